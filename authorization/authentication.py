@@ -0,0 +1,102 @@
+import pickle
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+LOCAL_CACHE_MAX_SIZE = 10000
+
+# (user_id, jti) -> (expires_at, pickled user); short-lived, so other workers may serve a stale profile that long
+_local_users = {}
+
+
+def get_auth_user_key(user_id, jti):
+    return f'auth_user:{user_id}:{jti}'
+
+
+def get_auth_generation_key(user_id):
+    return f'auth_user_generation:{user_id}'
+
+
+def invalidate_auth_user(user_id):
+    """
+    Drops the cached users of every token of the user: the shared entries
+    by bumping the user's generation, the local ones of this worker directly.
+    """
+    key = get_auth_generation_key(user_id)
+    cache.add(key, 0, None)
+    cache.incr(key)
+    for cache_key in [cache_key for cache_key in _local_users if cache_key[0] == user_id]:
+        _local_users.pop(cache_key, None)
+
+
+class ProfileJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that loads the user together with its UserProfile in
+    one query. With AUTH_USER_LOCAL_CACHE_TTL / AUTH_USER_CACHE_TTL set, the
+    loaded user is also cached per (user_id, token jti), in this worker and in
+    the shared cache, until invalidate_auth_user() is called for it. The
+    password hash is deferred, so it never reaches a cache; code that needs
+    it loads it on access.
+    """
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        user = self.get_cached_user(user_id, jti) if jti else None
+        if user is None:
+            try:
+                user = self.user_model.objects.select_related('user_profile').defer('password') \
+                    .get(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            if jti:
+                self.cache_user(user_id, jti, user)
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
+
+    def get_cached_user(self, user_id, jti):
+        # Every request gets its own instance, views are free to modify it
+        local = _local_users.get((user_id, jti))
+        if local and local[0] > time.monotonic():
+            return pickle.loads(local[1])
+
+        if not settings.AUTH_USER_CACHE_TTL:
+            return None
+        generation_key = get_auth_generation_key(user_id)
+        values = cache.get_many([get_auth_user_key(user_id, jti), generation_key])
+        entry = values.get(get_auth_user_key(user_id, jti))
+        if entry is None or entry['generation'] != values.get(generation_key, 0):
+            return None
+        self.cache_locally(user_id, jti, entry['user'])
+        return pickle.loads(entry['user'])
+
+    def cache_user(self, user_id, jti, user):
+        data = pickle.dumps(user)
+        if settings.AUTH_USER_CACHE_TTL:
+            generation = cache.get(get_auth_generation_key(user_id), 0)
+            cache.set(get_auth_user_key(user_id, jti), {'generation': generation, 'user': data},
+                      settings.AUTH_USER_CACHE_TTL)
+        self.cache_locally(user_id, jti, data)
+
+    def cache_locally(self, user_id, jti, data):
+        if not settings.AUTH_USER_LOCAL_CACHE_TTL:
+            return
+        if len(_local_users) >= LOCAL_CACHE_MAX_SIZE:
+            _local_users.clear()
+        _local_users[(user_id, jti)] = (time.monotonic() + settings.AUTH_USER_LOCAL_CACHE_TTL, data)
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import math
+import threading
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import aware_utcnow, datetime_from_epoch
+
+logger = logging.getLogger(__name__)
+
+BLOOM_MIN_CAPACITY = 100000
+BLOOM_ERROR_RATE = 0.001
+BLACKLIST_NEGATIVE_TTL = 300
+PRUNE_BATCH_SIZE = 1000
+
+
+class BloomFilter:
+    """
+    Set membership without false negatives: `jti in bloom` is False only for
+    jtis that were never added.
+    """
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        # Double hashing: position i is h1 + i * h2
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & 1 << (position & 7) for position in self.get_positions(value))
+
+
+def get_remaining_lifetime(expires_at):
+    return max(int((expires_at - aware_utcnow()).total_seconds()), 1)
+
+
+def get_blacklist_key(jti):
+    return f'token_blacklist:{jti}'
+
+
+def get_blacklist_log_key(number):
+    return f'token_blacklist:log:{number}'
+
+
+BLACKLIST_VERSION_KEY = 'token_blacklist:version'
+
+
+class TokenBlacklist:
+    """
+    Membership of refresh token jtis in the blacklist. A Bloom filter of the
+    blacklisted, unexpired jtis answers the common "not blacklisted" case in
+    memory; its positives are confirmed by the exact cache entry and then the
+    database. Logouts on other workers reach the filter through a numbered
+    log in the shared cache, read with one cache lookup per check.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.version = 0
+
+    def load(self):
+        """
+        Rebuilds the filter from the database. Server processes call it at
+        startup (see load_token_blacklist); otherwise the first check does.
+        """
+        with self.lock:
+            version = cache.get(BLACKLIST_VERSION_KEY, 0)
+            jtis = BlacklistedToken.objects.filter(token__expires_at__gt=aware_utcnow()) \
+                .values_list('token__jti', flat=True)
+            bloom = BloomFilter(max(jtis.count() * 2, BLOOM_MIN_CAPACITY))
+            for jti in jtis.iterator(chunk_size=PRUNE_BATCH_SIZE):
+                bloom.add(jti)
+            self.bloom, self.version = bloom, version
+
+    def sync(self):
+        """Adds the jtis blacklisted by other workers since the last sync."""
+        if self.bloom is None:
+            return self.load()
+        version = cache.get(BLACKLIST_VERSION_KEY, 0)
+        if version == self.version:
+            return
+        numbers = range(self.version + 1, version + 1) if version > self.version else ()
+        entries = cache.get_many([get_blacklist_log_key(number) for number in numbers])
+        if not numbers or len(entries) < len(numbers) or self.bloom.count + len(entries) > self.bloom.capacity:
+            # Evicted log entries, a flushed cache or a full filter
+            return self.load()
+        with self.lock:
+            for jti in entries.values():
+                self.bloom.add(jti)
+            self.version = max(self.version, version)
+
+    def add(self, jti, expires_at):
+        timeout = get_remaining_lifetime(expires_at)
+        cache.set(get_blacklist_key(jti), True, timeout)
+        cache.add(BLACKLIST_VERSION_KEY, 0, None)
+        cache.set(get_blacklist_log_key(cache.incr(BLACKLIST_VERSION_KEY)), jti, timeout)
+        if self.bloom is not None:
+            with self.lock:
+                self.bloom.add(jti)
+
+    def contains(self, jti, expires_at):
+        """Whether the token `jti`, valid until `expires_at`, is blacklisted."""
+        self.sync()
+        if jti not in self.bloom:
+            return False
+
+        key = get_blacklist_key(jti)
+        blacklisted = cache.get(key)
+        if blacklisted is None:
+            blacklisted = BlacklistedToken.objects.filter(token__jti=jti).exists()
+            # A blacklisted token is remembered until it expires anyway; false positives of the filter only
+            # for a while, the token may still get blacklisted
+            cache.set(key, blacklisted, get_remaining_lifetime(expires_at) if blacklisted else BLACKLIST_NEGATIVE_TTL)
+        return blacklisted
+
+
+token_blacklist = TokenBlacklist()
+
+
+def load_token_blacklist():
+    """Builds the filter of this process before it serves its first request."""
+    try:
+        token_blacklist.load()
+    except DatabaseError as e:
+        # No tables yet, e.g. before the first migrate: the first check loads it
+        logger.warning("Loading the token blacklist failed: %s", e)
+
+
+class CachedBlacklistRefreshToken(RefreshToken):
+    """
+    RefreshToken that checks the blacklist through token_blacklist. Every new
+    BlacklistedToken, however it is created, reaches token_blacklist through
+    authorization.signals.
+    """
+    def check_blacklist(self):
+        if token_blacklist.contains(self.payload[api_settings.JTI_CLAIM], datetime_from_epoch(self.payload['exp'])):
+            raise TokenError(_("Token is blacklisted"))
+
+
+class CachedBlacklistTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = CachedBlacklistRefreshToken
+
+
+def prune_expired_tokens(batch_size=PRUNE_BATCH_SIZE):
+    """
+    Deletes the expired outstanding tokens and their blacklist entries in
+    batches of batch_size ids. Returns the number of outstanding tokens
+    deleted.
+    """
+    deleted = 0
+    while True:
+        ids = list(OutstandingToken.objects.filter(expires_at__lte=aware_utcnow())
+                   .order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
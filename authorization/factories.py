@@ -0,0 +1,12 @@
+from .models import Organization, User, UserProfile
+
+# Test helpers shared by the apps' tests
+
+
+def create_profile(name):
+    user = User.objects.create_user(f"{name}@example.com", "password")
+    return UserProfile.objects.create(user=user, first_name=name, last_name="test")
+
+
+def create_organization(founder, title="Organization", **fields):
+    return Organization.objects.create(founder=founder, owner=founder, title=title, description="org", **fields)
@@ -0,0 +1,33 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from authorization.blacklist import PRUNE_BATCH_SIZE, prune_expired_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Deletes expired outstanding refresh tokens and their blacklist entries in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=3600,
+                            help="Seconds between two prunes.")
+        parser.add_argument('--batch-size', type=int, default=PRUNE_BATCH_SIZE)
+        parser.add_argument('--once', action='store_true',
+                            help="Prune once and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                deleted = prune_expired_tokens(options['batch_size'])
+                self.stdout.write(f"Pruned {deleted} expired tokens")
+            except Exception:
+                logger.exception("Token pruning failed")
+                if options['once']:
+                    raise
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
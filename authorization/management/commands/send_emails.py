@@ -0,0 +1,41 @@
+import logging
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from authorization.services import EMAIL_BATCH_SIZE, send_email_batch
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Sends the queued outbox emails over one reused connection."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait when no email is due.")
+        parser.add_argument('--batch-size', type=int, default=EMAIL_BATCH_SIZE)
+        parser.add_argument('--once', action='store_true',
+                            help="Send the due emails and exit.")
+
+    def handle(self, *args, **options):
+        connection = get_connection()
+        try:
+            while True:
+                try:
+                    handled = send_email_batch(connection, options['batch_size'])
+                except Exception:
+                    logger.exception("Email outbox sending failed")
+                    handled = 0
+                    if options['once']:
+                        raise
+
+                if not handled:
+                    if options['once']:
+                        return
+                    # Idle SMTP connections get dropped by the server, reconnect on the next email
+                    connection.close()
+                    time.sleep(options['interval'])
+        finally:
+            connection.close()
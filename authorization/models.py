@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser, PermissionsMixin
 from autoslug import AutoSlugField
 from operator import attrgetter
@@ -95,3 +96,22 @@ class Organization(models.Model):
 
     def __str__(self):
         return f"Title: {self.title}; Email: {self.founder.user.email}; Slug: {self.slug}"
+
+class EmailOutbox(models.Model):
+    # Transactional emails committed by the request and sent by the `send_emails` command
+    to_email = models.EmailField()
+    subject = models.CharField(max_length = 255)
+    template = models.CharField(max_length = 255)
+    context = models.JSONField(default = dict)
+    attempts = models.PositiveIntegerField(default = 0)
+    next_attempt_at = models.DateTimeField(default = timezone.now)
+    last_error = models.TextField(blank = True)
+    created_at = models.DateTimeField(auto_now_add = True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ['next_attempt_at'], name = 'email_outbox_next_attempt_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to_email}; attempts: {self.attempts}"
@@ -1,10 +1,24 @@
+import logging
 import random
+from datetime import timedelta
 
-from rest_framework_simplejwt.tokens import RefreshToken
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
 
-from .models import ConfirmationCode
+from .blacklist import CachedBlacklistRefreshToken
+from .models import ConfirmationCode, EmailOutbox
 from .utils import EmailUtil
 
+logger = logging.getLogger(__name__)
+
+EMAIL_BATCH_SIZE = 50
+EMAIL_MAX_ATTEMPTS = 8
+EMAIL_RETRY_DELAY = 30
+EMAIL_MAX_RETRY_DELAY = 3600
+# Seconds a claimed batch is hidden from other workers, longer than sending it takes
+EMAIL_LEASE = 600
+
 def create_token_and_send_to_email(user):
     code = ''
     for i in range(4):
@@ -16,20 +30,79 @@ def create_token_and_send_to_email(user):
     else:
         user_code.code = code
         user_code.save()
-    data = {'code': user_code.code,
-            'user_name': user.user_profile.first_name,
-            'email_subject': 'Verify your email',
-            'to_email': user.email}
-    html = 'authorization/email_mess.html'
-    EmailUtil.send_email(data, html)
+    queue_email(user.email, 'Verify your email', 'authorization/email_mess.html', {
+        'user_code': user_code.code,
+        'user_name': user.user_profile.first_name,
+    })
 
 def get_tokens_for_user(user):
-    refresh = RefreshToken.for_user(user)
+    refresh = CachedBlacklistRefreshToken.for_user(user)
     return {
         'refresh': str(refresh),
         'access': str(refresh.access_token),
     }
     
 def destroy_token(refresh_token):
-    token = RefreshToken(refresh_token)
-    token.blacklist()
\ No newline at end of file
+    token = CachedBlacklistRefreshToken(refresh_token)
+    token.blacklist()
+
+
+def queue_email(to_email, subject, template, context):
+    """
+    Adds the email to the outbox; it is rendered and sent by the `send_emails`
+    command, the request only pays for the insert.
+    """
+    return EmailOutbox.objects.create(to_email = to_email, subject = subject, template = template, context = context)
+
+
+def get_retry_delay(attempts):
+    # Exponential backoff: 30s, 1m, 2m, ... up to an hour
+    return timedelta(seconds = min(EMAIL_RETRY_DELAY * 2 ** (attempts - 1), EMAIL_MAX_RETRY_DELAY))
+
+
+def send_email_batch(connection = None, batch_size = EMAIL_BATCH_SIZE):
+    """
+    Sends one batch of due outbox emails over `connection`, which stays open
+    for the next batch. The batch is claimed for EMAIL_LEASE seconds and sent
+    outside of any transaction, so a worker that dies mid-batch has its emails
+    sent again by the next one: delivery is at least once. Sent emails are
+    deleted; failed ones are retried with backoff and dropped on the
+    EMAIL_MAX_ATTEMPTS-th failure. Returns the number of emails handled.
+    """
+    connection = connection or get_connection()
+    with transaction.atomic():
+        emails = list(EmailOutbox.objects.select_for_update(skip_locked = True)
+                      .filter(next_attempt_at__lte = timezone.now())
+                      .order_by('next_attempt_at', 'id')[:batch_size])
+        if not emails:
+            return 0
+        # Other workers skip the claimed emails until the lease runs out
+        EmailOutbox.objects.filter(id__in = [email.id for email in emails]) \
+            .update(next_attempt_at = timezone.now() + timedelta(seconds = EMAIL_LEASE))
+
+    sent, failed, dropped = [], [], []
+    for email in emails:
+        try:
+            connection.open()
+            EmailUtil.build_email(email.subject, email.to_email, email.template, email.context,
+                                  connection = connection).send()
+        except Exception as e:
+            logger.warning("Sending email %s failed: %s", email.id, e)
+            # The next attempt reconnects
+            connection.close()
+            email.attempts += 1
+            email.last_error = str(e)
+            if email.attempts >= EMAIL_MAX_ATTEMPTS:
+                logger.error("Dropping email %s to %s after %s attempts: %s", email.id, email.to_email,
+                             email.attempts, e)
+                dropped.append(email.id)
+            else:
+                email.next_attempt_at = timezone.now() + get_retry_delay(email.attempts)
+                failed.append(email)
+        else:
+            sent.append(email.id)
+
+    with transaction.atomic():
+        EmailOutbox.objects.filter(id__in = sent + dropped).delete()
+        EmailOutbox.objects.bulk_update(failed, ['attempts', 'next_attempt_at', 'last_error'])
+    return len(emails)
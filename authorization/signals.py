@@ -0,0 +1,29 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from .authentication import invalidate_auth_user
+from .blacklist import token_blacklist
+from .models import User, UserProfile
+
+
+def user_changed(sender, instance, **kwargs):
+    # Profile edits (MyProfileAPIView.put), deleted accounts (DeleteUserAPIView) and any other save
+    invalidate_auth_user(instance.pk)
+
+
+def profile_changed(sender, instance, **kwargs):
+    invalidate_auth_user(instance.user_id)
+
+
+def token_blacklisted(sender, instance, created, **kwargs):
+    # Logouts, the token_blacklist admin and plain RefreshToken.blacklist() alike; a rolled back one is not announced
+    if created:
+        token = instance.token
+        transaction.on_commit(lambda: token_blacklist.add(token.jti, token.expires_at))
+
+
+post_save.connect(token_blacklisted, sender=BlacklistedToken, dispatch_uid='token-blacklisted')
+for signal in (post_save, post_delete):
+    signal.connect(user_changed, sender=User, dispatch_uid=f'auth-user-{signal is post_save}')
+    signal.connect(profile_changed, sender=UserProfile, dispatch_uid=f'auth-user-profile-{signal is post_save}')
@@ -1,3 +1,229 @@
-from django.test import TestCase
+import uuid
+from datetime import timedelta
+from smtplib import SMTPException
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from .authentication import ProfileJWTAuthentication, _local_users, get_auth_user_key, invalidate_auth_user
+from .blacklist import BloomFilter, CachedBlacklistRefreshToken, TokenBlacklist, load_token_blacklist, token_blacklist
+from .factories import create_profile
+from .models import EmailOutbox
+from .services import (EMAIL_LEASE, EMAIL_MAX_ATTEMPTS, destroy_token, get_tokens_for_user, queue_email,
+                       send_email_batch)
+
+
+class AuthenticationTests(TestCase):
+    def setUp(self):
+        # Cached users are keyed by ids, which are reused between tests
+        cache.clear()
+        _local_users.clear()
+        self.profile = create_profile("user")
+        self.access = get_tokens_for_user(self.profile.user)['access']
+
+    def authenticate(self):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        return ProfileJWTAuthentication().authenticate(request)[0]
+
+    @override_settings(AUTH_USER_LOCAL_CACHE_TTL=0, AUTH_USER_CACHE_TTL=0)
+    def test_user_and_profile_are_loaded_in_one_query(self):
+        with self.assertNumQueries(1):
+            user = self.authenticate()
+            self.assertEqual(user.user_profile, self.profile)
+
+    def test_cached_user_costs_no_queries(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+            self.assertEqual(user.user_profile.first_name, "user")
+
+    @override_settings(AUTH_USER_LOCAL_CACHE_TTL=0)
+    def test_shared_cache_serves_other_workers(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            self.authenticate()
+
+    def test_every_request_gets_its_own_instance(self):
+        first = self.authenticate()
+        first.user_profile.first_name = "changed"
+        self.assertEqual(self.authenticate().user_profile.first_name, "user")
+
+    def test_profile_update_invalidates_the_cache(self):
+        self.authenticate()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        response = client.put('/my-profile/', {'first_name': "renamed", 'last_name': "test", 'middle_name': "test"})
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate().user_profile.first_name, "renamed")
+
+    def test_deleted_user_is_rejected(self):
+        self.authenticate()
+        self.profile.user.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_password_hash_stays_out_of_the_caches(self):
+        self.authenticate()
+        entry = cache.get(get_auth_user_key(self.profile.user_id, AccessToken(self.access)['jti']))
+        self.assertNotIn(self.profile.user.password.encode(), entry['user'])
+        self.assertFalse(any(self.profile.user.password.encode() in data for _, data in _local_users.values()))
+        # Loaded on access
+        with self.assertNumQueries(1):
+            self.assertTrue(self.authenticate().check_password("password"))
+
+    def test_invalidation_drops_the_shared_entries(self):
+        self.authenticate()
+        invalidate_auth_user(self.profile.user_id)
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+
+class BloomFilterTests(TestCase):
+    def test_added_values_are_always_found(self):
+        bloom = BloomFilter(1000)
+        values = [str(uuid.uuid4()) for _ in range(1000)]
+        for value in values:
+            bloom.add(value)
+        self.assertTrue(all(value in bloom for value in values))
+
+    def test_false_positive_rate_is_near_the_target(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for _ in range(1000):
+            bloom.add(str(uuid.uuid4()))
+        false_positives = sum(str(uuid.uuid4()) in bloom for _ in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TokenBlacklistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile = create_profile("user")
+        self.blacklist = TokenBlacklist()
+        self.blacklist.load()
+
+    def create_token(self):
+        return CachedBlacklistRefreshToken.for_user(self.profile.user)
+
+    def contains(self, token):
+        return self.blacklist.contains(token['jti'], datetime_from_epoch(token['exp']))
+
+    def test_unlisted_tokens_cost_no_queries(self):
+        token = self.create_token()
+        with self.assertNumQueries(0):
+            self.assertFalse(self.contains(token))
+
+    def test_blacklisted_token_is_refused(self):
+        token = self.create_token()
+        refresh = str(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            destroy_token(refresh)
+        response = APIClient().post('/authorization/refresh-token', {'refresh': refresh})
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_on_another_worker_reaches_the_filter(self):
+        token = self.create_token()
+        # Blacklisted through the process-wide instance, as another worker would
+        with self.captureOnCommitCallbacks(execute=True):
+            token.blacklist()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.contains(token))
+
+    def test_tokens_blacklisted_through_the_orm_are_refused(self):
+        token_blacklist.load()
+        token = RefreshToken.for_user(self.profile.user)
+        refresh = str(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token['jti']))
+        response = APIClient().post('/authorization/refresh-token', {'refresh': refresh})
+        self.assertEqual(response.status_code, 401)
+
+    def test_confirmed_positive_expires_with_the_token(self):
+        token = self.create_token()
+        BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token['jti']))
+        # The filter of a fresh load holds it, the cache does not
+        self.blacklist.load()
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            self.assertTrue(self.contains(token))
+        timeout = cache_set.call_args.args[2]
+        self.assertIsNotNone(timeout)
+        self.assertLessEqual(timeout, api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+
+    def test_missing_tables_leave_the_load_to_the_first_check(self):
+        with mock.patch.object(token_blacklist, 'load', side_effect=DatabaseError("no such table")), \
+                self.assertLogs('authorization.blacklist', 'WARNING'):
+            load_token_blacklist()
+
+
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        self.connection = get_connection()
+
+    def queue(self, to_email="user@example.com", **fields):
+        email = queue_email(to_email, "Subject", 'authorization/email_mess.html', {'user_code': '1234'})
+        if fields:
+            EmailOutbox.objects.filter(pk=email.pk).update(**fields)
+        return email
+
+    def fail_sending(self, error=SMTPException("Connection unexpectedly closed")):
+        return mock.patch.object(self.connection, 'send_messages', side_effect=error)
+
+    def test_sent_emails_leave_the_outbox(self):
+        self.queue("first@example.com")
+        self.queue("second@example.com")
+        self.assertEqual(send_email_batch(self.connection), 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ["first@example.com", "second@example.com"])
+        self.assertFalse(EmailOutbox.objects.exists())
+        self.assertEqual(send_email_batch(self.connection), 0)
+
+    def test_emails_are_sent_outside_the_transaction(self):
+        self.queue()
+        depth = len(connection.atomic_blocks)
+        depths = []
+        send_messages = self.connection.send_messages
+        with mock.patch.object(self.connection, 'send_messages',
+                               side_effect=lambda messages: depths.append(len(connection.atomic_blocks))
+                               or send_messages(messages)):
+            send_email_batch(self.connection)
+        self.assertEqual(depths, [depth])
+
+    def test_failed_email_is_retried_with_backoff(self):
+        email = self.queue()
+        with self.fail_sending(), self.assertLogs('authorization.services', 'WARNING'):
+            self.assertEqual(send_email_batch(self.connection), 1)
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 1)
+        self.assertIn("unexpectedly closed", email.last_error)
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(send_email_batch(self.connection), 0)
+
+    def test_email_is_dropped_on_the_last_attempt(self):
+        self.queue(attempts=EMAIL_MAX_ATTEMPTS - 1)
+        with self.fail_sending(), self.assertLogs('authorization.services', 'ERROR'):
+            send_email_batch(self.connection)
+        self.assertFalse(EmailOutbox.objects.exists())
+        self.assertEqual(mail.outbox, [])
+
+    def test_batch_of_a_dead_worker_is_sent_after_the_lease(self):
+        self.queue()
+        # The worker dies before recording the outcome
+        with mock.patch.object(self.connection, 'send_messages', side_effect=SystemExit), \
+                self.assertRaises(SystemExit):
+            send_email_batch(self.connection)
+        self.assertEqual(send_email_batch(self.connection), 0)
+        later = timezone.now() + timedelta(seconds=EMAIL_LEASE + 1)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(send_email_batch(self.connection), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(EmailOutbox.objects.exists())
@@ -1,27 +1,25 @@
 import re
+from functools import lru_cache
 
 from django.db import models
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMultiAlternatives
 from django.utils.translation import gettext as _
-from django.template.loader import render_to_string
+from django.template.loader import get_template
+
+# Templates are compiled once per process
+get_email_template = lru_cache(maxsize = None)(get_template)
 
 class EmailUtil:
     """
-    Email sending class
+    Email building class, the emails are sent from the outbox by the `send_emails` command
     """
     @staticmethod
-    def send_email(data, html):
-        context = {
-            'user_code': data['code'],
-            'user_name': data['user_name'],
-        }
-        html_content = render_to_string(
-            html, context = context
-        )
-        email = EmailMultiAlternatives(subject = data['email_subject'], to = [data['to_email']])
+    def build_email(subject, to_email, html, context, connection = None):
+        html_content = get_email_template(html).render(context)
+        email = EmailMultiAlternatives(subject = subject, to = [to_email], connection = connection)
         email.attach_alternative(html_content, "text/html")
-        email.send()
+        return email
 
 # Overriding email field of the model
 class LowercaseEmailField(models.EmailField):
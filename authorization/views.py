@@ -10,6 +10,7 @@ from drf_yasg.utils import swagger_auto_schema
 
 from .serializers import RegistrationSerializer, LoginSerializer
 from .models import User, UserProfile, ConfirmationCode
+from .blacklist import CachedBlacklistTokenRefreshSerializer
 from .services import get_tokens_for_user, create_token_and_send_to_email, destroy_token
 from .swagger import (login_swagger, resend_swagger, verify_swagger, 
                       register_swagger, delete_swagger, logout_swagger)
@@ -169,6 +170,8 @@ class LogoutAPIView(APIView):
             return Response({"Error": "Ошибка при выходе из учетной записи."}, status=status.HTTP_400_BAD_REQUEST)
 
 class TokenRefreshView(TokenRefreshView):
+    serializer_class = CachedBlacklistTokenRefreshSerializer
+
     @swagger_auto_schema(
         tags=['Authorization'],
         operation_description="Этот эндпоинт предоставляет "
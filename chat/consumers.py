@@ -1,121 +1,498 @@
-import base64
+import asyncio
 import json
-import secrets
+import uuid
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from django.core.files.base import ContentFile
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
 
 from authorization.models import UserProfile
-from .models import Message, Conversation
-from .serializers import MessageSerializer
+from notif.consumers import NotificationStream
+from .models import Message, Conversation, MessageUpload
+from .services import get_message_buffer, MessageBufferFull, start_upload, write_upload_chunks, complete_upload, \
+    get_message_event, UPLOAD_CHUNK_SIZE, \
+    connect_presence, refresh_presence, disconnect_presence, get_presence, set_typing, is_typing, \
+    anext_sequence, get_messages_after, set_ack, get_ack, PRESENCE_REFRESH_INTERVAL, TYPING_INTERVAL, TYPING_TTL
 
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+def parse_sequence(value):
+    try:
+        sequence = int(value)
+    except (TypeError, ValueError):
+        return None
+    return sequence if sequence >= 0 else None
+
+
+class ChatRoom:
+    """
+    One conversation joined by a socket: messages, typing, presence and
+    attachment uploads. `send` delivers a dict to the client, so the same
+    room works for a ChatConsumer socket and inside a UserConsumer.
+
+    Messages are queued in the write-behind MessageBuffer and fanned out to
+    the room right away, so delivery never waits on the database unless
+    the buffer is full. Messages over Message.text's max_length, and any
+    message while the database is unavailable and the buffer full, are
+    answered with {"error"} and not sent.
+    Presence and typing state is kept in the cache: a room refreshes its
+    presence at most every PRESENCE_REFRESH_INTERVAL seconds and forwards
+    "typing" at most every TYPING_INTERVAL seconds, however fast the
+    client sends it.
+
+    Every message carries its sequence number in the conversation. The
+    client confirms what it has with {"ack": n}, stored on the
+    conversation, and joins or sends {"resume": n} to get the messages
+    after n as one {"replay": [...], "has_more"} frame (a range query on
+    the sequence index); joining without an offset resumes from the last
+    ack. With
+    "has_more" it resumes again from the last replayed sequence. Live
+    messages can arrive before the replay; clients drop sequences they
+    already have, and a gap in the numbers means resuming again.
+    """
+    def __init__(self, consumer, conversation, profile, send):
+        self.consumer = consumer
+        self.conversation = conversation
+        self.profile = profile
+        self.send = send
+        self.group_name = f"chat_{conversation.id}"
+        self.upload = None
+        self.presence_refreshed_at = None
+        self.typing_sent_at = None
+
+    async def join(self, offset=None):
+        await self.consumer.channel_layer.group_add(self.group_name, self.consumer.channel_name)
+        await self.connect_presence()
+        if offset is None:
+            offset = get_ack(self.conversation, self.profile.id)
+        if offset is not None:
+            await self.replay(offset)
+
+    async def leave(self, presence=True):
+        """Leaves the room; `presence` False leaves the socket online, for a socket still in other rooms."""
+        await self.consumer.channel_layer.group_discard(self.group_name, self.consumer.channel_name)
+        await get_message_buffer().flush()
+        if self.typing_sent_at is not None:
+            await self.send_typing(False)
+        if presence and await disconnect_presence(self.profile.id, self.consumer.channel_name):
+            await self.group_send_presence(await get_presence(self.profile.id))
+
+    async def group_send(self, event):
+        # The conversation id lets a socket that joined several rooms pick the right one
+        await self.consumer.channel_layer.group_send(
+            self.group_name, {**event, 'conversation_id': self.conversation.id}
+        )
+
+    def get_participant(self):
+        if self.profile.id == self.conversation.initiator_id:
+            return self.conversation.receiver
+        return self.conversation.initiator
+
+    async def connect_presence(self):
+        self.presence_refreshed_at = asyncio.get_running_loop().time()
+        # Only the first socket of a profile announces it
+        if await connect_presence(self.profile.id, self.consumer.channel_name) == 1:
+            await self.group_send_presence({'online': True, 'last_seen': None})
+
+        participant = self.get_participant()
+        if participant is not None:
+            presence = await get_presence(participant.id)
+            typing = await is_typing(self.conversation.id, participant.id)
+            await self.send({'presence': {'sender': participant.slug, **presence, 'typing': typing}})
+
+    async def refresh_presence(self):
+        now = asyncio.get_running_loop().time()
+        if now - self.presence_refreshed_at >= PRESENCE_REFRESH_INTERVAL:
+            self.presence_refreshed_at = now
+            await refresh_presence(self.profile.id, self.consumer.channel_name)
+
+    async def group_send_presence(self, presence):
+        await self.group_send({
+            'type': 'chat_presence',
+            'user_slug': self.profile.slug,
+            'sender_channel': self.consumer.channel_name,
+            **presence,
+        })
+
+    async def receive_typing(self, typing):
+        if typing:
+            now = asyncio.get_running_loop().time()
+            if self.typing_sent_at is not None and now - self.typing_sent_at < TYPING_INTERVAL:
+                return
+            self.typing_sent_at = now
+        elif self.typing_sent_at is None:
+            return
+        await self.send_typing(bool(typing))
+
+    async def send_typing(self, typing):
+        if not typing:
+            self.typing_sent_at = None
+        await set_typing(self.conversation.id, self.profile.id, typing)
+        await self.group_send({
+            'type': 'chat_typing',
+            'user_slug': self.profile.slug,
+            'sender_channel': self.consumer.channel_name,
+            'typing': typing,
+        })
+
+    async def receive(self, data):
+        await self.refresh_presence()
+        if 'upload' in data:
+            await self.receive_upload_command(data)
+            return
+        if 'typing' in data:
+            await self.receive_typing(data['typing'])
+            return
+        if 'ping' in data:
+            # Keeps the presence of an idle socket alive
+            return
+        if 'ack' in data:
+            sequence = parse_sequence(data['ack'])
+            if sequence is not None:
+                await database_sync_to_async(set_ack)(self.conversation, self.profile.id, sequence)
+            return
+        if 'resume' in data:
+            sequence = parse_sequence(data['resume'])
+            if sequence is not None:
+                await self.replay(sequence)
+            return
+        message = data.get('message')
+        if not isinstance(message, str) or len(message) > Message._meta.get_field('text').max_length:
+            await self.send({'error': "message must be a text of at most "
+                                      f"{Message._meta.get_field('text').max_length} characters"})
+            return
+        chat_message = Message(
+            uid=uuid.uuid4(),
+            sender=self.profile,
+            text=message,
+            conversation_id=self.conversation,
+        )
+        try:
+            await get_message_buffer().add(chat_message, anext_sequence)
+        except MessageBufferFull:
+            # Not sent either: the client retries what the room never saw
+            await self.send({'error': "Messages cannot be stored right now, try again later", 'message': message})
+            return
+        # Send message to room group
+        await self.group_send({
+            'type': 'chat_message',
+            'message': message,
+            'user_slug': self.profile.slug,
+            'sequence': chat_message.sequence,
+        })
+        if self.typing_sent_at is not None:
+            # The message itself tells the room that typing stopped
+            self.typing_sent_at = None
+            await set_typing(self.conversation.id, self.profile.id, False)
+
+    async def replay(self, offset):
+        # Messages of this worker's buffer are stored first, so the range query sees them
+        await get_message_buffer().flush()
+        messages, has_more = await database_sync_to_async(get_messages_after)(self.conversation.id, offset)
+        await self.send({
+            'replay': [self.get_message_frame(message) for message in messages],
+            'has_more': has_more,
+        })
+
+    def get_message_frame(self, message):
+        frame = {
+            'message': message.text,
+            'sender': message.sender.slug if message.sender else None,
+            'sequence': message.sequence,
+        }
+        if message.attachment:
+            frame['attachment'] = message.attachment.url
+        return frame
+
+    # Attachment upload protocol:
+    #   {"upload": "start", "file_name", "size", "sha256"} or {"upload": "resume", "upload_id"}
+    #       -> {"upload": "ready", "upload_id", "offset", "chunk_size"}
+    #   binary frames with the next bytes of the file -> {"upload": "ack", "upload_id", "offset"}
+    #   {"upload": "complete", "message"} -> the message is sent to the room with its attachment
+    async def receive_upload_command(self, command):
+        try:
+            action = command['upload']
+            if action == 'start':
+                self.upload = await database_sync_to_async(start_upload)(
+                    self.conversation, self.profile, command.get('file_name'), command.get('size'),
+                    command.get('sha256'))
+            elif action == 'resume':
+                self.upload = await self.get_upload(command.get('upload_id'))
+            elif action == 'complete':
+                await self.complete_upload(command.get('message', ''))
+                return
+            else:
+                raise ValidationError("Unknown upload command")
+        except ValidationError as error:
+            await self.send_upload_error(error)
+            return
+
+        await self.send({
+            'upload': 'ready',
+            'upload_id': str(self.upload.id),
+            'offset': self.upload.received,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+        })
+
+    async def receive_upload_chunk(self, chunk):
+        await self.refresh_presence()
+        upload = self.upload
+        if upload is None:
+            await self.send_upload_error(ValidationError("No upload in progress"))
+            return
+        try:
+            offset = await database_sync_to_async(write_upload_chunks)(upload, upload.received, [chunk])
+        except ValidationError as error:
+            await self.send_upload_error(error)
+            return
+        await self.send({'upload': 'ack', 'upload_id': str(upload.id), 'offset': offset})
+
+    async def complete_upload(self, text):
+        upload = self.upload
+        if upload is None:
+            raise ValidationError("No upload in progress")
+        message = await database_sync_to_async(complete_upload)(upload, text)
+        self.upload = None
+        await self.group_send(get_message_event(message))
+
+    @database_sync_to_async
+    def get_upload(self, upload_id):
+        try:
+            upload = MessageUpload.objects.filter(id=upload_id, owner=self.profile,
+                                                  conversation=self.conversation).first()
+        except DjangoValidationError:
+            upload = None
+        if upload is None:
+            raise ValidationError("Upload does not exist")
+        return upload
+
+    async def send_upload_error(self, error):
+        await self.send({'upload': 'error', 'detail': error.detail})
+
+    # Receive message from room group
+    async def chat_message(self, event):
+        re_dict = {
+            'message': event['message'],
+            'sender': event['user_slug'],
+            'sequence': event.get('sequence'),
+        }
+        if event.get('attachment'):
+            re_dict['attachment'] = event['attachment']
+        await self.send(re_dict)
+
+    async def chat_presence(self, event):
+        if event['sender_channel'] == self.consumer.channel_name:
+            return
+        await self.send({'presence': {
+            'sender': event['user_slug'],
+            'online': event['online'],
+            'last_seen': event['last_seen'],
+        }})
+
+    async def chat_typing(self, event):
+        if event['sender_channel'] == self.consumer.channel_name:
+            return
+        # Clients drop the indicator after `ttl` seconds without a repeat
+        await self.send({'typing': {
+            'sender': event['user_slug'],
+            'typing': event['typing'],
+            'ttl': TYPING_TTL,
+        }})
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """One socket per conversation: ws/chat/<conversation id>/?offset=<last sequence the client has>."""
+    async def connect(self):
         self.sender = self.scope['user']
+        self.room = None
         if self.sender.is_authenticated:
             self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-            self.conversation = Conversation.objects.get(id=int(self.room_name))
-            self.room_group_name = f"chat_{self.room_name}"
-
-            if self.conversation.receiver == self.sender.user_profile or self.conversation.initiator == self.sender.user_profile:
-                async_to_sync(self.channel_layer.group_add)(
-                    self.room_group_name, self.channel_name
-                )
-                self.accept()
-                self.send(json.dumps({"accept": True}))
-            
+            conversation, profile = await self.get_conversation_and_profile(int(self.room_name))
+
+            if conversation and profile.id in (conversation.receiver_id, conversation.initiator_id):
+                self.room = ChatRoom(self, conversation, profile, self.send_data)
+                await self.accept()
+                await self.send(json.dumps({"accept": True}))
+                params = parse_qs(self.scope.get('query_string', b'').decode())
+                await self.room.join(parse_sequence(params.get('offset', [None])[0]))
+
         # self.send({"close": True})
 
-    def disconnect(self, close_code):
+    @database_sync_to_async
+    def get_conversation_and_profile(self, conversation_id):
+        conversation = Conversation.objects.filter(id=conversation_id).select_related('initiator', 'receiver').first()
+        return conversation, self.sender.user_profile
+
+    async def disconnect(self, close_code):
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name, self.channel_name
-        )
+        if self.room:
+            await self.room.leave()
+
+    async def send_data(self, data):
+        await self.send(text_data=json.dumps(data))
 
-    # # Receive message from WebSocket
-    # def receive(self, text_data=None, bytes_data=None):
-    #     # parse the json data into dictionary object
-    #     text_data_json = json.loads(text_data)
-    #     # Send message to room group
-    #     chat_type = {"type": "chat_message"}
-    #     return_dict = {**chat_type, **text_data_json}
-    #     async_to_sync(self.channel_layer.group_send)(
-    #         self.room_group_name,
-    #         return_dict,
-    #     )
-
-    # # Receive message from room group
-    # def chat_message(self, event):
-    #     text_data_json = event.copy()
-    #     text_data_json.pop("type")
-    #     message, attachment = (
-    #         text_data_json["message"],
-    #         text_data_json.get("attachment"),
-    #     )
-
-    #     conversation = self.conversation
-    #     sender = self.sender
-
-    #     # Attachment
-    #     if attachment:
-    #         file_str, file_ext = attachment["data"], attachment["format"]
-
-    #         file_data = ContentFile(
-    #             base64.b64decode(file_str), name=f"{secrets.token_hex(8)}.{file_ext}"
-    #         )
-    #         _message = Message.objects.create(
-    #             sender=sender.user_profile,
-    #             attachment=file_data,
-    #             text=message,
-    #             conversation_id=conversation,
-    #         )
-    #     else:
-    #         _message = Message.objects.create(
-    #             sender=sender.user_profile,
-    #             text=message,
-    #             conversation_id=conversation,
-    #         )
-    #     serializer = MessageSerializer(instance=_message)
-    #     # Send message to WebSocket
-    #     self.send(
-    #         text_data=json.dumps(
-    #             serializer.data
-    #         ).encode('utf-8').decode()
-    #     )
     # Receive message from WebSocket
-    def receive(self, text_data=None, bytes_data=None):
-        # parse the json data into dictionary object
-        text_data_json = json.loads(text_data)
-        # Send message to room group
-        message = text_data_json['message']
-        sender = self.sender
-        Message.objects.create(
-                sender=sender.user_profile,
-                text=message,
-                conversation_id=self.conversation
-        )
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'user_slug': self.sender.user_profile.slug
-            }
-        )
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.room.receive_upload_chunk(bytes_data)
+        else:
+            await self.room.receive(json.loads(text_data))
 
-    # Receive message from room group
-    def chat_message(self, event):
-        message = event['message']
-        user_slug = event['user_slug']
-        re_dict = {
-            'message': message,
-            'sender': user_slug
-        }
-        # Send message to WebSocket
-        self.send(
-            text_data=json.dumps(
-                re_dict
-            ).encode('utf-8').decode()
-        )
\ No newline at end of file
+    async def chat_message(self, event):
+        await self.room.chat_message(event)
+
+    async def chat_presence(self, event):
+        await self.room.chat_presence(event)
+
+    async def chat_typing(self, event):
+        await self.room.chat_typing(event)
+
+
+class UserConsumer(AsyncWebsocketConsumer):
+    """
+    One authenticated socket per user, ws/stream/, carrying any number of
+    conversations and the notifications. The profile is loaded once on
+    connect; each subscription then costs one query for however many
+    conversations it names.
+
+        {"subscribe": ["notifications", "chat:12", "chat:15"], "last_sequence": n,
+         "offsets": {"chat:12": n}}
+        {"unsubscribe": "chat:12"}
+        {"stream": "chat:15", "message": "..."}   (any ChatConsumer frame)
+        {"stream": "notifications", "last_sequence": n}
+
+    Every frame sent to the client carries its "stream". Binary frames go
+    to the upload started last.
+    """
+    NOTIFICATIONS = 'notifications'
+    CHAT_PREFIX = 'chat:'
+
+    async def connect(self):
+        user = self.scope['user']
+        self.rooms = {}
+        self.notifications = None
+        self.upload_room = None
+        if not user.is_authenticated:
+            await self.close()
+            return
+        self.profile = await database_sync_to_async(lambda: user.user_profile)()
+        await self.accept()
+        await self.send(json.dumps({"accept": True}))
+
+    async def disconnect(self, close_code):
+        rooms, self.rooms = list(self.rooms.values()), {}
+        await self.leave_rooms(rooms)
+        if self.notifications:
+            await self.notifications.leave()
+
+    async def leave_rooms(self, rooms):
+        # The socket is online while it is in any room; going offline is announced to every room it leaves
+        for room in rooms:
+            await room.leave(presence=False)
+        if rooms and not self.rooms and await disconnect_presence(self.profile.id, self.channel_name):
+            presence = await get_presence(self.profile.id)
+            for room in rooms:
+                await room.group_send_presence(presence)
+
+    def get_sender(self, stream):
+        async def send(data):
+            await self.send(text_data=json.dumps({'stream': stream, **data}))
+        return send
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            if self.upload_room is None:
+                await self.send(json.dumps({'upload': 'error', 'detail': ["No upload in progress"]}))
+                return
+            await self.upload_room.receive_upload_chunk(bytes_data)
+            return
+
+        data = json.loads(text_data)
+        if 'subscribe' in data:
+            await self.subscribe(self.get_streams(data['subscribe']), data.get('last_sequence'), data.get('offsets'))
+        elif 'unsubscribe' in data:
+            await self.unsubscribe(self.get_streams(data['unsubscribe']))
+        elif data.get('stream') == self.NOTIFICATIONS and self.notifications:
+            await self.notifications.receive(data)
+        elif self.get_conversation_id(data.get('stream')) in self.rooms:
+            room = self.rooms[self.get_conversation_id(data['stream'])]
+            if 'upload' in data:
+                self.upload_room = room
+            await room.receive(data)
+        else:
+            await self.send(json.dumps({'error': "Not subscribed", 'stream': data.get('stream')}))
+
+    def get_streams(self, streams):
+        return [streams] if isinstance(streams, str) else list(streams)
+
+    def get_conversation_id(self, stream):
+        if isinstance(stream, str) and stream.startswith(self.CHAT_PREFIX) and stream[len(self.CHAT_PREFIX):].isdigit():
+            return int(stream[len(self.CHAT_PREFIX):])
+        return None
+
+    async def subscribe(self, streams, last_sequence=None, offsets=None):
+        offsets = offsets if isinstance(offsets, dict) else {}
+        if self.NOTIFICATIONS in streams and self.notifications is None:
+            self.notifications = NotificationStream(self, self.profile.id, self.get_sender(self.NOTIFICATIONS),
+                                                    last_sequence)
+            await self.send(json.dumps({'subscribed': self.NOTIFICATIONS}))
+            await self.notifications.join()
+
+        conversation_ids = {self.get_conversation_id(stream) for stream in streams} - {None} - set(self.rooms)
+        conversations = await self.get_conversations(conversation_ids) if conversation_ids else {}
+        for conversation_id in conversation_ids:
+            stream = f"{self.CHAT_PREFIX}{conversation_id}"
+            if conversation_id not in conversations:
+                await self.send(json.dumps({'error': "Conversation does not exist", 'stream': stream}))
+                continue
+            room = ChatRoom(self, conversations[conversation_id], self.profile, self.get_sender(stream))
+            self.rooms[conversation_id] = room
+            await self.send(json.dumps({'subscribed': stream}))
+            await room.join(parse_sequence(offsets.get(stream)))
+
+    async def unsubscribe(self, streams):
+        if self.NOTIFICATIONS in streams and self.notifications:
+            await self.notifications.leave()
+            self.notifications = None
+            await self.send(json.dumps({'unsubscribed': self.NOTIFICATIONS}))
+
+        rooms = []
+        for stream in streams:
+            room = self.rooms.pop(self.get_conversation_id(stream), None)
+            if room is None:
+                continue
+            if room is self.upload_room:
+                self.upload_room = None
+            rooms.append(room)
+        await self.leave_rooms(rooms)
+        for room in rooms:
+            await self.send(json.dumps({'unsubscribed': f"{self.CHAT_PREFIX}{room.conversation.id}"}))
+
+    @database_sync_to_async
+    def get_conversations(self, conversation_ids):
+        conversations = Conversation.objects.filter(Q(initiator=self.profile) | Q(receiver=self.profile),
+                                                    id__in=conversation_ids).select_related('initiator', 'receiver')
+        return {conversation.id: conversation for conversation in conversations}
+
+    # Group events: chat ones name their conversation
+    async def chat_message(self, event):
+        if event.get('conversation_id') in self.rooms:
+            await self.rooms[event['conversation_id']].chat_message(event)
+
+    async def chat_presence(self, event):
+        if event.get('conversation_id') in self.rooms:
+            await self.rooms[event['conversation_id']].chat_presence(event)
+
+    async def chat_typing(self, event):
+        if event.get('conversation_id') in self.rooms:
+            await self.rooms[event['conversation_id']].chat_typing(event)
+
+    async def notification_created(self, event):
+        if self.notifications:
+            await self.notifications.notification_created(event)
+
+    async def get_notifications_handler(self, event):
+        if self.notifications:
+            await self.notifications.send_changes()
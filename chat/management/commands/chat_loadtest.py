@@ -0,0 +1,101 @@
+import asyncio
+import json
+import time
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from authorization.models import User, UserProfile
+from chat.consumers import ChatConsumer
+from chat.models import Conversation, Message
+from chat.services import get_message_buffer
+
+
+class Command(BaseCommand):
+    help = ("Drives concurrent chat sockets through the InMemoryChannelLayer on a throwaway test "
+            "database and reports delivered messages/sec and fan-out latency.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=100, help="Conversations, two sockets each.")
+        parser.add_argument('--messages', type=int, default=20, help="Messages sent by every socket.")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(CHANNEL_LAYERS={'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                'CONFIG': {'capacity': 100000},
+            }}):
+                rooms = self.create_rooms(options['rooms'])
+                report = asyncio.run(self.run(rooms, options['messages']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def create_rooms(self, count):
+        rooms = []
+        for number in range(count):
+            profiles = []
+            for side in ('a', 'b'):
+                user = User.objects.create_user(f"loadtest-{number}-{side}@example.com", "password")
+                profiles.append(UserProfile.objects.filter(user=user).first() or UserProfile.objects.create(
+                    user=user, first_name=f"{side}{number}", last_name="loadtest"))
+            conversation = Conversation.objects.create(initiator=profiles[0], receiver=profiles[1])
+            rooms.append((conversation, [profile.user for profile in profiles]))
+        return rooms
+
+    async def run(self, rooms, messages_per_socket):
+        sockets = []
+        for conversation, users in rooms:
+            for user in users:
+                communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{conversation.id}/")
+                communicator.scope['user'] = user
+                communicator.scope['url_route'] = {'kwargs': {'room_name': str(conversation.id)}}
+                connected, _ = await communicator.connect()
+                assert connected
+                await communicator.receive_json_from()  # {"accept": true}
+                sockets.append(communicator)
+
+        # Every message reaches both sockets of its room
+        expected = len(sockets) * messages_per_socket * 2
+        latencies = []
+
+        async def send(communicator):
+            for _ in range(messages_per_socket):
+                await communicator.send_json_to({'message': repr(time.perf_counter())})
+
+        async def receive(communicator):
+            received = 0
+            while received < messages_per_socket * 2:
+                event = await communicator.receive_json_from(timeout=30)
+                if 'message' not in event:
+                    # Presence and typing updates
+                    continue
+                received += 1
+                latencies.append(time.perf_counter() - float(event['message']))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(socket) for socket in sockets), *(receive(socket) for socket in sockets))
+        elapsed = time.perf_counter() - started
+
+        for communicator in sockets:
+            await communicator.disconnect()
+        await get_message_buffer().flush()
+        stored = await database_sync_to_async(Message.objects.count)()
+
+        latencies.sort()
+        return {
+            'sockets': len(sockets),
+            'messages sent': len(sockets) * messages_per_socket,
+            'messages delivered': len(latencies),
+            'messages stored': stored,
+            'delivered/sec': round(expected / elapsed),
+            'p50 fan-out ms': round(latencies[len(latencies) // 2] * 1000, 2),
+            'p99 fan-out ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        }
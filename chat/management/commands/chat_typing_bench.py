@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from authorization.models import User, UserProfile
+from chat.consumers import ChatConsumer
+from chat.models import Conversation
+from chat.services import TYPING_INTERVAL
+
+
+class Command(BaseCommand):
+    help = ("Opens N sockets in one chat room that all send typing updates at a fixed keystroke rate, "
+            "on a throwaway test database, and reports the typing events delivered per second "
+            "against the TYPING_INTERVAL bound.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--typers', type=int, default=10, help="Sockets typing in the room.")
+        parser.add_argument('--rate', type=float, default=20, help="Typing updates sent per socket per second.")
+        parser.add_argument('--seconds', type=float, default=6, help="How long everyone types.")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(CHANNEL_LAYERS={'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                'CONFIG': {'capacity': 100000},
+            }}, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+                conversation, users = self.create_room()
+                report = asyncio.run(self.run(conversation, users, options['typers'], options['rate'],
+                                              options['seconds']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def create_room(self):
+        profiles = []
+        for side in ('a', 'b'):
+            user = User.objects.create_user(f"typingbench-{side}@example.com", "password")
+            profiles.append(UserProfile.objects.filter(user=user).first() or UserProfile.objects.create(
+                user=user, first_name=side, last_name="typingbench"))
+        conversation = Conversation.objects.create(initiator=profiles[0], receiver=profiles[1])
+        return conversation, [profile.user for profile in profiles]
+
+    async def run(self, conversation, users, typers, rate, seconds):
+        sockets = []
+        for number in range(typers):
+            # Both participants, several tabs each
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{conversation.id}/")
+            communicator.scope['user'] = users[number % 2]
+            communicator.scope['url_route'] = {'kwargs': {'room_name': str(conversation.id)}}
+            connected, _ = await communicator.connect()
+            assert connected
+            sockets.append(communicator)
+        await asyncio.sleep(0.1)
+        for communicator in sockets:
+            while not await communicator.receive_nothing(timeout=0.05):
+                await communicator.receive_from()
+
+        typing_events = 0
+        stop = asyncio.Event()
+
+        async def type_(communicator):
+            while not stop.is_set():
+                await communicator.send_json_to({'typing': True})
+                await asyncio.sleep(1 / rate)
+
+        async def receive(communicator):
+            nonlocal typing_events
+            while not stop.is_set():
+                # A timed out receive_from would cancel the consumer, so wait with receive_nothing
+                if await communicator.receive_nothing(timeout=0.05):
+                    continue
+                event = json.loads(await communicator.receive_from())
+                if 'typing' in event:
+                    typing_events += 1
+
+        started = time.perf_counter()
+        tasks = [asyncio.ensure_future(coroutine) for communicator in sockets
+                 for coroutine in (type_(communicator), receive(communicator))]
+        await asyncio.sleep(seconds)
+        stop.set()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        for communicator in sockets:
+            await communicator.disconnect()
+
+        sent = round(typers * rate * seconds)
+        # Every socket forwards at most one update per TYPING_INTERVAL, delivered to the other sockets
+        bound = typers * (typers - 1) / TYPING_INTERVAL
+        return {
+            'typers': typers,
+            'typing updates sent': sent,
+            'typing updates sent/sec': round(sent / elapsed),
+            'typing events delivered': typing_events,
+            'typing events delivered/sec': round(typing_events / elapsed, 1),
+            'bound delivered/sec': round(bound, 1),
+        }
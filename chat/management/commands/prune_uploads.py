@@ -0,0 +1,34 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.services import UPLOAD_EXPIRY, prune_uploads
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Deletes chat attachment uploads left incomplete and orphaned staging files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=3600,
+                            help="Seconds between two prunes.")
+        parser.add_argument('--expiry', type=int, default=UPLOAD_EXPIRY,
+                            help="Seconds after which an incomplete upload is deleted.")
+        parser.add_argument('--once', action='store_true',
+                            help="Prune once and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                removed = prune_uploads(options['expiry'])
+                self.stdout.write(f"Removed {removed} stale upload files")
+            except Exception:
+                logger.exception("Upload pruning failed")
+                if options['once']:
+                    raise
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
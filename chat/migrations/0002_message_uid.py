@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:40
+
+import uuid
+
+from django.db import migrations, models
+
+
+def fill_message_uids(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    messages = list(Message.objects.only('id'))
+    for message in messages:
+        message.uid = uuid.uuid4()
+    Message.objects.bulk_update(messages, ['uid'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='uid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_message_uids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_uid'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_id', 'timestamp', 'id'], name='message_conversation_time_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_conversation_summaries(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    conversations = list(Conversation.objects.only('id', 'start_time'))
+    for conversation in conversations:
+        last_message = Message.objects.filter(conversation_id=conversation.id).order_by('-timestamp', '-id').first()
+        conversation.last_message = last_message
+        conversation.last_message_text = last_message.text if last_message else None
+        conversation.last_message_at = last_message.timestamp if last_message else conversation.start_time
+    # Read state was never tracked, so the existing history starts out read
+    Conversation.objects.bulk_update(conversations, ['last_message', 'last_message_text', 'last_message_at'],
+                                     batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_conversation_time_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='initiator_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_text',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='receiver_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_conversation_summaries, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['initiator', '-last_message_at'], name='conversation_initiator_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['receiver', '-last_message_at'], name='conversation_receiver_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:34
+
+from django.db import migrations, models
+
+
+def merge_duplicate_conversations(apps, schema_editor):
+    """
+    Fills the pair key and merges the conversations of the same pair into
+    the oldest one, moving their messages and adding up the unread counters.
+    """
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    pairs = {}
+    conversations = Conversation.objects.filter(initiator__isnull=False, receiver__isnull=False).order_by('id')
+    for conversation in conversations:
+        key = (min(conversation.initiator_id, conversation.receiver_id),
+               max(conversation.initiator_id, conversation.receiver_id))
+        pairs.setdefault(key, []).append(conversation)
+
+    keepers = []
+    for (low, high), (keeper, *duplicates) in pairs.items():
+        keeper.pair_low, keeper.pair_high = low, high
+        keepers.append(keeper)
+        if duplicates:
+            unread = {low: 0, high: 0}
+            for conversation in (keeper, *duplicates):
+                unread[conversation.initiator_id] += conversation.initiator_unread
+                unread[conversation.receiver_id] += conversation.receiver_unread
+            duplicate_ids = [conversation.id for conversation in duplicates]
+            Message.objects.filter(conversation_id__in=duplicate_ids).update(conversation_id=keeper.id)
+            Conversation.objects.filter(id__in=duplicate_ids).delete()
+
+            last_message = Message.objects.filter(conversation_id=keeper.id).order_by('-timestamp', '-id').first()
+            if last_message:
+                keeper.last_message = last_message
+                keeper.last_message_text = last_message.text
+                keeper.last_message_at = last_message.timestamp
+            if keeper.initiator_id == keeper.receiver_id:
+                keeper.initiator_unread, keeper.receiver_unread = unread[keeper.initiator_id], 0
+            else:
+                keeper.initiator_unread = unread[keeper.initiator_id]
+                keeper.receiver_unread = unread[keeper.receiver_id]
+
+    Conversation.objects.bulk_update(keepers, ['pair_low', 'pair_high', 'last_message', 'last_message_text',
+                                               'last_message_at', 'initiator_unread', 'receiver_unread'],
+                                     batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='pair_high',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='pair_low',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_conversations, migrations.RunPython.noop),
+    ]
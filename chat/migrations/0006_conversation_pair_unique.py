@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_conversation_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('pair_low', 'pair_high'), name='conversation_pair_unique'),
+        ),
+    ]
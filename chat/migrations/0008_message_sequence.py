@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:46
+
+from django.db import migrations, models
+
+
+def fill_message_sequences(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    messages = list(Message.objects.only('id', 'conversation_id').order_by('conversation_id', 'timestamp', 'id'))
+    sequences = {}
+    for message in messages:
+        message.sequence = sequences.get(message.conversation_id_id, 0) + 1
+        sequences[message.conversation_id_id] = message.sequence
+    Message.objects.bulk_update(messages, ['sequence'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_messageupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_message_sequences, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_id', 'sequence'], name='message_conversation_seq_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.5 on 2026-10-17 18:30
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+# chat.services.SEQUENCE_BLOCK at the time of this migration
+SEQUENCE_BLOCK = 1000
+
+
+def renumber_duplicates_and_reserve(apps, schema_editor):
+    """
+    Moves messages that share a sequence with an earlier one of their
+    conversation past its highest sequence, and reserves every
+    conversation's numbers up to the end of the block of its highest one.
+    """
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    duplicated = Message.objects.values('conversation_id', 'sequence').annotate(count=Count('id')) \
+        .filter(count__gt=1).values_list('conversation_id', flat=True).distinct()
+    for conversation_id in set(duplicated):
+        messages = list(Message.objects.filter(conversation_id=conversation_id).only('id', 'sequence')
+                        .order_by('sequence', 'id'))
+        last = messages[-1].sequence
+        seen, moved = set(), []
+        for message in messages:
+            if message.sequence in seen:
+                last += 1
+                message.sequence = last
+                moved.append(message)
+            seen.add(message.sequence)
+        Message.objects.bulk_update(moved, ['sequence'], batch_size=1000)
+
+    conversations = []
+    for conversation_id, sequence in Message.objects.values('conversation_id').annotate(sequence=Max('sequence')) \
+            .values_list('conversation_id', 'sequence'):
+        conversations.append(Conversation(pk=conversation_id,
+                                          sequence_reserved=-(-sequence // SEQUENCE_BLOCK) * SEQUENCE_BLOCK))
+    Conversation.objects.bulk_update(conversations, ['sequence_reserved'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_sequence'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_conversation_seq_idx',
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='initiator_ack',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='receiver_ack',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='sequence_reserved',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(renumber_duplicates_and_reserve, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation_id', 'sequence'), name='message_conversation_seq_unique'),
+        ),
+    ]
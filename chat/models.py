@@ -1,9 +1,16 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 
 from authorization.models import UserProfile
 
 # Create your models here.
 
+def get_pair_key(first_id, second_id):
+    return min(first_id, second_id), max(first_id, second_id)
+
+
 class Conversation(models.Model):
     initiator = models.ForeignKey(
         UserProfile, on_delete=models.SET_NULL, null=True, related_name="convo_starter"
@@ -12,10 +19,38 @@ class Conversation(models.Model):
         UserProfile, on_delete=models.SET_NULL, null=True, related_name="convo_participant"
     )
     start_time = models.DateTimeField(auto_now_add=True)
+    # Participant ids in ascending order: one row per pair, whoever started the conversation
+    pair_low = models.BigIntegerField(null=True, editable=False)
+    pair_high = models.BigIntegerField(null=True, editable=False)
+    # Inbox summary, kept up to date by chat.services.store_messages
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_text = models.CharField(max_length=200, null=True, blank=True)
+    last_message_at = models.DateTimeField(default=timezone.now)
+    initiator_unread = models.PositiveIntegerField(default=0)
+    receiver_unread = models.PositiveIntegerField(default=0)
+    # Message sequences are handed out from the cache; numbers up to this one may be in use
+    sequence_reserved = models.PositiveBigIntegerField(default=0, editable=False)
+    # Last sequence each participant acknowledged, where its sockets resume
+    initiator_ack = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    receiver_ack = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return "{}".format(self.id)
 
+    def save(self, *args, **kwargs):
+        if self.pair_low is None and self.initiator_id is not None and self.receiver_id is not None:
+            self.pair_low, self.pair_high = get_pair_key(self.initiator_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pair_low', 'pair_high'], name='conversation_pair_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['initiator', '-last_message_at'], name='conversation_initiator_idx'),
+            models.Index(fields=['receiver', '-last_message_at'], name='conversation_receiver_idx'),
+        ]
+
 class Message(models.Model):
     sender = models.ForeignKey(UserProfile, on_delete=models.SET_NULL,
                               null=True, related_name='message_sender')
@@ -23,6 +58,35 @@ class Message(models.Model):
     attachment = models.FileField(blank=True)
     conversation_id = models.ForeignKey(Conversation, on_delete=models.CASCADE,)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Assigned when the message is received, so a retried write-behind flush cannot store it twice
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    # Position in the conversation, assigned before fan-out; clients resume after the last one they have
+    sequence = models.PositiveBigIntegerField(default=0, editable=False)
 
     class Meta:
-        ordering = ('-timestamp',)
\ No newline at end of file
+        ordering = ('-timestamp',)
+        constraints = [
+            models.UniqueConstraint(fields=['conversation_id', 'sequence'], name='message_conversation_seq_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation_id', 'timestamp', 'id'], name='message_conversation_time_idx'),
+        ]
+
+class MessageUpload(models.Model):
+    """
+    A chunked attachment upload. Chunks are appended to a staging file
+    until `received` reaches `size`; the verified file is then stored as
+    the attachment of `message`.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_uploads')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='uploads')
+    file_name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received = models.PositiveBigIntegerField(default=0)
+    message = models.OneToOneField(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.size})"
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Conversation, Message
+from .models import Conversation, Message, MessageUpload
 from authorization.models import UserProfile
 
 class UserChatSerializer(serializers.ModelSerializer):
@@ -16,21 +16,28 @@ class MessageSerializer(serializers.ModelSerializer):
     sender = UserChatSerializer()
     class Meta:
         model = Message
-        fields = ['sender', 'text', 'attachment', 'timestamp', 'conversation_id']
+        fields = ['sender', 'text', 'attachment', 'timestamp', 'conversation_id', 'sequence']
 
 
 class ConversationListSerializer(serializers.ModelSerializer):
     initiator = UserChatSerializer()
     receiver = UserChatSerializer()
-    last_message = serializers.SerializerMethodField()
+    last_message = serializers.CharField(source='last_message_text', read_only=True)
+    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Conversation
-        fields = ['id', 'initiator', 'receiver', 'last_message']
+        fields = ['id', 'initiator', 'receiver', 'last_message', 'last_message_at', 'unread_count']
 
-    def get_last_message(self, instance):
-        message = instance.message_set.first()
-        return message.text if message else None
+    def get_unread_count(self, instance):
+        profile = self.context.get('profile')
+        if profile is None:
+            return None
+        if profile.id == instance.initiator_id:
+            return instance.initiator_unread
+        if profile.id == instance.receiver_id:
+            return instance.receiver_unread
+        return None
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -40,4 +47,19 @@ class ConversationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Conversation
-        fields = ['id', 'initiator', 'receiver', 'message_set']
\ No newline at end of file
+        fields = ['id', 'initiator', 'receiver', 'message_set']
+
+
+class ConversationDetailSerializer(serializers.ModelSerializer):
+    initiator = UserChatSerializer()
+    receiver = UserChatSerializer()
+
+    class Meta:
+        model = Conversation
+        fields = ['id', 'initiator', 'receiver']
+
+
+class MessageUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MessageUpload
+        fields = ['id', 'conversation', 'file_name', 'size', 'sha256', 'received', 'message']
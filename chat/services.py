@@ -0,0 +1,587 @@
+import asyncio
+import atexit
+import hashlib
+import logging
+import os
+import re
+import weakref
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db import InterfaceError, OperationalError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from rest_framework.exceptions import ValidationError
+
+from marketplace.utils import decode_cursor, encode_cursor, get_keyset_page
+from .models import Conversation, Message, MessageUpload, get_pair_key
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_FLUSH_SIZE = 100
+MESSAGE_FLUSH_INTERVAL = 0.5
+MESSAGE_MAX_PENDING = 5000
+
+MESSAGE_PAGE_SIZE = 50
+
+MESSAGE_REPLAY_LIMIT = 200
+SEQUENCE_BLOCK = 1000
+
+PRESENCE_TTL = 60
+PRESENCE_SLOTS = 16
+PRESENCE_REFRESH_INTERVAL = 20
+LAST_SEEN_TTL = 30 * 24 * 60 * 60
+TYPING_TTL = 6
+TYPING_INTERVAL = 3
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_MAX_SIZE = 100 * 1024 * 1024
+UPLOAD_EXPIRY = 24 * 60 * 60
+
+
+def get_or_create_conversation(profile, participant):
+    """
+    Returns the conversation between the two profiles and whether it was
+    created. The unique pair key makes a concurrent create fail, after
+    which get_or_create returns the conversation the other request stored.
+    """
+    pair_low, pair_high = get_pair_key(profile.id, participant.id)
+    return Conversation.objects.get_or_create(pair_low=pair_low, pair_high=pair_high,
+                                              defaults={'initiator': profile, 'receiver': participant})
+
+
+def get_sequence_key(conversation_id):
+    return f'chat:sequence:{conversation_id}'
+
+
+def reserve_sequences(conversation_id, sequence):
+    """Records on the conversation that numbers up to the end of `sequence`'s block are handed out."""
+    ceiling = -(-sequence // SEQUENCE_BLOCK) * SEQUENCE_BLOCK
+    Conversation.objects.filter(pk=conversation_id, sequence_reserved__lt=ceiling).update(sequence_reserved=ceiling)
+
+
+def get_restart_sequence(conversation_id):
+    """
+    Where the sequence counter of a conversation restarts when the cache
+    lost it: past the reserved numbers, which cover the messages still in
+    write-behind buffers, and a block further, in case the reservation of
+    the current block is still being written.
+    """
+    reserved = Conversation.objects.filter(pk=conversation_id).values_list('sequence_reserved', flat=True).first()
+    return (reserved or 0) + SEQUENCE_BLOCK
+
+
+def next_sequence(conversation_id):
+    """
+    Allocates the next sequence number of the conversation from a cache
+    counter. The database only sees one reservation per SEQUENCE_BLOCK
+    numbers, written before the first number of the block is used.
+    Numbers increase but skip after the counter is lost.
+    """
+    key = get_sequence_key(conversation_id)
+    try:
+        sequence = cache.incr(key)
+    except ValueError:
+        cache.add(key, get_restart_sequence(conversation_id), None)
+        sequence = cache.incr(key)
+    if sequence % SEQUENCE_BLOCK == 1:
+        reserve_sequences(conversation_id, sequence)
+    return sequence
+
+
+async def anext_sequence(conversation_id):
+    key = get_sequence_key(conversation_id)
+    try:
+        sequence = await cache.aincr(key)
+    except ValueError:
+        restart = await database_sync_to_async(get_restart_sequence)(conversation_id)
+        await cache.aadd(key, restart, None)
+        sequence = await cache.aincr(key)
+    if sequence % SEQUENCE_BLOCK == 1:
+        await database_sync_to_async(reserve_sequences)(conversation_id, sequence)
+    return sequence
+
+
+def get_messages_after(conversation_id, sequence, limit=MESSAGE_REPLAY_LIMIT):
+    """Returns up to `limit` messages after `sequence` and whether more follow."""
+    messages = list(Message.objects.filter(conversation_id=conversation_id, sequence__gt=sequence)
+                    .select_related('sender').order_by('sequence', 'id')[:limit + 1])
+    return messages[:limit], len(messages) > limit
+
+
+def get_ack_field(conversation, profile_id):
+    if profile_id == conversation.initiator_id:
+        return 'initiator_ack'
+    if profile_id == conversation.receiver_id:
+        return 'receiver_ack'
+    return None
+
+
+def set_ack(conversation, profile_id, sequence):
+    """
+    Moves the last sequence the profile confirmed, its default resume
+    point, forward; a late ack of an older sequence changes nothing.
+    """
+    field = get_ack_field(conversation, profile_id)
+    if field is None:
+        return
+    Conversation.objects.filter(Q(**{f'{field}__lt': sequence}) | Q(**{f'{field}__isnull': True}),
+                                pk=conversation.pk).update(**{field: sequence})
+    if getattr(conversation, field) is None or getattr(conversation, field) < sequence:
+        setattr(conversation, field, sequence)
+
+
+def get_ack(conversation, profile_id):
+    field = get_ack_field(conversation, profile_id)
+    return getattr(conversation, field) if field else None
+
+
+def store_messages(messages):
+    """
+    Stores the messages and updates the summaries of their conversations
+    in one transaction. Messages whose uid is already stored come from a
+    retried flush and are skipped, so they are not counted as unread twice.
+    Messages without a sequence number get the next ones.
+    Returns the newly stored messages.
+    """
+    with transaction.atomic():
+        stored = set(Message.objects.filter(uid__in=[message.uid for message in messages])
+                     .values_list('uid', flat=True))
+        messages = [message for message in messages if message.uid not in stored]
+        if not messages:
+            return []
+        for message in messages:
+            if not message.sequence:
+                message.sequence = next_sequence(message.conversation_id_id)
+        Message.objects.bulk_create(messages)
+        if any(message.pk is None for message in messages):
+            # Backends that cannot return ids from a bulk insert
+            ids = dict(Message.objects.filter(uid__in=[message.uid for message in messages])
+                       .values_list('uid', 'id'))
+            for message in messages:
+                message.pk = ids[message.uid]
+        update_conversation_summaries(messages)
+    return messages
+
+
+def update_conversation_summaries(messages):
+    """
+    Moves the last message of every conversation in `messages` forward and
+    adds them to the unread counter of the other participant, with one
+    UPDATE per conversation.
+    """
+    text_length = Conversation._meta.get_field('last_message_text').max_length
+    messages_by_conversation = {}
+    for message in messages:
+        messages_by_conversation.setdefault(message.conversation_id_id, []).append(message)
+
+    for conversation_id, conversation_messages in messages_by_conversation.items():
+        conversation = conversation_messages[0].conversation_id
+        last_message = max(conversation_messages, key=lambda message: (message.timestamp, message.pk))
+        # Only move forward: a concurrent write may already have stored a newer message
+        is_newer = Q(last_message_at__lt=last_message.timestamp) | Q(last_message__isnull=True) | Q(
+            last_message_at=last_message.timestamp, last_message_id__lt=last_message.pk)
+        summary = {'last_message': last_message.pk, 'last_message_text': last_message.text[:text_length],
+                   'last_message_at': last_message.timestamp}
+        Conversation.objects.filter(pk=conversation_id).update(
+            **{field: Case(When(is_newer, then=Value(value)), default=F(field),
+                           output_field=Conversation._meta.get_field(field))
+               for field, value in summary.items()},
+            initiator_unread=F('initiator_unread') + sum(
+                1 for message in conversation_messages if message.sender_id == conversation.receiver_id),
+            receiver_unread=F('receiver_unread') + sum(
+                1 for message in conversation_messages if message.sender_id == conversation.initiator_id),
+        )
+
+
+def mark_conversation_read(conversation, profile):
+    """Resets the unread counter of `profile` in the conversation."""
+    if profile.id == conversation.initiator_id:
+        field = 'initiator_unread'
+    elif profile.id == conversation.receiver_id:
+        field = 'receiver_unread'
+    else:
+        return
+    if getattr(conversation, field):
+        Conversation.objects.filter(pk=conversation.pk).update(**{field: 0})
+        setattr(conversation, field, 0)
+
+
+def store_messages_one_by_one(messages):
+    """
+    Stores the messages of a batch that failed as a whole one at a time,
+    so a single bad row (too long, or of a deleted conversation) does not
+    keep the others out: messages the database rejects are logged and
+    dropped. Returns the messages left unstored because the database is
+    unavailable.
+    """
+    for position, message in enumerate(messages):
+        try:
+            store_messages([message])
+        except (OperationalError, InterfaceError):
+            return messages[position:]
+        except Exception:
+            logger.exception("Dropping chat message %s of conversation %s", message.uid,
+                             message.conversation_id_id)
+    return []
+
+
+class MessageBufferFull(Exception):
+    pass
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for the chat messages of one event loop.
+    Messages are stored with one bulk_create when `flush_size` of them are
+    pending or `flush_interval` seconds after the first one. A batch the
+    database rejects is stored one message at a time and the failing
+    messages are dropped; while the database is unavailable the batch is
+    kept for the next attempt. The unique uid keeps retries from storing a
+    message twice.
+    At most `max_pending` messages are held: a sender that finds the
+    buffer full waits for a flush, and add() raises MessageBufferFull when
+    that flush could not make room. The sequence number of a message is
+    allocated only once it has room, so rejected messages leave no gaps.
+    """
+    def __init__(self, flush_size=MESSAGE_FLUSH_SIZE, flush_interval=MESSAGE_FLUSH_INTERVAL,
+                 max_pending=MESSAGE_MAX_PENDING):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        # Messages that have room but still wait for their sequence number
+        self.adding = 0
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.tasks = set()
+
+    async def add(self, message, allocate_sequence=None):
+        """
+        Queues the message; `allocate_sequence`, an async function of the
+        conversation id, numbers it once there is room.
+        """
+        if len(self.pending) + self.adding >= self.max_pending:
+            await self.flush()
+            if len(self.pending) + self.adding >= self.max_pending:
+                raise MessageBufferFull(f"{len(self.pending)} chat messages are waiting for the database")
+        if allocate_sequence is not None:
+            self.adding += 1
+            try:
+                message.sequence = await allocate_sequence(message.conversation_id_id)
+            finally:
+                self.adding -= 1
+        self.pending.append(message)
+        if len(self.pending) >= self.flush_size:
+            self.flush_soon()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush_soon)
+
+    def flush_soon(self):
+        task = asyncio.ensure_future(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        async with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                await database_sync_to_async(store_messages)(batch)
+                return
+            except (OperationalError, InterfaceError):
+                unstored = batch
+            except Exception:
+                logger.exception("Storing %s chat messages failed, storing them one by one", len(batch))
+                unstored = await database_sync_to_async(store_messages_one_by_one)(batch)
+            if unstored:
+                logger.error("Database unavailable, keeping %s chat messages for the next flush", len(unstored))
+                self.pending[:0] = unstored
+                self.timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush_soon)
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_message_buffer():
+    loop = asyncio.get_running_loop()
+    if loop not in _buffers:
+        _buffers[loop] = MessageBuffer()
+    return _buffers[loop]
+
+
+@atexit.register
+def flush_message_buffers():
+    # The event loop is gone at exit, so whatever is left is stored synchronously
+    for buffer in list(_buffers.values()):
+        if buffer.pending:
+            try:
+                store_messages(buffer.pending)
+            except Exception:
+                unstored = store_messages_one_by_one(buffer.pending)
+                if unstored:
+                    logger.error("Storing %s chat messages at exit failed", len(unstored))
+            buffer.pending = []
+
+
+def get_message_history(conversation, request):
+    """
+    Returns a page of the conversation's messages with its cursors.
+    `cursor` pages backwards from the newest message; `since` (a cursor of
+    the newest message a client has) returns what came after it, oldest first.
+    """
+    messages = Message.objects.filter(conversation_id=conversation).select_related('sender')
+    limit = request.query_params.get('limit', MESSAGE_PAGE_SIZE)
+    since = request.query_params.get('since')
+
+    if since:
+        try:
+            limit = max(int(limit), 1)
+        except (TypeError, ValueError):
+            limit = MESSAGE_PAGE_SIZE
+        timestamp, pk = decode_cursor(since)
+        page = list(messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+                    .order_by('timestamp', 'id')[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        latest_cursor = encode_cursor(page[-1], 'timestamp') if page else since
+        return page, {'has_more': has_more, 'latest_cursor': latest_cursor}
+
+    page, next_cursor = get_keyset_page(messages, request.query_params.get('cursor'), limit, 'timestamp')
+    pagination = {'next_cursor': next_cursor}
+    if not request.query_params.get('cursor'):
+        # The first page starts at the newest message: its cursor is where `since` picks up
+        pagination['latest_cursor'] = encode_cursor(page[0], 'timestamp') if page else None
+    return page, pagination
+
+
+def get_upload_path(upload):
+    return os.path.join(settings.CHAT_UPLOAD_DIR, f'{upload.id}.part')
+
+
+def start_upload(conversation, profile, file_name, size, sha256):
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid size")
+    if not 0 < size <= UPLOAD_MAX_SIZE:
+        raise ValidationError(f"Size must be between 1 and {UPLOAD_MAX_SIZE} bytes")
+    if not re.fullmatch(r'[0-9a-f]{64}', str(sha256).lower()):
+        raise ValidationError("sha256 must be a hex digest")
+    file_name = os.path.basename(str(file_name or ''))
+    if not file_name:
+        raise ValidationError("Invalid file name")
+
+    upload = MessageUpload.objects.create(owner=profile, conversation=conversation, file_name=file_name,
+                                          size=size, sha256=sha256.lower())
+    os.makedirs(settings.CHAT_UPLOAD_DIR, exist_ok=True)
+    open(get_upload_path(upload), 'wb').close()
+    return upload
+
+
+def write_upload_chunks(upload, offset, chunks):
+    """
+    Writes `chunks` (an iterable of bytes) to the staging file at `offset`,
+    which has to be the number of bytes received so far. The upload row is
+    locked for the write, so concurrent writers of the same upload take
+    turns and only the one at the stored offset writes. Nothing is held in
+    memory beyond one chunk. Returns the new offset.
+    """
+    with transaction.atomic():
+        locked = MessageUpload.objects.select_for_update().only('received', 'message_id', 'size').get(pk=upload.pk)
+        upload.received, upload.message_id = locked.received, locked.message_id
+        if upload.message_id:
+            raise ValidationError("Upload is already complete")
+        if offset != upload.received:
+            raise ValidationError(f"Expected offset {upload.received}")
+
+        received = offset
+        with open(get_upload_path(upload), 'r+b') as file:
+            # Bytes past `received` are left over from an interrupted write
+            file.seek(offset)
+            file.truncate()
+            for chunk in chunks:
+                received += len(chunk)
+                if received > upload.size:
+                    raise ValidationError("Upload is larger than its declared size")
+                file.write(chunk)
+
+        MessageUpload.objects.filter(pk=upload.pk).update(received=received)
+    upload.received = received
+    return received
+
+
+def get_file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete_upload(upload, text=''):
+    """
+    Verifies the staged file against its sha256 and stores it as the
+    attachment of a new message. Completing twice returns the same message.
+    A mismatching file is discarded and the upload starts over.
+    """
+    text = text or ''
+    if len(text) > Message._meta.get_field('text').max_length:
+        raise ValidationError("Message text is too long")
+
+    with transaction.atomic():
+        upload = MessageUpload.objects.select_for_update().select_related('owner', 'conversation').get(pk=upload.pk)
+        if upload.message_id:
+            return upload.message
+        if upload.received != upload.size:
+            raise ValidationError(f"Upload is incomplete: {upload.received} of {upload.size} bytes received")
+
+        path = get_upload_path(upload)
+        message = None
+        if get_file_sha256(path) != upload.sha256:
+            open(path, 'wb').close()
+            upload.received = 0
+            upload.save(update_fields=['received'])
+        else:
+            field = Message._meta.get_field('attachment')
+            with open(path, 'rb') as file:
+                name = field.storage.save(field.generate_filename(None, upload.file_name), File(file))
+
+            message = store_messages([Message(sender=upload.owner, text=text, conversation_id=upload.conversation,
+                                              attachment=name)])[0]
+            upload.message = message
+            upload.save(update_fields=['message'])
+
+    if message is None:
+        # Raised outside the transaction, so the reset is kept
+        raise ValidationError("Checksum mismatch, upload the file again")
+    os.remove(path)
+    return message
+
+
+def get_message_event(message):
+    """The room group event of a stored message, as ChatRoom sends it."""
+    event = {
+        'type': 'chat_message',
+        'message': message.text,
+        'user_slug': message.sender.slug if message.sender else None,
+        'sequence': message.sequence,
+        'conversation_id': message.conversation_id_id,
+    }
+    if message.attachment:
+        event['attachment'] = message.attachment.url
+    return event
+
+
+def prune_uploads(expiry=UPLOAD_EXPIRY):
+    """
+    Deletes the uploads left incomplete for `expiry` seconds with their
+    staging files, and staging files without an upload (left behind by a
+    crash between the two). Returns the number of files removed.
+    """
+    expired = timezone.now() - timedelta(seconds=expiry)
+    MessageUpload.objects.filter(message__isnull=True, created_at__lt=expired).delete()
+    if not os.path.isdir(settings.CHAT_UPLOAD_DIR):
+        return 0
+
+    removed = 0
+    with os.scandir(settings.CHAT_UPLOAD_DIR) as entries:
+        paths = {entry.name[:-len('.part')]: entry.path for entry in entries if entry.name.endswith('.part')}
+    # Read after the listing, so the file of an upload started meanwhile is not taken for an orphan
+    active = {str(upload_id) for upload_id in MessageUpload.objects.filter(message__isnull=True)
+              .values_list('id', flat=True)}
+    for upload_id, path in paths.items():
+        if upload_id in active:
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+# Presence and typing state is ephemeral: it lives in the cache with TTLs
+# and never touches the database.
+
+def get_presence_keys(profile_id):
+    return [f'chat:presence:{profile_id}:{slot}' for slot in range(PRESENCE_SLOTS)]
+
+
+def get_last_seen_key(profile_id):
+    return f'chat:last_seen:{profile_id}'
+
+
+def get_typing_key(conversation_id, profile_id):
+    return f'chat:typing:{conversation_id}:{profile_id}'
+
+
+# A profile is online while any of its presence slots holds a socket. Every
+# socket claims a slot under its channel name, with PRESENCE_TTL of its own,
+# so a socket counts once however many rooms it joins, and the sockets of a
+# crashed worker drop out when their slots expire.
+
+async def connect_presence(profile_id, channel_name):
+    """
+    Registers the socket `channel_name` of the profile and returns the
+    number of its sockets, this one included. Sockets past PRESENCE_SLOTS
+    keep no slot of their own; the others keep the profile online.
+    """
+    keys = get_presence_keys(profile_id)
+    slots = await cache.aget_many(keys)
+    for key, value in slots.items():
+        if value == channel_name:
+            await cache.atouch(key, PRESENCE_TTL)
+            return len(slots)
+    for key in keys:
+        # add() fails for a slot another socket claimed meanwhile
+        if key not in slots and await cache.aadd(key, channel_name, PRESENCE_TTL):
+            return len(slots) + 1
+    return len(slots)
+
+
+async def refresh_presence(profile_id, channel_name):
+    await connect_presence(profile_id, channel_name)
+
+
+async def disconnect_presence(profile_id, channel_name):
+    """
+    Drops the socket `channel_name` of the profile. Returns True when no
+    socket of the profile is left, after recording when it was last seen.
+    """
+    slots = await cache.aget_many(get_presence_keys(profile_id))
+    own = [key for key, value in slots.items() if value == channel_name]
+    await cache.adelete_many(own)
+    if len(slots) > len(own):
+        return False
+    await cache.aset(get_last_seen_key(profile_id), timezone.now().isoformat(), LAST_SEEN_TTL)
+    return True
+
+
+async def get_presence(profile_id):
+    keys = get_presence_keys(profile_id)
+    values = await cache.aget_many([*keys, get_last_seen_key(profile_id)])
+    return {
+        'online': any(key in values for key in keys),
+        'last_seen': values.get(get_last_seen_key(profile_id)),
+    }
+
+
+async def set_typing(conversation_id, profile_id, typing):
+    key = get_typing_key(conversation_id, profile_id)
+    if typing:
+        await cache.aset(key, True, TYPING_TTL)
+    else:
+        await cache.adelete(key)
+
+
+async def is_typing(conversation_id, profile_id):
+    return bool(await cache.aget(get_typing_key(conversation_id, profile_id)))
@@ -1,3 +1,612 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import timedelta
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authorization.factories import create_profile
+from notif.services import create_notification
+from .consumers import ChatConsumer, UserConsumer
+from .models import Conversation, Message, MessageUpload, get_pair_key
+from .services import MessageBuffer, MessageBufferFull, connect_presence, get_message_buffer, get_messages_after, \
+    get_or_create_conversation, get_presence, get_presence_keys, is_typing, next_sequence, prune_uploads, set_ack, \
+    store_messages, SEQUENCE_BLOCK
+
+
+class ChatTestCase(TestCase):
+    def setUp(self):
+        # Sequence counters and presence live in the cache, and ids are reused between tests
+        cache.clear()
+        self.initiator = create_profile("initiator")
+        self.receiver = create_profile("receiver")
+        self.conversation = Conversation.objects.create(initiator=self.initiator, receiver=self.receiver)
+
+    async def connect(self, profile, conversation=None, query=''):
+        conversation = conversation or self.conversation
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{conversation.id}/?{query}")
+        communicator.scope['user'] = profile.user
+        communicator.scope['url_route'] = {'kwargs': {'room_name': str(conversation.id)}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_json_from(), {'accept': True})
+        return communicator
+
+    async def receive_until(self, communicator, key):
+        # Skips presence and typing frames
+        while True:
+            message = await communicator.receive_json_from()
+            if key in message:
+                return message
+
+    def create_message(self, text="Hello", **fields):
+        return Message(sender=self.initiator, text=text, conversation_id=self.conversation, **fields)
+
+
+class ChatMessageTests(ChatTestCase):
+    async def test_messages_are_delivered_and_stored(self):
+        sender = await self.connect(self.initiator)
+        receiver = await self.connect(self.receiver)
+        await sender.send_json_to({'message': "Hello"})
+        message = await self.receive_until(receiver, 'message')
+        self.assertEqual((message['message'], message['sender']), ("Hello", self.initiator.slug))
+
+        await get_message_buffer().flush()
+        stored = await database_sync_to_async(Message.objects.get)()
+        self.assertEqual((stored.text, stored.sequence), ("Hello", message['sequence']))
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    async def test_invalid_messages_are_rejected(self):
+        sender = await self.connect(self.initiator)
+        for data in ({'message': "x" * 201}, {'message': 5}, {'text': "no message key"}):
+            await sender.send_json_to(data)
+            self.assertIn('error', await self.receive_until(sender, 'error'))
+        await get_message_buffer().flush()
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+        await sender.disconnect()
+
+    async def test_full_buffer_rejects_the_message(self):
+        sender = await self.connect(self.initiator)
+        await sender.send_json_to({'message': "First"})
+        first = await self.receive_until(sender, 'sequence')
+        with mock.patch('chat.consumers.get_message_buffer', return_value=MessageBuffer(max_pending=0)):
+            await sender.send_json_to({'message': "Hello"})
+            error = await self.receive_until(sender, 'error')
+        self.assertEqual(error['message'], "Hello")
+        # Nothing went to the room
+        self.assertTrue(await sender.receive_nothing())
+        # and the rejected message used no sequence number
+        await sender.send_json_to({'message': "Hello again"})
+        self.assertEqual((await self.receive_until(sender, 'sequence'))['sequence'], first['sequence'] + 1)
+        await get_message_buffer().flush()
+        await sender.disconnect()
+
+
+class MessageBufferTests(ChatTestCase):
+    def test_batch_is_stored_with_one_insert(self):
+        async def store():
+            buffer = MessageBuffer(flush_size=1000)
+            for number in range(20):
+                await buffer.add(self.create_message(str(number)))
+            await buffer.flush()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(store)()
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "chat_message"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(Message.objects.count(), 20)
+
+    async def test_bad_row_is_dropped_and_the_rest_stored(self):
+        buffer = MessageBuffer(flush_size=1000)
+        await buffer.add(self.create_message("first"))
+        # NOT NULL violation: the database rejects the row and with it the whole bulk insert
+        await buffer.add(self.create_message(None))
+        await buffer.add(self.create_message("third"))
+        with self.assertLogs('chat.services', 'ERROR'):
+            await buffer.flush()
+        self.assertEqual(buffer.pending, [])
+        texts = await database_sync_to_async(lambda: sorted(Message.objects.values_list('text', flat=True)))()
+        self.assertEqual(texts, ["first", "third"])
+
+    async def test_unavailable_database_keeps_the_batch(self):
+        buffer = MessageBuffer(flush_size=1000)
+        messages = [self.create_message(str(number)) for number in range(3)]
+        for message in messages:
+            await buffer.add(message)
+        with mock.patch('chat.services.store_messages', side_effect=OperationalError), \
+                self.assertLogs('chat.services', 'ERROR'):
+            await buffer.flush()
+        self.assertEqual(buffer.pending, messages)
+        await buffer.flush()
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 3)
+
+    async def test_full_buffer_applies_backpressure(self):
+        buffer = MessageBuffer(flush_size=1000, max_pending=2)
+        await buffer.add(self.create_message("1"))
+        await buffer.add(self.create_message("2"))
+        with mock.patch('chat.services.store_messages', side_effect=OperationalError), \
+                self.assertLogs('chat.services', 'ERROR'):
+            with self.assertRaises(MessageBufferFull):
+                await buffer.add(self.create_message("3"))
+        self.assertEqual(len(buffer.pending), 2)
+        # Once the database is back, the flush makes room
+        await buffer.add(self.create_message("3"))
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+        self.assertEqual(len(buffer.pending), 1)
+        buffer.timer.cancel()
+
+    async def test_sequence_is_allocated_once_there_is_room(self):
+        buffer = MessageBuffer(flush_size=1000, max_pending=1)
+        allocate_sequence = mock.AsyncMock(side_effect=[1, 2])
+        await buffer.add(self.create_message("1"), allocate_sequence)
+        with mock.patch('chat.services.store_messages', side_effect=OperationalError), \
+                self.assertLogs('chat.services', 'ERROR'):
+            with self.assertRaises(MessageBufferFull):
+                await buffer.add(self.create_message("2"), allocate_sequence)
+        allocate_sequence.assert_awaited_once_with(self.conversation.id)
+        self.assertEqual(buffer.pending[0].sequence, 1)
+        buffer.timer.cancel()
+
+
+class MessageHistoryTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.initiator.user)
+        self.url = f'/messages/{self.conversation.id}/'
+
+    def store(self, count, start=0):
+        senders = (self.initiator, self.receiver)
+        return store_messages([Message(sender=senders[number % 2], text=str(number), conversation_id=self.conversation)
+                               for number in range(start, start + count)])
+
+    def get_pages(self, limit):
+        texts, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get(self.url, {'cursor': cursor, 'limit': limit})
+            texts.extend(message['text'] for message in response.data['message_set'])
+            cursor = response.data['next_cursor']
+        return texts
+
+    def test_pages_go_back_from_the_newest_message(self):
+        messages = self.store(7)
+        # Equal timestamps are ordered by id
+        Message.objects.filter(pk__in=[message.pk for message in messages[2:5]]).update(
+            timestamp=messages[2].timestamp)
+        expected = list(Message.objects.order_by('-timestamp', '-id').values_list('text', flat=True))
+        self.assertEqual(self.get_pages(limit=2), expected)
+        self.assertEqual(self.get_pages(limit=3), expected)
+
+    def test_queries_do_not_grow_with_page_size(self):
+        self.store(2)
+        with CaptureQueriesContext(connection) as small_page:
+            self.client.get(self.url, {'limit': 50})
+        self.store(30, start=2)
+        with CaptureQueriesContext(connection) as full_page:
+            response = self.client.get(self.url, {'limit': 50})
+        self.assertEqual(len(response.data['message_set']), 32)
+        # The read counter of the first page is reset both times
+        self.assertEqual(len(full_page), len(small_page))
+
+    def test_since_returns_the_newer_messages_oldest_first(self):
+        self.store(3)
+        response = self.client.get(self.url, {'limit': 2})
+        latest_cursor = response.data['latest_cursor']
+        self.store(3, start=3)
+
+        response = self.client.get(self.url, {'since': latest_cursor, 'limit': 2})
+        self.assertEqual([message['text'] for message in response.data['message_set']], ["3", "4"])
+        self.assertTrue(response.data['has_more'])
+        response = self.client.get(self.url, {'since': response.data['latest_cursor'], 'limit': 2})
+        self.assertEqual([message['text'] for message in response.data['message_set']], ["5"])
+        self.assertFalse(response.data['has_more'])
+
+
+class ConversationSummaryTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.initiator.user)
+
+    def test_summary_follows_the_stored_messages(self):
+        store_messages([self.create_message("first"), Message(sender=self.receiver, text="second",
+                                                              conversation_id=self.conversation)])
+        self.conversation.refresh_from_db()
+        last_message = Message.objects.order_by('-timestamp', '-id').first()
+        self.assertEqual((self.conversation.last_message, self.conversation.last_message_text),
+                         (last_message, "second"))
+        self.assertEqual((self.conversation.initiator_unread, self.conversation.receiver_unread), (1, 1))
+
+    def test_retried_messages_are_counted_once(self):
+        messages = [self.create_message(str(number)) for number in range(3)]
+        store_messages(messages[:2])
+        store_messages(messages)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.receiver_unread, 3)
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_long_text_preview_is_truncated(self):
+        store_messages([self.create_message("x" * 250)])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_text, "x" * 200)
+
+    def test_opening_the_conversation_marks_it_read(self):
+        store_messages([Message(sender=self.receiver, text="Hello", conversation_id=self.conversation)])
+        self.client.get(f'/messages/{self.conversation.id}/')
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.initiator_unread, 0)
+
+    def test_inbox_is_sorted_by_last_activity_in_constant_queries(self):
+        others = [create_profile(f"other{number}") for number in range(3)]
+        conversations = [Conversation.objects.create(initiator=self.initiator, receiver=other) for other in others]
+        with CaptureQueriesContext(connection) as small_inbox:
+            self.client.get('/conversations/')
+        for conversation in (conversations[1], self.conversation, conversations[0]):
+            store_messages([Message(sender=self.initiator, text="Hi", conversation_id=conversation)])
+
+        with CaptureQueriesContext(connection) as full_inbox:
+            response = self.client.get('/conversations/', {'limit': 2, 'page': 1})
+        self.assertEqual([row['id'] for row in response.data['data']], [conversations[0].id, self.conversation.id])
+        self.assertEqual(response.data['data'][0]['last_message'], "Hi")
+        self.assertEqual(len(full_inbox), len(small_inbox))
+
+
+class ConversationPairTests(ChatTestCase):
+    def test_either_participant_finds_the_conversation(self):
+        with self.assertNumQueries(1):
+            conversation, created = get_or_create_conversation(self.receiver, self.initiator)
+        self.assertEqual((conversation, created), (self.conversation, False))
+
+    def test_new_pair_is_created_once(self):
+        other = create_profile("other")
+        conversation, created = get_or_create_conversation(other, self.initiator)
+        self.assertTrue(created)
+        self.assertEqual((conversation.initiator, conversation.receiver), (other, self.initiator))
+        self.assertEqual(get_or_create_conversation(self.initiator, other), (conversation, False))
+
+    def test_duplicate_pair_is_rejected(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Conversation.objects.create(initiator=self.receiver, receiver=self.initiator)
+
+    def test_migration_merges_duplicate_conversations(self):
+        merge_duplicate_conversations = import_module(
+            'chat.migrations.0005_conversation_pair_key').merge_duplicate_conversations
+        Conversation.objects.all().delete()
+        # Rows from before the pair key: bulk_create skips save(), which fills it in
+        older, newer = Conversation.objects.bulk_create([
+            Conversation(initiator=self.initiator, receiver=self.receiver, initiator_unread=1),
+            Conversation(initiator=self.receiver, receiver=self.initiator, initiator_unread=2, receiver_unread=3),
+        ])
+        # Numbered as one conversation would have been
+        store_messages([Message(sender=self.initiator, text="old", conversation_id=older, sequence=1),
+                        Message(sender=self.receiver, text="new", conversation_id=newer, sequence=2)])
+        Conversation.objects.update(pair_low=None, pair_high=None)
+
+        merge_duplicate_conversations(apps, None)
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.pk, older.pk)
+        self.assertEqual((conversation.pair_low, conversation.pair_high),
+                         get_pair_key(self.initiator.id, self.receiver.id))
+        self.assertEqual(set(conversation.message_set.values_list('text', flat=True)), {"old", "new"})
+        self.assertEqual(conversation.last_message_text, "new")
+        # Unread counters follow the participant, whichever side of the duplicate they were on
+        self.assertEqual((conversation.initiator_unread, conversation.receiver_unread), (1 + 3 + 1, 2 + 1))
+
+
+class UploadTests(ChatTestCase):
+    data = b"0123456789" * 1000
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(CHAT_UPLOAD_DIR=os.path.join(directory, 'uploads'),
+                                              MEDIA_ROOT=os.path.join(directory, 'media'),
+                                              DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.initiator.user)
+
+    def start(self, data=None):
+        data = self.data if data is None else data
+        response = self.client.post('/uploads/', {'conversation_id': self.conversation.id, 'file_name': "file.txt",
+                                                  'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def put(self, upload_id, chunk, offset):
+        return self.client.put(f'/uploads/{upload_id}/', chunk, content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE=f'bytes {offset}-{offset + len(chunk) - 1}/*')
+
+    def test_http_upload_is_resumed_and_attached(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, self.data[:4000], 0).data['received'], 4000)
+        # A retried chunk at an old offset is rejected, the client resumes from `received`
+        self.assertEqual(self.put(upload_id, self.data[:4000], 0).status_code, 400)
+        self.assertEqual(self.client.get(f'/uploads/{upload_id}/').data['received'], 4000)
+        self.put(upload_id, self.data[4000:], 4000)
+
+        response = self.client.post(f'/uploads/{upload_id}/complete/', {'text': "File"})
+        self.assertEqual(response.status_code, 200)
+        message = Message.objects.get()
+        self.assertEqual(message.text, "File")
+        with message.attachment.open('rb') as file:
+            self.assertEqual(file.read(), self.data)
+        self.assertFalse(os.listdir(settings.CHAT_UPLOAD_DIR))
+        # Completing again returns the same message
+        self.client.post(f'/uploads/{upload_id}/complete/')
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_checksum_mismatch_restarts_the_upload(self):
+        upload_id = self.start()
+        self.put(upload_id, b"x" * len(self.data), 0)
+        response = self.client.post(f'/uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(MessageUpload.objects.get().received, 0)
+        self.assertFalse(Message.objects.exists())
+
+    def test_upload_larger_than_declared_is_rejected(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, self.data + b"x", 0).status_code, 400)
+        self.assertEqual(MessageUpload.objects.get().received, 0)
+
+    async def test_http_completion_is_sent_to_the_room(self):
+        receiver = await self.connect(self.receiver)
+        upload_id = await database_sync_to_async(self.start)()
+        await database_sync_to_async(self.put)(upload_id, self.data, 0)
+        await database_sync_to_async(self.client.post)(f'/uploads/{upload_id}/complete/', {'text': "File"})
+        message = await self.receive_until(receiver, 'message')
+        self.assertEqual((message['message'], message['sender']), ("File", self.initiator.slug))
+        self.assertIn('attachment', message)
+        await receiver.disconnect()
+
+    async def test_websocket_upload(self):
+        sender = await self.connect(self.initiator)
+        receiver = await self.connect(self.receiver)
+        await sender.send_json_to({'upload': 'start', 'file_name': "file.txt", 'size': len(self.data),
+                                   'sha256': hashlib.sha256(self.data).hexdigest()})
+        ready = await self.receive_until(sender, 'upload')
+        self.assertEqual((ready['upload'], ready['offset']), ('ready', 0))
+        for start in range(0, len(self.data), 4000):
+            await sender.send_to(bytes_data=self.data[start:start + 4000])
+            ack = await self.receive_until(sender, 'upload')
+            self.assertEqual(ack['offset'], min(start + 4000, len(self.data)))
+
+        await sender.send_json_to({'upload': 'complete', 'message': "File"})
+        message = await self.receive_until(receiver, 'message')
+        self.assertEqual(message['message'], "File")
+        self.assertIn('attachment', message)
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    def test_prune_removes_stale_uploads_and_orphan_files(self):
+        stale, active = self.start(), self.start()
+        MessageUpload.objects.filter(id=stale).update(created_at=timezone.now() - timedelta(days=2))
+        orphan = os.path.join(settings.CHAT_UPLOAD_DIR, f'{uuid.uuid4()}.part')
+        open(orphan, 'wb').close()
+
+        self.assertEqual(prune_uploads(), 2)
+        self.assertEqual(list(MessageUpload.objects.values_list('id', flat=True)), [uuid.UUID(active)])
+        self.assertEqual(os.listdir(settings.CHAT_UPLOAD_DIR), [f'{active}.part'])
+
+
+class PresenceTests(ChatTestCase):
+    async def get_presence_frame(self, communicator):
+        return (await self.receive_until(communicator, 'presence'))['presence']
+
+    async def test_profile_is_online_until_its_last_socket_leaves(self):
+        receiver = await self.connect(self.receiver)
+        # The participant's presence on join
+        self.assertFalse((await self.get_presence_frame(receiver))['online'])
+        first = await self.connect(self.initiator)
+        self.assertTrue((await self.get_presence_frame(receiver))['online'])
+        second = await self.connect(self.initiator)
+        # The socket joins after its accept frame; the participant's presence follows its presence slot
+        await self.get_presence_frame(second)
+
+        await first.disconnect()
+        self.assertTrue((await get_presence(self.initiator.id))['online'])
+        self.assertTrue(await receiver.receive_nothing())
+        await second.disconnect()
+        presence = await self.get_presence_frame(receiver)
+        self.assertFalse(presence['online'])
+        self.assertIsNotNone(presence['last_seen'])
+        await receiver.disconnect()
+
+    async def test_socket_counts_once_however_many_rooms_it_joins(self):
+        other = await database_sync_to_async(
+            lambda: Conversation.objects.create(initiator=self.initiator, receiver=create_profile("other")))()
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), '/ws/stream/')
+        communicator.scope['user'] = self.initiator.user
+        await communicator.connect()
+        await communicator.send_json_to({'subscribe': [f'chat:{self.conversation.id}', f'chat:{other.id}']})
+        await self.receive_until(communicator, 'presence')
+        await self.receive_until(communicator, 'presence')
+        self.assertEqual(len(await cache.aget_many(get_presence_keys(self.initiator.id))), 1)
+
+        await communicator.send_json_to({'unsubscribe': f'chat:{other.id}'})
+        await self.receive_until(communicator, 'unsubscribed')
+        self.assertTrue((await get_presence(self.initiator.id))['online'])
+        await communicator.send_json_to({'unsubscribe': f'chat:{self.conversation.id}'})
+        await self.receive_until(communicator, 'unsubscribed')
+        self.assertFalse((await get_presence(self.initiator.id))['online'])
+        await communicator.disconnect()
+
+    async def test_sockets_of_a_crashed_worker_expire(self):
+        with mock.patch('chat.services.PRESENCE_TTL', 1):
+            self.assertEqual(await connect_presence(self.initiator.id, 'crashed'), 1)
+            self.assertEqual(await connect_presence(self.initiator.id, 'alive'), 2)
+            # Reconnecting a registered socket does not count it again
+            self.assertEqual(await connect_presence(self.initiator.id, 'alive'), 2)
+            await asyncio.sleep(1.1)
+        self.assertFalse((await get_presence(self.initiator.id))['online'])
+        self.assertEqual(await connect_presence(self.initiator.id, 'alive'), 1)
+
+    async def test_typing_is_forwarded_at_a_bounded_rate(self):
+        sender = await self.connect(self.initiator)
+        receiver = await self.connect(self.receiver)
+        for _ in range(5):
+            await sender.send_json_to({'typing': True})
+        typing = await self.receive_until(receiver, 'typing')
+        self.assertTrue(typing['typing']['typing'])
+        self.assertTrue(await receiver.receive_nothing())
+        self.assertTrue(await is_typing(self.conversation.id, self.initiator.id))
+        await sender.disconnect()
+        await receiver.disconnect()
+
+
+class UserConsumerTests(ChatTestCase):
+    async def connect_stream(self, profile=None):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), '/ws/stream/')
+        communicator.scope['user'] = (profile or self.initiator).user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_json_from(), {'accept': True})
+        return communicator
+
+    async def test_one_socket_carries_chat_and_notifications(self):
+        await database_sync_to_async(create_notification)(self.initiator, "Title", "Description")
+        communicator = await self.connect_stream()
+        stream = f'chat:{self.conversation.id}'
+        await communicator.send_json_to({'subscribe': ['notifications', stream], 'last_sequence': 0})
+        notifications = await self.receive_until(communicator, 'notifications')
+        self.assertEqual((notifications['stream'], len(notifications['notifications'])), ('notifications', 1))
+
+        receiver = await self.connect(self.receiver)
+        await receiver.send_json_to({'message': "Hello"})
+        message = await self.receive_until(communicator, 'message')
+        self.assertEqual((message['stream'], message['message']), (stream, "Hello"))
+        await self.receive_until(receiver, 'message')
+
+        await communicator.send_json_to({'stream': stream, 'message': "Hi"})
+        self.assertEqual((await self.receive_until(receiver, 'message'))['message'], "Hi")
+        await communicator.disconnect()
+        await receiver.disconnect()
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+
+    def test_subscribing_loads_the_conversations_in_one_query(self):
+        streams = [f'chat:{self.conversation.id}']
+        for number in range(3):
+            conversation = Conversation.objects.create(initiator=self.initiator, receiver=create_profile(str(number)))
+            streams.append(f'chat:{conversation.id}')
+
+        async def subscribe():
+            communicator = await self.connect_stream()
+            await communicator.send_json_to({'subscribe': streams})
+            for _ in streams:
+                await self.receive_until(communicator, 'presence')
+            await communicator.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(subscribe)()
+        self.assertEqual(sum(1 for query in queries if 'FROM "chat_conversation"' in query['sql']), 1)
+
+    async def test_foreign_and_unsubscribed_streams_are_refused(self):
+        others = await database_sync_to_async(lambda: Conversation.objects.create(
+            initiator=create_profile("first"), receiver=create_profile("second")))()
+        communicator = await self.connect_stream()
+        await communicator.send_json_to({'subscribe': f'chat:{others.id}'})
+        self.assertEqual(await self.receive_until(communicator, 'error'),
+                         {'error': "Conversation does not exist", 'stream': f'chat:{others.id}'})
+        await communicator.send_json_to({'stream': f'chat:{others.id}', 'message': "Hello"})
+        self.assertEqual((await self.receive_until(communicator, 'error'))['error'], "Not subscribed")
+        await communicator.disconnect()
+
+    async def test_anonymous_socket_is_closed(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), '/ws/stream/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class SequenceTests(ChatTestCase):
+    def test_sequences_survive_a_lost_counter_with_buffered_messages(self):
+        # Numbered and fanned out, still waiting in a buffer
+        allocated = [next_sequence(self.conversation.id) for _ in range(3)]
+        self.assertEqual(allocated, sorted(set(allocated)))
+        cache.clear()
+        self.assertGreater(next_sequence(self.conversation.id), allocated[-1])
+
+    def test_reservation_costs_one_update_per_block(self):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(5):
+                next_sequence(self.conversation.id)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in queries), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.sequence_reserved % SEQUENCE_BLOCK, 0)
+        self.assertGreaterEqual(self.conversation.sequence_reserved, 5)
+
+    def test_sequence_is_unique_in_a_conversation(self):
+        store_messages([self.create_message(sequence=7)])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Message.objects.create(sender=self.initiator, text="Hello", conversation_id=self.conversation, sequence=7)
+
+    def test_ack_only_moves_forward(self):
+        set_ack(self.conversation, self.receiver.id, 5)
+        set_ack(self.conversation, self.receiver.id, 3)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.receiver_ack, self.conversation.initiator_ack), (5, None))
+
+
+class ResumeTests(ChatTestCase):
+    async def send_messages(self, count):
+        sender = await self.connect(self.initiator)
+        for number in range(count):
+            await sender.send_json_to({'message': str(number)})
+            await self.receive_until(sender, 'message')
+        await sender.disconnect()
+
+    async def test_offset_replays_only_the_missing_messages(self):
+        await self.send_messages(4)
+        stored = await database_sync_to_async(lambda: list(Message.objects.order_by('sequence')))()
+        receiver = await self.connect(self.receiver, query=f'offset={stored[1].sequence}')
+        replay = await self.receive_until(receiver, 'replay')
+        self.assertEqual([message['message'] for message in replay['replay']], ["2", "3"])
+        self.assertFalse(replay['has_more'])
+        await receiver.disconnect()
+
+    async def test_join_resumes_from_the_stored_ack(self):
+        await self.send_messages(3)
+        receiver = await self.connect(self.receiver, query='offset=0')
+        replay = await self.receive_until(receiver, 'replay')
+        await receiver.send_json_to({'ack': replay['replay'][0]['sequence']})
+        await receiver.disconnect()
+
+        # The ack outlives the cache
+        cache.clear()
+        conversation = await database_sync_to_async(Conversation.objects.get)()
+        self.assertEqual(conversation.receiver_ack, replay['replay'][0]['sequence'])
+        receiver = await self.connect(self.receiver)
+        replay = await self.receive_until(receiver, 'replay')
+        self.assertEqual([message['message'] for message in replay['replay']], ["1", "2"])
+        await receiver.disconnect()
+
+    async def test_replay_is_paged(self):
+        await self.send_messages(3)
+        with mock.patch.object(get_messages_after, '__defaults__', (2,)):
+            receiver = await self.connect(self.receiver, query='offset=0')
+            replay = await self.receive_until(receiver, 'replay')
+        self.assertEqual(len(replay['replay']), 2)
+        self.assertTrue(replay['has_more'])
+        await receiver.send_json_to({'resume': replay['replay'][-1]['sequence']})
+        replay = await self.receive_until(receiver, 'replay')
+        self.assertEqual([message['message'] for message in replay['replay']], ["2"])
+        await receiver.disconnect()
@@ -5,5 +5,8 @@ urlpatterns = [
     path('conversation/start/', views.ConversationStartAPIView.as_view(), name='start-conversation'),
     path('messages/<int:convo_id>/', views.MessageAPIView.as_view(), name='getconversation'),
     path('send/message/<slug:user_slug>/', views.SendMessageAPIView.as_view(), name='sendmessage'),
-    path('conversations/', views.ConversationListAPIView.as_view(), name='conversations')
+    path('conversations/', views.ConversationListAPIView.as_view(), name='conversations'),
+    path('uploads/', views.UploadStartAPIView.as_view(), name='start-upload'),
+    path('uploads/<uuid:upload_id>/', views.UploadAPIView.as_view(), name='upload'),
+    path('uploads/<uuid:upload_id>/complete/', views.UploadCompleteAPIView.as_view(), name='complete-upload'),
 ]
\ No newline at end of file
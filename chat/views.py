@@ -1,14 +1,24 @@
+import re
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import NotFound
 from django.db.models import Q
 from django.shortcuts import redirect
 from django.urls import reverse
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 
 from authorization.models import UserProfile
-from .models import Conversation, Message
-from .serializers import ConversationListSerializer, ConversationSerializer, MessageSerializer
+from marketplace.services import paginate
+from .models import Conversation, Message, MessageUpload
+from .serializers import ConversationListSerializer, ConversationSerializer, MessageSerializer, \
+    ConversationDetailSerializer, MessageUploadSerializer
+from .services import get_message_history, get_or_create_conversation, mark_conversation_read, store_messages, \
+    start_upload, write_upload_chunks, complete_upload, get_message_event, UPLOAD_CHUNK_SIZE
 
 # Create your views here.
 
@@ -32,12 +42,10 @@ class ConversationStartAPIView(APIView):
         except UserProfile.DoesNotExist:
             return Response({'message': 'You cannot chat with a non existent user'})
 
-        conversation = Conversation.objects.filter(Q(initiator=request.user.user_profile, receiver=participant) |
-                                                Q(initiator=participant, receiver=request.user.user_profile))
-        if conversation.exists():
-            return redirect(reverse('getconversation', args=(conversation[0].id,)))
+        conversation, created = get_or_create_conversation(request.user.user_profile, participant)
+        if not created:
+            return redirect(reverse('getconversation', args=(conversation.id,)))
         else:
-            conversation = Conversation.objects.create(initiator=request.user.user_profile, receiver=participant)
             return Response(ConversationSerializer(instance=conversation).data)
 
 
@@ -48,18 +56,34 @@ class MessageAPIView(APIView):
         tags = ["Chat"],
         operation_summary = "Открыть переписку с пользователем.",
         operation_description = "Предоставляет доступ к переписке с другим пользователем.",
+        manual_parameters = [
+            openapi.Parameter('cursor', openapi.IN_QUERY, type = openapi.TYPE_STRING, required = False,
+                              description = "next_cursor предыдущей страницы: более старые сообщения."),
+            openapi.Parameter('since', openapi.IN_QUERY, type = openapi.TYPE_STRING, required = False,
+                              description = "latest_cursor клиента: только новые сообщения, от старых к новым."),
+            openapi.Parameter('limit', openapi.IN_QUERY, type = openapi.TYPE_INTEGER, required = False,
+                              description = "Количество сообщений на странице (по умолчанию 50)."),
+        ],
         responses = {
             200: ConversationSerializer,
             404: "Not found",
         }
     )
     def get(self, request, convo_id):
-        conversation = Conversation.objects.filter(id=convo_id)
-        if not conversation.exists():
+        conversation = Conversation.objects.filter(id=convo_id).select_related('initiator', 'receiver').first()
+        if not conversation:
             return Response({'message': 'Conversation does not exist'})
         else:
-            serializer = ConversationSerializer(instance=conversation[0])
-            return Response(serializer.data)
+            messages, pagination = get_message_history(conversation, request)
+            if not request.query_params.get('cursor'):
+                # The newest messages are on screen
+                mark_conversation_read(conversation, request.user.user_profile)
+            data = {
+                **ConversationDetailSerializer(instance=conversation).data,
+                'message_set': MessageSerializer(messages, many=True).data,
+                **pagination,
+            }
+            return Response(data)
 
 class SendMessageAPIView(APIView):
     permission_classes = [IsAuthenticated]
@@ -80,12 +104,9 @@ class SendMessageAPIView(APIView):
         except UserProfile.DoesNotExist:
             return Response({'message': 'You cannot chat with a non existent user'})
 
-        conversation = Conversation.objects.filter(Q(initiator=request.user.user_profile, receiver=participant) |
-                                                Q(initiator=participant, receiver=request.user.user_profile)).first()
-        if not conversation:
-            conversation = Conversation.objects.create(initiator=request.user.user_profile, receiver=participant)
+        conversation, _ = get_or_create_conversation(request.user.user_profile, participant)
         attachment = data.get('attachment', None)
-        message = Message.objects.create(sender = request.user.user_profile, text = data['text'], conversation_id = conversation, attachment = attachment)
+        message = store_messages([Message(sender = request.user.user_profile, text = data['text'], conversation_id = conversation, attachment = attachment)])[0]
         return Response(MessageSerializer(instance=message).data)
 
 
@@ -96,13 +117,138 @@ class ConversationListAPIView(APIView):
         tags = ["Chat"],
         operation_summary = "Список чатов пользователя",
         operation_description = "Предоставляет доступ к чатам пользователя.",
+        manual_parameters = [
+            openapi.Parameter('page', openapi.IN_QUERY, type = openapi.TYPE_INTEGER, required = False),
+            openapi.Parameter('limit', openapi.IN_QUERY, type = openapi.TYPE_INTEGER, required = False),
+            openapi.Parameter('cursor', openapi.IN_QUERY, type = openapi.TYPE_STRING, required = False,
+                              description = "next_cursor предыдущей страницы (пустой для первой)."),
+        ],
         responses = {
-            200: ConversationSerializer,
+            200: ConversationListSerializer,
             404: "Not found",
         }
     )
     def get(self, request):
-        conversation_list = Conversation.objects.filter(Q(initiator=request.user.user_profile) |
-                                                        Q(receiver=request.user.user_profile))
-        serializer = ConversationListSerializer(instance=conversation_list, many=True)
-        return Response(serializer.data)
+        profile = request.user.user_profile
+        conversation_list = Conversation.objects.filter(Q(initiator=profile) | Q(receiver=profile)) \
+            .select_related('initiator', 'receiver').order_by('-last_message_at', '-id')
+        page, pagination = paginate(conversation_list, request, cursor_field='last_message_at')
+        serializer = ConversationListSerializer(instance=page, many=True, context={'profile': profile})
+        return Response({'data': serializer.data, **pagination})
+
+
+def get_own_upload(request, upload_id):
+    upload = MessageUpload.objects.filter(id=upload_id, owner=request.user.user_profile).first()
+    if not upload:
+        raise NotFound("Upload does not exist")
+    return upload
+
+
+class UploadStartAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags = ["Chat"],
+        operation_summary = "Начать загрузку вложения",
+        operation_description = "Создает загрузку вложения по частям. Файл отправляется частями через PUT "
+                                "/uploads/<id>/ и прикрепляется к сообщению после проверки sha256.",
+        request_body = openapi.Schema(
+            type = openapi.TYPE_OBJECT,
+            required = ['conversation_id', 'file_name', 'size', 'sha256'],
+            properties = {
+                'conversation_id': openapi.Schema(type = openapi.TYPE_INTEGER),
+                'file_name': openapi.Schema(type = openapi.TYPE_STRING),
+                'size': openapi.Schema(type = openapi.TYPE_INTEGER, description = "Размер файла в байтах"),
+                'sha256': openapi.Schema(type = openapi.TYPE_STRING, description = "sha256 файла (hex)"),
+            }
+        ),
+        responses = {
+            201: MessageUploadSerializer,
+            400: "Bad request",
+            404: "Not found",
+        }
+    )
+    def post(self, request):
+        profile = request.user.user_profile
+        conversation_id = str(request.data.get('conversation_id', ''))
+        conversation = Conversation.objects.filter(id=conversation_id).first() if conversation_id.isdigit() else None
+        if not conversation or profile.id not in (conversation.initiator_id, conversation.receiver_id):
+            return Response({'message': 'Conversation does not exist'}, status=404)
+
+        upload = start_upload(conversation, profile, request.data.get('file_name'), request.data.get('size'),
+                              request.data.get('sha256'))
+        return Response({**MessageUploadSerializer(instance=upload).data, 'chunk_size': UPLOAD_CHUNK_SIZE},
+                        status=201)
+
+
+class UploadAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags = ["Chat"],
+        operation_summary = "Состояние загрузки вложения",
+        operation_description = "Возвращает количество полученных байт (received), с которого продолжается загрузка.",
+        responses = {
+            200: MessageUploadSerializer,
+            404: "Not found",
+        }
+    )
+    def get(self, request, upload_id):
+        return Response(MessageUploadSerializer(instance=get_own_upload(request, upload_id)).data)
+
+    @swagger_auto_schema(
+        tags = ["Chat"],
+        operation_summary = "Загрузить часть вложения",
+        operation_description = "Тело запроса - байты файла начиная с received. Смещение можно передать "
+                                "заголовком Content-Range: bytes <start>-<end>/<size>.",
+        responses = {
+            200: MessageUploadSerializer,
+            400: "Bad request",
+            404: "Not found",
+        }
+    )
+    def put(self, request, upload_id):
+        upload = get_own_upload(request, upload_id)
+        offset = upload.received
+        content_range = request.headers.get('Content-Range')
+        if content_range:
+            match = re.fullmatch(r'bytes (\d+)-\d+/(?:\d+|\*)', content_range.strip())
+            if not match:
+                return Response({'message': 'Invalid Content-Range'}, status=400)
+            offset = int(match.group(1))
+
+        # The body is read in chunks straight from the request stream, never as a whole
+        stream = request.stream
+        chunks = iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b'') if stream is not None else ()
+        write_upload_chunks(upload, offset, chunks)
+        return Response(MessageUploadSerializer(instance=upload).data)
+
+
+class UploadCompleteAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags = ["Chat"],
+        operation_summary = "Завершить загрузку вложения",
+        operation_description = "Проверяет sha256 загруженного файла и отправляет сообщение с вложением.",
+        request_body = openapi.Schema(
+            type = openapi.TYPE_OBJECT,
+            properties = {
+                'text': openapi.Schema(type = openapi.TYPE_STRING),
+            }
+        ),
+        responses = {
+            200: MessageSerializer,
+            400: "Bad request",
+            404: "Not found",
+        }
+    )
+    def post(self, request, upload_id):
+        upload = get_own_upload(request, upload_id)
+        completed = upload.message_id is not None
+        message = complete_upload(upload, request.data.get('text', ''))
+        if not completed:
+            # Sockets in the conversation get the message as if it was sent over the socket
+            async_to_sync(get_channel_layer().group_send)(f"chat_{message.conversation_id_id}",
+                                                          get_message_event(message))
+        return Response(MessageSerializer(instance=message).data)
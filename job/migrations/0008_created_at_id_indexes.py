@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('job', '0007_alter_vacancyresponse_applicant'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='resume',
+            index=models.Index(fields=['-created_at', '-id'], name='resume_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vacancy',
+            index=models.Index(fields=['-created_at', '-id'], name='vacancy_created_id_idx'),
+        ),
+    ]
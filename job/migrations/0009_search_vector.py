@@ -0,0 +1,24 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:17
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('job', '0008_created_at_id_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resume',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='vacancy',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from autoslug import AutoSlugField
+from django.contrib.postgres.search import SearchVectorField
 
 from authorization.models import Organization, UserProfile
 
@@ -52,10 +53,16 @@ class Vacancy(models.Model):
     currency = models.CharField(max_length=15, choices=CURRENCY, default='Som')
     hide = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return f"This {self.job_title} by {self.organization.title}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='vacancy_created_id_idx'),
+        ]
+
 
 class Resume(models.Model):
     job_title = models.CharField(max_length=60)
@@ -70,11 +77,17 @@ class Resume(models.Model):
     currency = models.CharField(max_length=15, choices=CURRENCY, default='Som')
     hide = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(null=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"This {self.job_title} by {self.author.first_name}-{self.author.last_name}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='resume_created_id_idx'),
+        ]
+
 
 class VacancyResponse(models.Model):
     vacancy = models.ForeignKey(Vacancy, on_delete=models.CASCADE)
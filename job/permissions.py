@@ -2,6 +2,8 @@ from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
 
 from authorization.models import Organization
 from monitoring.models import Employee, STATUS_CHOICES
+from monitoring.services import get_org_context
+from .services import get_vacancy_organization
 
 
 class CurrentUserOrReadOnly(IsAuthenticated):
@@ -14,17 +16,17 @@ class CurrentUserOrReadOnly(IsAuthenticated):
 
 class AddVacancyEmployee(IsAuthenticated):
     def has_permission(self, request, view):
-        user = request.user.user_profile
-        current_organization = Organization.objects.filter(owner=user).first()
-        if not current_organization:
+        if not super().has_permission(request, view):
             return False
-        if user == current_organization.founder or user == current_organization.owner:
-            return True
-
-        employee = Employee.objects.filter(user=user, org=current_organization).first()
-        if employee and employee.job_title and employee.job_title.flag_create_vacancy:
+        organization = get_vacancy_organization(request)
+        if organization is None:
+            return False
+        context = get_org_context(request)
+        if organization.id != context.org_id:
+            # The founder's or owner's organization, without an Employee row
             return True
-        return False
+        # The founder and the owner may always add vacancies
+        return context.has_permission('flag_create_vacancy', allow_owner=True)
 
 
 class IsOrganizationEmployeeReadOnly(IsAuthenticated):
@@ -32,7 +34,7 @@ class IsOrganizationEmployeeReadOnly(IsAuthenticated):
         user = request.user
 
         if user and not user.is_anonymous:
-            employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
+            employee = get_org_context(request).employee
             if not employee:
                 return False
             return True
@@ -1,11 +1,42 @@
+from django.db.models import Q
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from authorization.models import Organization
+from marketplace.utils import get_keyset_page
+from monitoring.services import get_org_context
 
 
 class MyCustomPagination(PageNumberPagination):
     page_size = 10
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # Passing `cursor` switches to keyset pagination on (created_at, id); lists answer it with 400
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page, self.next_cursor = get_keyset_page(queryset, request.query_params.get(self.cursor_query_param),
+                                                 self.page_size)
+        return page
+
+    def get_next_cursor_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
 
     def get_paginated_response(self, data):
+        if self.cursor_mode:
+            return Response({
+                'data': data,
+                'has_next_page': self.next_cursor is not None,
+                'next_cursor': self.next_cursor,
+                'next_link': self.get_next_cursor_link(),
+            })
         return Response({
             'data': data,
             'total_page': self.page.paginator.num_pages,
@@ -13,3 +44,20 @@ class MyCustomPagination(PageNumberPagination):
             'has_next_page': self.get_next_link(),
             'has_prev_page': self.get_previous_link()
         })
+
+
+def get_vacancy_organization(request):
+    """
+    The organization the request user adds vacancies to: the active one of
+    the user's Employee row, else the active organization the user founded
+    or owns, which needs no Employee row. Resolved once per request.
+    """
+    http_request = getattr(request, '_request', request)
+    if not hasattr(http_request, 'vacancy_organization'):
+        organization = get_org_context(request).org
+        if organization is None:
+            profile = request.user.user_profile
+            organization = Organization.objects.filter(Q(founder=profile) | Q(owner=profile), active=True) \
+                .order_by('id').first()
+        http_request.vacancy_organization = organization
+    return http_request.vacancy_organization
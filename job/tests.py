@@ -1,3 +1,74 @@
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from authorization.factories import create_organization, create_profile
+from monitoring.models import Employee, JobTitle
+from .models import Vacancy
+
+
+def create_vacancy(organization, job_title="Vacancy", **fields):
+    return Vacancy.objects.create(organization=organization, job_title=job_title, min_salary=100, max_salary=200,
+                                  **fields)
+
+
+class VacancyCursorPaginationTests(TestCase):
+    def setUp(self):
+        self.organization = create_organization(create_profile("founder"))
+        self.vacancies = [create_vacancy(self.organization, f"Vacancy {number}") for number in range(12)]
+        Vacancy.objects.filter(pk__in=[vacancy.pk for vacancy in self.vacancies[3:8]]).update(
+            created_at=self.vacancies[3].created_at)
+        self.client = APIClient()
+
+    def test_cursor_pages_cover_the_list_once(self):
+        slugs, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get('/vacancy/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            slugs.extend(row['slug'] for row in response.data['data'])
+            cursor = response.data['next_cursor']
+            self.assertIs(response.data['has_next_page'], cursor is not None)
+        self.assertEqual(slugs, list(Vacancy.objects.order_by('-created_at', '-id').values_list('slug', flat=True)))
+
+    def test_page_mode_is_the_default(self):
+        response = self.client.get('/vacancy/')
+        self.assertEqual(response.data['total_page'], 2)
+        self.assertEqual(len(response.data['data']), 10)
+
+
+class AddVacancyTests(TestCase):
+    def setUp(self):
+        # Organization contexts and permissions are cached by ids, which are reused between tests
+        cache.clear()
+        self.founder = create_profile("founder")
+        self.organization = create_organization(self.founder, active=True)
+        self.client = APIClient()
+        self.data = {'job_title': "Vacancy", 'min_salary': 100, 'max_salary': 200}
+
+    def add_vacancy(self, profile):
+        self.client.force_authenticate(profile.user)
+        return self.client.post('/add-vacancy/', self.data, format='json')
+
+    def add_employee(self, profile, organization, **flags):
+        job_title = JobTitle.objects.create(org=organization, title="Manager", description="job", **flags)
+        return Employee.objects.create(user=profile, org=organization, job_title=job_title, active=True)
+
+    def test_founder_without_an_employee_row(self):
+        response = self.add_vacancy(self.founder)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Vacancy.objects.get().organization, self.organization)
+
+    def test_employee_adds_to_the_active_organization(self):
+        employee = create_profile("employee")
+        create_organization(employee, "Own organization")
+        self.add_employee(employee, self.organization, flag_create_vacancy=True)
+        response = self.add_vacancy(employee)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Vacancy.objects.get().organization, self.organization)
+
+    def test_employee_without_the_flag_is_refused(self):
+        employee = create_profile("employee")
+        self.add_employee(employee, self.organization)
+        self.assertEqual(self.add_vacancy(employee).status_code, 403)
+        self.assertEqual(self.add_vacancy(create_profile("outsider")).status_code, 403)
+        self.assertFalse(Vacancy.objects.exists())
@@ -11,12 +11,13 @@ from django.db.models import Q
 from authorization.models import Organization, UserProfile
 from monitoring.models import STATUS_CHOICES
 from monitoring.models import Employee
+from monitoring.services import get_org_context
 from .models import Vacancy, Resume, VacancyResponse
 from .serializers import (VacancyListSerializer, VacancyDetailSerializer,
                           ResumeListSerializer, ResumeDetailSerializer, VacancyResponseSerializer)
 from .permissions import CurrentUserOrReadOnly, AddVacancyEmployee, IsOrganizationEmployeeReadOnly
-from .services import MyCustomPagination
-from .firebase_config import send_fcm_notification
+from .services import MyCustomPagination, get_vacancy_organization
+from search.services import search_queryset
 
 
 class VacancyListAPIView(views.APIView):
@@ -209,15 +210,11 @@ class AddVacancyAPIView(views.APIView):
         tags=["Vacancy"]
     )
     def post(self, request, *args, **kwargs):
-        user = request.user
-        if Organization.objects.filter(founder=user.user_profile):
-            organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
-        else:
-            try:
-                organization = user.user_profile.working_orgs.get().org()
-            except Exception as e:
-                return Response({"error": "You must belong to an organization to create a vacancy"},
-                                status=status.HTTP_403_FORBIDDEN)
+        # AddVacancyEmployee checked the permission in this organization
+        organization = get_vacancy_organization(request)
+        if not organization:
+            return Response({"error": "You must belong to an organization to create a vacancy"},
+                            status=status.HTTP_403_FORBIDDEN)
 
         serializer = VacancyDetailSerializer(data=request.data)
         if serializer.is_valid():
@@ -356,12 +353,12 @@ class VacancySearchAPIView(views.APIView):
         vacancy = request.query_params.get('job_title', None)
 
         if vacancy:
-            queryset = Vacancy.objects.filter(Q(job_title__istartswith=vacancy)).order_by('-created_at')
+            queryset = search_queryset(Vacancy.objects.all(), vacancy)
         else:
             return Response({"error": "Nothing was found for your request"}, status=status.HTTP_404_NOT_FOUND)
 
         paginator = self.pagination_class()
-        page = paginator.paginate_queryset(vacancy, request)
+        page = paginator.paginate_queryset(queryset, request)
         if page is not None:
             serializer = VacancyListSerializer(page, many=True, include_response_count=False)
             return paginator.get_paginated_response(serializer.data)
@@ -384,8 +381,8 @@ class VacancyByOrgAPIView(views.APIView):
         tags=["Vacancy"]
     )
     def get(self, request, *args, **kwargs):
-        user = request.user
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
+        # Resolved by the IsOrganizationEmployeeReadOnly permission already
+        employee = get_org_context(request).employee
         vacancy = Vacancy.objects.filter(organization=employee.org).order_by('-created_at')
 
         paginator = self.pagination_class()
@@ -889,12 +886,12 @@ class SearchResumeAPIView(views.APIView):
         resume = request.query_params.get('job_title', None)
 
         if resume:
-            resume_queryset = Resume.objects.filter(Q(job_title__istartswith=resume)).order_by('-created_at')
+            resume_queryset = search_queryset(Resume.objects.all(), resume)
         else:
             return Response({"error": "Nothing was found for your request"}, status=status.HTTP_404_NOT_FOUND)
 
         paginator = self.pagination_class()
-        page = paginator.paginate_queryset(resume, request)
+        page = paginator.paginate_queryset(resume_queryset, request)
         if page is not None:
             serializer = ResumeListSerializer(page, many=True)
             return paginator.get_paginated_response(serializer.data)
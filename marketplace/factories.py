@@ -0,0 +1,18 @@
+from datetime import date
+
+from .models import Equipment, Order, Service
+
+# Test helpers shared by the apps' tests
+
+
+def create_order(author, title="Order", **fields):
+    return Order.objects.create(author=author, title=title, price=100, deadline=date(2030, 1, 1),
+                                phone_number="0700", **fields)
+
+
+def create_equipment(author, title="Equipment", **fields):
+    return Equipment.objects.create(author=author, title=title, price=100, phone_number="0700", **fields)
+
+
+def create_service(author, title="Service", **fields):
+    return Service.objects.create(author=author, title=title, price=100, phone_number="0700", **fields)
@@ -0,0 +1,36 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.scheduler import get_worker_id, register_jobs, run_due_jobs
+from marketplace.tasks import JOBS
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Runs the periodic order jobs of marketplace.tasks. Every node may run this command; "
+            "a database lease makes sure each job runs on one node at a time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30,
+                            help="Seconds between two checks for due jobs.")
+        parser.add_argument('--once', action='store_true',
+                            help="Run the due jobs and exit.")
+
+    def handle(self, *args, **options):
+        worker_id = get_worker_id()
+        register_jobs(JOBS)
+        while True:
+            try:
+                for name in run_due_jobs(JOBS, worker_id):
+                    self.stdout.write(f"Ran {name}")
+            except Exception:
+                logger.exception("Scheduled jobs check failed")
+                if options['once']:
+                    raise
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
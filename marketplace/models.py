@@ -1,5 +1,7 @@
 from django.db import models
+from django.utils import timezone
 from autoslug import AutoSlugField
+from django.contrib.postgres.search import SearchVectorField
 from authorization.models import UserProfile, Organization
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -39,10 +41,16 @@ class Equipment(models.Model):
     hide = models.BooleanField(default=False)
     quantity = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return f"{self.title}, slug: {self.slug}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='equipment_created_id_idx'),
+        ]
+
 
 class EquipmentImages(models.Model):
     equipment = models.ForeignKey(Equipment, related_name='images', on_delete=models.CASCADE)
@@ -74,10 +82,16 @@ class Service(models.Model):
     liked_by = models.ManyToManyField(UserProfile, blank=True, related_name='liked_services')
     hide = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return f"{self.title}, slug: {self.slug}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='service_created_id_idx'),
+        ]
+
 
 class ServiceImages(models.Model):
     service = models.ForeignKey(Service, related_name='images', on_delete=models.CASCADE)
@@ -106,7 +120,58 @@ class Size(models.Model):
         return self.size
 
 
-class Order(models.Model):
+class FieldTrackerMixin:
+    """
+    Remembers the values of `tracked_fields` as they were loaded from the
+    database, so signal handlers can see what a save changes without
+    re-reading the row.
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.reset_tracked_fields()
+        return instance
+
+    def reset_tracked_fields(self, fields=None):
+        snapshot = self.__dict__.setdefault('_tracked_values', {})
+        for name in fields or self.tracked_fields:
+            # Deferred fields are missing from __dict__
+            if name in self.tracked_fields and name in self.__dict__:
+                snapshot[name] = self.__dict__[name]
+
+    def get_tracked_changes(self, update_fields=None):
+        """
+        Returns {field: (old value, new value)} for the tracked fields that
+        differ from the loaded values and are written by this save.
+        """
+        if self._state.adding:
+            return {}
+        snapshot = self.__dict__.get('_tracked_values', {})
+        return {name: (snapshot[name], self.__dict__[name]) for name in self.tracked_fields
+                if name in snapshot and name in self.__dict__ and snapshot[name] != self.__dict__[name]
+                and (update_fields is None or name in update_fields)}
+
+    def load_missing_tracked_values(self):
+        snapshot = self.__dict__.setdefault('_tracked_values', {})
+        missing = [name for name in self.tracked_fields if name in self.__dict__ and name not in snapshot]
+        if missing:
+            # Not loaded from the database (e.g. built with a pk): read the old values once
+            snapshot.update(type(self)._base_manager.filter(pk=self.pk).values(*missing).first() or {})
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            self.load_missing_tracked_values()
+        super().save(*args, **kwargs)
+        self.reset_tracked_fields(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        self.reset_tracked_fields(fields)
+
+
+class Order(FieldTrackerMixin, models.Model):
     title = models.CharField(max_length=60)
     slug = AutoSlugField(populate_from='title', unique=True, always_update=True)
     category = models.ForeignKey(OrderCategory, related_name='orders', null=True, blank=True, on_delete=models.DO_NOTHING)
@@ -125,14 +190,25 @@ class Order(models.Model):
     org_work = models.ForeignKey(Organization, related_name='received_orders', blank=True, null=True, on_delete=models.SET_NULL)
     org_applicants = models.ManyToManyField(Organization, related_name='applied_orders', blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(null=True, editable=False)
     booked_at = models.DateTimeField(blank=True, null=True)
     is_finished = models.BooleanField(default=False)
     finished_at = models.DateTimeField(blank=True, null=True)
     arrived_at = models.DateTimeField(blank=True, null=True)
+    deadline_alerted_at = models.DateTimeField(blank=True, null=True)
+
+    tracked_fields = ('is_booked', 'is_finished', 'status')
 
     def __str__(self):
         return f"{self.title}, slug: {self.slug}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='order_created_id_idx'),
+            # Deadline sweep of unfinished orders
+            models.Index(fields=['is_finished', 'deadline'], name='order_finished_deadline_idx'),
+        ]
+
 
 class OrderImages(models.Model):
     order = models.ForeignKey(Order, related_name='images', on_delete=models.CASCADE)
@@ -152,3 +228,18 @@ class Reviews(models.Model):
 
     def __str__(self):
         return f'Review by {self.reviewer} on {self.order}'
+
+
+class ScheduledJob(models.Model):
+    # Schedule and lease of a periodic job in marketplace.tasks.JOBS, run by the `run_scheduled_jobs` command.
+    # A runner owns the job until `locked_until`, so only one node runs it at a time.
+    name = models.CharField(max_length=100, unique=True)
+    next_run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_started_at = models.DateTimeField(blank=True, null=True)
+    last_finished_at = models.DateTimeField(blank=True, null=True)
+    last_result = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.name}, next run: {self.next_run_at}"
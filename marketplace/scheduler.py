@@ -0,0 +1,52 @@
+import logging
+import os
+import socket
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ScheduledJob
+
+logger = logging.getLogger(__name__)
+
+# Longer than any run; a node that dies mid-run releases its jobs when the lease expires
+JOB_LEASE = timedelta(minutes=30)
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def register_jobs(jobs):
+    ScheduledJob.objects.bulk_create([ScheduledJob(name=name) for name in jobs], ignore_conflicts=True)
+
+
+def acquire_job(name, worker_id, lease=JOB_LEASE):
+    # A single conditional UPDATE, so only one node gets the lease of a due job
+    now = timezone.now()
+    return ScheduledJob.objects.filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+                                       name=name, next_run_at__lte=now) \
+        .update(locked_by=worker_id, locked_until=now + lease, last_started_at=now) == 1
+
+
+def run_due_jobs(jobs, worker_id, lease=JOB_LEASE):
+    """
+    Runs every job of `jobs` that is due and whose lease this worker gets,
+    then schedules its next run. Returns the names of the jobs run.
+    """
+    ran = []
+    for name, (function, interval) in jobs.items():
+        if not acquire_job(name, worker_id, lease):
+            continue
+        try:
+            result = f"ok: {function()}"
+        except Exception as e:
+            logger.exception("Scheduled job %s failed", name)
+            result = f"error: {e}"
+        finished_at = timezone.now()
+        ScheduledJob.objects.filter(name=name, locked_by=worker_id).update(
+            locked_by='', locked_until=None, last_finished_at=finished_at,
+            next_run_at=finished_at + interval, last_result=result)
+        ran.append(name)
+    return ran
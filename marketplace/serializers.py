@@ -4,6 +4,7 @@ from authorization.models import UserProfile, Organization
 from .models import Equipment, Order, Reviews, EquipmentCategory, OrderCategory, EquipmentImages, OrderImages, \
     Notification
 from .models import Service, ServiceCategory, ServiceImages, Size
+from .utils import get_viewer_state, get_cover_image
 
 
 class AuthorSerializer(serializers.ModelSerializer):
@@ -194,15 +195,10 @@ class ServiceListAPI(serializers.ModelSerializer):
         return None
 
     def get_is_liked(self, instance):
-        user = self.context['request'].user if self.context.get('request') else None
-        if user and not user.is_anonymous:
-            return instance.liked_by.filter(user=user).exists()
-        else:
-            # If user is None or anonymous, set 'is_liked' to False
-            return False
+        return get_viewer_state(self, instance).is_liked(instance)
 
     def get_image(self, instance):
-        first_image = instance.images.first()
+        first_image = get_cover_image(instance)
         if first_image:
             return first_image.images.url
         return None
@@ -326,27 +322,13 @@ class OrderListAPI(serializers.ModelSerializer):
 
 
     def get_is_liked(self, instance):
-        user = self.context['request'].user if self.context.get('request') else None
-        if user and not user.is_anonymous:
-            return instance.liked_by.filter(user=user).exists()
-        else:
-            # If user is None or anonymous, set 'is_liked' to False
-            return False
+        return get_viewer_state(self, instance).is_liked(instance)
 
     def get_is_applied(self, instance):
-        user = self.context['request'].user if self.context.get('request') else None
-        if user and not user.is_anonymous:
-            if Organization.objects.filter(founder=user.user_profile):
-                organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
-                return organization in instance.org_applicants.all()
-            else:
-                # If user is None or anonymous, set 'is_liked' to False
-                return False
-        else:
-            return False
+        return get_viewer_state(self, instance).is_applied(instance)
 
     def get_image(self, instance):
-        first_image = instance.images.first()
+        first_image = get_cover_image(instance)
         if first_image:
             return first_image.images.url
         return None
@@ -662,18 +644,13 @@ class EquipmentSerializer(serializers.ModelSerializer):
         return None
 
     def get_image(self, instance):
-        image = instance.images.first()
+        image = get_cover_image(instance)
         if image:
             return image.images.url
         return 'Images does not exist'
 
     def get_is_liked(self, instance):
-        user = self.context['request'].user if self.context.get('request') else None
-        if user and not user.is_anonymous:
-            return instance.liked_by.filter(user=user).exists()
-        else:
-            # If user is None or anonymous, set 'is_liked' to False
-            return False
+        return get_viewer_state(self, instance).is_liked(instance)
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -709,18 +686,13 @@ class MyAdsSerializer(serializers.ModelSerializer):
         fields = ['title', 'slug', 'author', 'description', 'type', 'image', 'status', 'is_liked', 'price', 'currency', 'created_at']  # Adjust fields as needed
 
     def get_image(self, instance):
-        image = instance.images.first()
+        image = get_cover_image(instance)
         if image:
             return image.images.url
         return 'Images does not exist'
 
     def get_is_liked(self, instance):
-        user = self.context['request'].user if self.context.get('request') else None
-        if user and not user.is_anonymous:
-            return instance.liked_by.filter(user=user).exists()
-        else:
-            # If user is None or anonymous, set 'is_liked' to False
-            return False
+        return get_viewer_state(self, instance).is_liked(instance)
 
     def get_type(self, instance):
         if isinstance(instance, Equipment):
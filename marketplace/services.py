@@ -3,19 +3,30 @@ from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
 
 from .serializers import OrderListAPI, EquipmentSerializer, MyAdsSerializer, ServiceListAPI
+from .utils import ViewerState, prefetch_cover_images, get_keyset_page
 
 
-def get_paginated_data(queryset, request, list_type):
-    page_number = request.query_params.get('page', 1)
+def paginate(queryset, request, cursor_field='created_at'):
+    """
+    Returns the requested page and its pagination info.
+    Passing `cursor` (empty for the first page) switches to keyset pagination
+    on (cursor_field, id), which skips the COUNT(*) and the OFFSET scan.
+    Lists cannot be paged by cursor and answer a cursor with 400.
+    """
     page_limit = request.query_params.get('limit', 10)
 
+    if 'cursor' in request.query_params:
+        page, next_cursor = get_keyset_page(queryset, request.query_params.get('cursor'), page_limit, cursor_field)
+        pagination = {
+            'has_next_page': next_cursor is not None,
+            'next_cursor': next_cursor,
+        }
+        return page, pagination
+
+    page_number = request.query_params.get('page', 1)
     paginator = Paginator(queryset, page_limit)
     page_obj = paginator.get_page(page_number)
-
-    serializer = OrderListAPI(page_obj, many=True, context={'request': request, 'list_type': list_type})
-    content = {"data": serializer.data}
-    data = {
-        'data': content,
+    pagination = {
         'total_pages': paginator.num_pages,
         'current_page': page_obj.number,
         'has_next_page': page_obj.has_next(),
@@ -23,69 +34,62 @@ def get_paginated_data(queryset, request, list_type):
         'next_page_number': page_obj.next_page_number() if page_obj.has_next() else None,
         'prev_page_number': page_obj.previous_page_number() if page_obj.has_previous() else None,
     }
+    return page_obj, pagination
+
+
+def get_paginated_data(queryset, request, list_type):
+    page_obj, pagination = paginate(queryset, request)
+    prefetch_cover_images(page_obj)
+
+    serializer = OrderListAPI(page_obj, many=True, context={'request': request, 'list_type': list_type,
+                                                        'viewer_state': ViewerState.resolve(page_obj, request)})
+    content = {"data": serializer.data}
+    data = {
+        'data': content,
+        **pagination,
+    }
     return data
 
 
 def get_services_paginated_data(queryset, request):
-    page_number = request.query_params.get('page', 1)
-    page_limit = request.query_params.get('limit', 10)
+    page_obj, pagination = paginate(queryset, request)
+    prefetch_cover_images(page_obj)
 
-    paginator = Paginator(queryset, page_limit)
-    page_obj = paginator.get_page(page_number)
-
-    serializer = ServiceListAPI(page_obj, many=True, context={'request': request})
+    serializer = ServiceListAPI(page_obj, many=True, context={'request': request,
+                                                           'viewer_state': ViewerState.resolve(page_obj, request)})
 
     data = {
         'data': serializer.data,
-        'total_pages': paginator.num_pages,
-        'current_page': page_obj.number,
-        'has_next_page': page_obj.has_next(),
-        'has_prev_page': page_obj.has_previous(),
-        'next_page_number': page_obj.next_page_number() if page_obj.has_next() else None,
-        'prev_page_number': page_obj.previous_page_number() if page_obj.has_previous() else None,
+        **pagination,
     }
     return data
 
 
 def get_equipment_paginated(queryset, request, equipment_type):
-    page_number = request.query_params.get('page', 1)
-    max_page = request.query_params.get('limit', 10)
+    page_obj, pagination = paginate(queryset, request)
+    prefetch_cover_images(page_obj)
 
-    paginator = Paginator(queryset, max_page)
-    page_obj = paginator.get_page(page_number)
-
-    serializer = EquipmentSerializer(page_obj, many=True, context={'request': request, 'equipment_type': equipment_type})
+    serializer = EquipmentSerializer(page_obj, many=True, context={'request': request, 'equipment_type': equipment_type,
+                                                                'viewer_state': ViewerState.resolve(page_obj, request)})
 
     data = {
         'data': serializer.data,
-        'total_pages': paginator.num_pages,
-        'current_page': page_obj.number,
-        'has_next_page': page_obj.has_next(),
-        'has_prev_page': page_obj.has_previous(),
-        'next_page_number': page_obj.next_page_number() if page_obj.has_next() else None,
-        'prev_page_number': page_obj.previous_page_number() if page_obj.has_previous() else None,
+        **pagination,
     }
 
     return data
 
 
 def get_order_or_equipment(queryset, request):
-    page_number = request.query_params.get('page', 1)
-    max_page = request.query_params.get('limit', 10)
-
-    paginator = Paginator(queryset, max_page)
-    page_obj = paginator.get_page(page_number)
+    page_obj, pagination = paginate(queryset, request)
+    prefetch_cover_images(page_obj)
 
-    serializer = MyAdsSerializer(page_obj, many=True, context={'request': request})
+    serializer = MyAdsSerializer(page_obj, many=True, context={'request': request,
+                                                            'viewer_state': ViewerState.resolve(page_obj, request)})
 
     data = {
         'data': serializer.data,
-        'total_pages': paginator.num_pages,
-        'current_page': page_obj.number,
-        'has_next_page': page_obj.has_next(),
-        'has_prev_page': page_obj.has_previous(),
-        'next_page_number': page_obj.next_page_number() if page_obj.has_next() else None,
-        'prev_page_number': page_obj.previous_page_number() if page_obj.has_previous() else None
+        **pagination,
     }
 
     return data
@@ -1,24 +1,83 @@
-# # tasks.py
-# from datetime import timedelta
-# from django.utils import timezone
-# from django_q.tasks import schedule
+from datetime import timedelta
 
+from django.db import transaction
+from django.utils import timezone
 
-# def check_and_auto_finish_orders():
-#     from .models import Order
+from authorization.models import Organization
+from notif.models import Notifications
+from notif.services import create_notifications
+from .models import Order
 
-#     # Calculate the threshold date (seven days ago)
-#     threshold_date = timezone.now() - timedelta(days=7)
+AUTO_FINISH_AFTER = timedelta(days=7)
+SWEEP_BATCH_SIZE = 500
 
-#     # Query orders that are arrived but not finished manually within seven days
-#     orders_to_auto_finish = Order.objects.filter(status='Arrived', is_finished=False, arrived_at__lte=threshold_date)
 
-#     # Auto finish each order
-#     for order in orders_to_auto_finish:
-#         order.is_finished = True
-#         order.finished_at = timezone.now()
-#         order.save()
+def auto_finish_orders(batch_size=SWEEP_BATCH_SIZE):
+    """
+    Finishes the orders that arrived AUTO_FINISH_AFTER ago and were not
+    finished by hand, with one UPDATE per batch, and notifies their authors
+    as a manual finish does. Returns the number of orders finished.
+    """
+    finished = 0
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            orders = list(Order.objects.select_for_update(skip_locked=True)
+                          .filter(status='Arrived', is_finished=False, arrived_at__lte=now - AUTO_FINISH_AFTER)
+                          .order_by('id').only('id', 'title', 'slug', 'author_id')[:batch_size])
+            if not orders:
+                return finished
+            Order.objects.filter(id__in=[order.id for order in orders]).update(is_finished=True, finished_at=now)
+            # Same notification as notif.signals.order_finish_notification, which update() does not trigger
+            create_notifications(
+                Notifications(recipient_id=order.author_id, type='Order', title="Заказ готов",
+                              description=f"Ваш заказ - '{order.title}' готов.", target_slug=order.slug)
+                for order in orders
+            )
+        finished += len(orders)
 
 
-# # Schedule the task to run every day
-# schedule('tasks.check_and_auto_finish_orders', q_options={'schedule_type': 'D', 'minutes': 1})
+def alert_missed_deadlines(batch_size=SWEEP_BATCH_SIZE):
+    """
+    Notifies the author and the owner of the working organization once about
+    every unfinished order past its deadline. Scans the
+    (is_finished, deadline) index. Returns the number of orders alerted.
+    """
+    alerted = 0
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            orders = list(Order.objects.select_for_update(skip_locked=True)
+                          .filter(is_finished=False, deadline__lt=timezone.localdate(now),
+                                  deadline_alerted_at__isnull=True)
+                          .order_by('deadline', 'id')
+                          .only('id', 'title', 'slug', 'deadline', 'author_id', 'org_work_id')[:batch_size])
+            if not orders:
+                return alerted
+            owners = dict(Organization.objects.filter(id__in={order.org_work_id for order in orders})
+                          .values_list('id', 'owner_id'))
+
+            notifications = []
+            for order in orders:
+                deadline = order.deadline.strftime("%d.%m.%Y")
+                notifications.append(Notifications(
+                    recipient_id=order.author_id, type='Order', title="Срок заказа истёк",
+                    description=f"Срок выполнения вашего заказа {order.title} истёк {deadline}.",
+                    target_slug=order.slug))
+                owner_id = owners.get(order.org_work_id)
+                if owner_id and owner_id != order.author_id:
+                    notifications.append(Notifications(
+                        recipient_id=owner_id, type='Order', title="Срок заказа истёк",
+                        description=f"Срок выполнения заказа {order.title} истёк {deadline}.",
+                        target_slug=order.slug))
+
+            Order.objects.filter(id__in=[order.id for order in orders]).update(deadline_alerted_at=now)
+            create_notifications(notifications)
+        alerted += len(orders)
+
+
+# Jobs of the `run_scheduled_jobs` command: name -> (function, interval between runs)
+JOBS = {
+    'auto_finish_orders': (auto_finish_orders, timedelta(hours=1)),
+    'alert_missed_deadlines': (alert_missed_deadlines, timedelta(hours=1)),
+}
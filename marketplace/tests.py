@@ -1,3 +1,342 @@
-from django.test import TestCase
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authorization.factories import create_profile
+from authorization.models import Organization
+from notif.models import Notifications
+from .factories import create_equipment, create_order, create_service
+from .models import Order, Equipment, Service, OrderImages, ScheduledJob
+from .scheduler import JOB_LEASE, acquire_job, register_jobs, run_due_jobs
+from .tasks import JOBS
+from .utils import AdFeed, ViewerState, prefetch_cover_images, get_cover_image
+
+
+def count_queries(client, url, *tables):
+    """Requests `url` and counts the queries that touch any of `tables`."""
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url)
+    return response, sum(1 for query in queries if any(f'"{table}"' in query['sql'] for table in tables))
+
+
+class ViewerStateTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+        self.viewer = create_profile("viewer")
+        self.org = Organization.objects.create(founder=self.viewer, owner=self.viewer, title="Viewer org",
+                                               description="org", active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer.user)
+
+    def get_orders(self, count):
+        orders = [create_order(self.author, f"Order {number}") for number in range(count)]
+        orders[0].liked_by.add(self.viewer)
+        orders[1].org_applicants.add(self.org)
+        return orders
+
+    def test_flags_of_marketplace_orders(self):
+        liked, applied = self.get_orders(3)[:2]
+        response = self.client.get('/marketplace-orders/')
+        rows = {row['slug']: row for row in response.data['data']['data']}
+        self.assertTrue(rows[liked.slug]['is_liked'])
+        self.assertFalse(rows[liked.slug]['is_applied'])
+        self.assertTrue(rows[applied.slug]['is_applied'])
+        self.assertFalse(rows[applied.slug]['is_liked'])
+
+    def test_flag_queries_do_not_grow_with_page_size(self):
+        self.get_orders(2)
+        tables = ('marketplace_order_liked_by', 'marketplace_order_org_applicants')
+        _, small_page = count_queries(self.client, '/marketplace-orders/?limit=10', *tables)
+        for number in range(8):
+            create_order(self.author, f"More {number}")
+        response, full_page = count_queries(self.client, '/marketplace-orders/?limit=10', *tables)
+        self.assertEqual(len(response.data['data']['data']), 10)
+        self.assertEqual(small_page, 2)
+        self.assertEqual(full_page, 2)
+
+    def test_mixed_page_queries_liked_once_per_model(self):
+        equipment = create_equipment(self.author)
+        service = create_service(self.author)
+        order = create_order(self.author)
+        equipment.liked_by.add(self.viewer)
+        service.liked_by.add(self.viewer)
+        request = RequestFactory().get('/')
+        request.user = self.viewer.user
+        # One liked query per model and one for applied orders
+        with self.assertNumQueries(4):
+            state = ViewerState.resolve([equipment, service, order], request)
+        self.assertTrue(state.is_liked(equipment))
+        self.assertTrue(state.is_liked(service))
+        self.assertFalse(state.is_liked(order))
+
+    def test_applied_flag_uses_the_first_active_org(self):
+        later_org = Organization.objects.create(founder=self.viewer, owner=self.viewer, title="Later org",
+                                                description="org", active=True)
+        first, second = create_order(self.author, "First"), create_order(self.author, "Second")
+        first.org_applicants.add(self.org)
+        second.org_applicants.add(later_org)
+        request = RequestFactory().get('/')
+        request.user = self.viewer.user
+        state = ViewerState.resolve([first, second], request)
+        self.assertTrue(state.is_applied(first))
+        self.assertFalse(state.is_applied(second))
+
+    def test_anonymous_viewer_costs_no_queries(self):
+        order = self.get_orders(2)[0]
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with self.assertNumQueries(0):
+            state = ViewerState.resolve([order], request)
+        self.assertFalse(state.is_liked(order))
+
+
+class CoverImageTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+        self.client = APIClient()
+
+    def create_images(self, order, count):
+        return [OrderImages.objects.create(order=order, images=f"Order images/{order.pk}-{number}.jpg")
+                for number in range(count)]
+
+    def test_prefetch_loads_the_first_image_of_every_ad(self):
+        orders = [create_order(self.author, f"Order {number}") for number in range(3)]
+        images = {order.pk: self.create_images(order, 3) for order in orders[:2]}
+        orders = list(Order.objects.filter(pk__in=[order.pk for order in orders]))
+        with self.assertNumQueries(1):
+            prefetch_cover_images(orders)
+        with self.assertNumQueries(0):
+            covers = {order.pk: get_cover_image(order) for order in orders}
+        for order in orders[:2]:
+            self.assertEqual(covers[order.pk], images[order.pk][0])
+        self.assertIsNone(covers[orders[2].pk])
+
+    def test_prefetch_queries_once_per_ad_model(self):
+        items = [create_order(self.author), create_equipment(self.author), create_service(self.author),
+                 create_order(self.author, "Second")]
+        with self.assertNumQueries(3):
+            prefetch_cover_images(items)
+
+    def test_image_queries_do_not_grow_with_page_size(self):
+        self.create_images(create_order(self.author), 2)
+        _, small_page = count_queries(self.client, '/marketplace-orders/', 'marketplace_orderimages')
+        for number in range(5):
+            self.create_images(create_order(self.author, f"More {number}"), 2)
+        response, full_page = count_queries(self.client, '/marketplace-orders/', 'marketplace_orderimages')
+        self.assertEqual(len(response.data['data']['data']), 6)
+        self.assertTrue(all(row['image'] for row in response.data['data']['data']))
+        self.assertEqual(small_page, 1)
+        self.assertEqual(full_page, 1)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+        self.client = APIClient()
+        self.orders = [create_order(self.author, f"Order {number}") for number in range(7)]
+        # Equal timestamps are ordered by id
+        Order.objects.filter(pk__in=[order.pk for order in self.orders[2:5]]).update(
+            created_at=self.orders[2].created_at)
+
+    def get_pages(self, limit):
+        slugs, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get('/marketplace-orders/', {'cursor': cursor, 'limit': limit})
+            self.assertEqual(response.status_code, 200)
+            slugs.extend(row['slug'] for row in response.data['data']['data'])
+            cursor = response.data['next_cursor']
+        return slugs
+
+    def test_cursor_pages_cover_the_list_once(self):
+        expected = list(Order.objects.order_by('-created_at', '-id').values_list('slug', flat=True))
+        self.assertEqual(self.get_pages(limit=2), expected)
+        self.assertEqual(self.get_pages(limit=3), expected)
+
+    def test_cursor_is_stable_under_inserts(self):
+        response = self.client.get('/marketplace-orders/', {'cursor': '', 'limit': 3})
+        first_page = [row['slug'] for row in response.data['data']['data']]
+        create_order(self.author, "Newer")
+        response = self.client.get('/marketplace-orders/', {'cursor': response.data['next_cursor'], 'limit': 10})
+        rest = [row['slug'] for row in response.data['data']['data']]
+        self.assertEqual(len(first_page) + len(rest), len(self.orders))
+        self.assertFalse(set(first_page) & set(rest))
+        self.assertIsNone(response.data['next_cursor'])
+
+    def test_cursor_mode_skips_the_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/marketplace-orders/', {'cursor': '', 'limit': 3})
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/marketplace-orders/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_on_another_ordering_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(self.author.user)
+        # Ordered by booked_at
+        response = client.get('/my-order-ads/', {'cursor': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.data)
+        # Ordered by relevance
+        response = self.client.get('/marketplace-orders/', {'cursor': '', 'title': 'Order'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_on_a_list_is_rejected(self):
+        # The federated search merges its hits into a list
+        response = self.client.get('/ads-search/', {'cursor': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.data)
+
+
+class AdFeedTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+        self.other = create_profile("other")
+        self.ads = []
+        for number in range(4):
+            self.ads += [create_order(self.author, f"Order {number}"), create_equipment(self.author, f"Eq {number}"),
+                         create_service(self.author, f"Service {number}")]
+        create_order(self.other, "Someone else's")
+
+    def get_feed(self):
+        return AdFeed(Equipment.objects.filter(author=self.author), Order.objects.filter(author=self.author),
+                      Service.objects.filter(author=self.author))
+
+    def test_feed_is_ordered_across_types(self):
+        expected = sorted(self.ads, key=lambda ad: (ad.created_at, ad.pk), reverse=True)
+        self.assertEqual([(type(ad), ad.pk) for ad in self.get_feed()[:len(self.ads)]],
+                         [(type(ad), ad.pk) for ad in expected])
+        self.assertEqual(self.get_feed().count(), len(self.ads))
+
+    def test_slice_loads_only_its_rows(self):
+        # The UNION ALL page, then one query per ad type on it
+        with self.assertNumQueries(3):
+            page = self.get_feed()[2:4]
+        self.assertEqual(len(page), 2)
+
+    def test_filter_applies_to_every_type(self):
+        feed = self.get_feed().filter(title__endswith='1')
+        self.assertEqual({ad.title for ad in feed[:10]}, {"Order 1", "Eq 1", "Service 1"})
+
+    def test_my_ads_pages_the_feed(self):
+        client = APIClient()
+        client.force_authenticate(self.author.user)
+        response = client.get('/my-ads/', {'limit': 5, 'page': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['data']), 2)
+        self.assertEqual(response.data['total_pages'], 3)
+
+
+class OrderChangeTrackingTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+        self.order = create_order(self.author)
+
+    def test_loaded_values_are_the_baseline(self):
+        order = Order.objects.get(pk=self.order.pk)
+        order.status = 'Process'
+        self.assertEqual(order.get_tracked_changes(), {'status': ('Waiting', 'Process')})
+        self.assertEqual(order.get_tracked_changes(update_fields=['title']), {})
+
+    def test_saves_without_tracked_changes_cost_no_extra_queries(self):
+        order = Order.objects.get(pk=self.order.pk)
+        order.description = "Changed"
+        with CaptureQueriesContext(connection) as queries:
+            order.save()
+        # Only the slug uniqueness check of AutoSlugField reads the table, the row itself is not re-read
+        self.assertEqual(sum(query['sql'].startswith('SELECT') for query in queries), 1)
+        self.assertFalse(Notifications.objects.exists())
+
+    def test_changes_notify_once_per_field(self):
+        order = Order.objects.get(pk=self.order.pk)
+        order.status = 'Process'
+        order.is_booked = True
+        order.save()
+        titles = sorted(Notifications.objects.values_list('title', flat=True))
+        self.assertEqual(titles, ["Заказ забронирован", "Статус заказа изменился!"])
+        # The snapshot moves with the save
+        order.save()
+        self.assertEqual(Notifications.objects.count(), 2)
+
+    def test_instance_built_with_a_pk_reads_the_old_values_once(self):
+        order = Order(pk=self.order.pk, author=self.author, title="Order", price=100, deadline=date(2030, 1, 1),
+                      phone_number="0700", created_at=self.order.created_at, status='Sending')
+        order.save()
+        self.assertEqual(Notifications.objects.get().description,
+                         f"Статус вашего заказа {order.title} изменился c Waiting на Sending.")
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        self.runs = []
+        self.jobs = {'job': (lambda: self.runs.append(timezone.now()), timedelta(hours=1))}
+        register_jobs(self.jobs)
+
+    def later(self, delta):
+        return mock.patch('django.utils.timezone.now', return_value=timezone.now() + delta)
+
+    def test_only_one_worker_gets_the_lease(self):
+        self.assertTrue(acquire_job('job', 'first'))
+        self.assertFalse(acquire_job('job', 'second'))
+        self.assertEqual(ScheduledJob.objects.get().locked_by, 'first')
+
+    def test_expired_lease_is_taken_over(self):
+        acquire_job('job', 'first')
+        with self.later(JOB_LEASE + timedelta(seconds=1)):
+            self.assertTrue(acquire_job('job', 'second'))
+        self.assertEqual(ScheduledJob.objects.get().locked_by, 'second')
+
+    def test_job_runs_once_until_it_is_due_again(self):
+        self.assertEqual(run_due_jobs(self.jobs, 'first'), ['job'])
+        self.assertEqual(run_due_jobs(self.jobs, 'second'), [])
+        job = ScheduledJob.objects.get()
+        self.assertEqual(job.locked_by, '')
+        self.assertIsNone(job.locked_until)
+        self.assertTrue(job.last_result.startswith('ok'))
+        with self.later(timedelta(hours=1, seconds=1)):
+            self.assertEqual(run_due_jobs(self.jobs, 'second'), ['job'])
+        self.assertEqual(len(self.runs), 2)
+
+    def test_running_job_is_skipped_by_other_workers(self):
+        others = []
+        jobs = {'job': (lambda: others.append(run_due_jobs(self.jobs, 'second')), timedelta(hours=1))}
+        self.assertEqual(run_due_jobs(jobs, 'first'), ['job'])
+        self.assertEqual(others, [[]])
+        self.assertEqual(self.runs, [])
+
+    def test_late_worker_keeps_off_the_new_lease(self):
+        def take_over():
+            # The lease runs out mid-run and another worker takes the job
+            with self.later(JOB_LEASE + timedelta(seconds=1)):
+                acquire_job('job', 'second')
+        run_due_jobs({'job': (take_over, timedelta(hours=1))}, 'first')
+        job = ScheduledJob.objects.get()
+        self.assertEqual(job.locked_by, 'second')
+        self.assertIsNone(job.last_finished_at)
+
+    def test_failed_job_releases_the_lease(self):
+        def fail():
+            raise RuntimeError("broken")
+        with self.assertLogs('marketplace.scheduler', 'ERROR'):
+            self.assertEqual(run_due_jobs({'job': (fail, timedelta(hours=1))}, 'first'), ['job'])
+        job = ScheduledJob.objects.get()
+        self.assertEqual(job.last_result, "error: broken")
+        self.assertEqual(job.locked_by, '')
+        self.assertGreater(job.next_run_at, timezone.now())
+
+    def test_command_runs_the_due_jobs_once(self):
+        stdout = StringIO()
+        call_command('run_scheduled_jobs', once=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue().split('\n')[:-1], [f"Ran {name}" for name in JOBS])
+        stdout = StringIO()
+        call_command('run_scheduled_jobs', once=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
@@ -0,0 +1,199 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import CharField, F, Q, Prefetch, QuerySet, Subquery, Value, Window, prefetch_related_objects
+from django.db.models.functions import RowNumber
+from rest_framework.exceptions import NotFound, ValidationError
+
+from authorization.models import Organization
+from .models import Order, Equipment, Service, OrderImages, EquipmentImages, ServiceImages
+
+
+class ViewerState:
+    """
+    Liked / applied flags of the current user for a whole page of ads.
+    Resolved with one membership query per ad model on the page (plus one
+    for applied orders), so the serializers do not query per row.
+    """
+    def __init__(self, liked=None, applied=None):
+        self.liked = liked or {}
+        self.applied = applied or set()
+
+    @classmethod
+    def resolve(cls, items, request):
+        user = request.user if request else None
+        if not user or user.is_anonymous:
+            return cls()
+
+        ids_by_model = {}
+        for item in items:
+            ids_by_model.setdefault(type(item), []).append(item.pk)
+
+        liked = {}
+        for model, ids in ids_by_model.items():
+            if model not in (Order, Equipment, Service):
+                continue
+            through = model.liked_by.through
+            column = f'{model._meta.model_name}_id'
+            liked[model] = set(
+                through.objects.filter(**{f'{column}__in': ids, 'userprofile__user_id': user.id})
+                .values_list(column, flat=True)
+            )
+
+        applied = set()
+        if ids_by_model.get(Order):
+            # Same organization the serializers used to pick: the first active one founded by the user
+            active_org = Organization.objects.filter(founder__user_id=user.id, active=True).order_by('id') \
+                .values('id')[:1]
+            applied = set(
+                Order.org_applicants.through.objects.filter(order_id__in=ids_by_model[Order],
+                                                            organization_id=Subquery(active_org))
+                .values_list('order_id', flat=True)
+            )
+        return cls(liked, applied)
+
+    def is_liked(self, instance):
+        return instance.pk in self.liked.get(type(instance), ())
+
+    def is_applied(self, instance):
+        return instance.pk in self.applied
+
+
+def get_viewer_state(serializer, instance):
+    state = serializer.context.get('viewer_state')
+    if state is None:
+        state = ViewerState.resolve([instance], serializer.context.get('request'))
+    return state
+
+
+COVER_IMAGE_RELATIONS = {
+    Order: (OrderImages, 'order'),
+    Equipment: (EquipmentImages, 'equipment'),
+    Service: (ServiceImages, 'service'),
+}
+
+
+def prefetch_cover_images(items):
+    """
+    Loads only the first image of every ad on the page, one query per ad model.
+    The image is stored in the `cover_images` attribute of the instance.
+    """
+    items_by_model = {}
+    for item in items:
+        items_by_model.setdefault(type(item), []).append(item)
+
+    for model, model_items in items_by_model.items():
+        if model not in COVER_IMAGE_RELATIONS:
+            continue
+        image_model, fk_name = COVER_IMAGE_RELATIONS[model]
+        # Same image as `instance.images.first()`: the lowest id per ad
+        first_images = image_model.objects.annotate(
+            position=Window(RowNumber(), partition_by=[F(fk_name)], order_by=F('id').asc())
+        ).filter(position=1).only('id', fk_name, 'images')
+        prefetch_related_objects(model_items, Prefetch('images', queryset=first_images, to_attr='cover_images'))
+    return items
+
+
+def get_cover_image(instance):
+    if hasattr(instance, 'cover_images'):
+        return instance.cover_images[0] if instance.cover_images else None
+    return instance.images.first()
+
+
+CURSOR_ORDERING = ('-created_at', '-id')
+
+
+def encode_cursor(instance, field='created_at'):
+    value = f"{getattr(instance, field).isoformat()}|{instance.pk}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise NotFound("Invalid cursor")
+
+
+def get_ordering(queryset):
+    return tuple(queryset.query.order_by) if isinstance(queryset, QuerySet) else tuple(queryset.ordering)
+
+
+def get_keyset_page(queryset, cursor, limit, field='created_at'):
+    """
+    Returns the items after `cursor` in (-field, -id) order and the cursor
+    of the next page (None on the last page). Only querysets and AdFeeds
+    that are unordered or ordered by -field can be paged by cursor, other
+    orderings (relevance, booked_at) would be lost.
+    """
+    if not isinstance(queryset, (QuerySet, AdFeed)) or \
+            get_ordering(queryset) not in ((), (f'-{field}',), (f'-{field}', '-id')):
+        raise ValidationError({'cursor': "This list does not support cursor pagination, use page instead."})
+    try:
+        limit = max(int(limit), 1)
+    except (TypeError, ValueError):
+        limit = 10
+
+    queryset = queryset.order_by(f'-{field}', '-id')
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+
+    items = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(items[limit - 1], field) if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+class AdFeed:
+    """
+    One (-created_at, -id) ordered stream over several ad querysets.
+    The ordering and the limit/offset run in the database as a UNION ALL of
+    (type, id, created_at) rows; only the sliced rows are loaded as model
+    instances. Supports what Paginator and get_keyset_page need: filter,
+    order_by, count and slicing.
+    """
+    def __init__(self, *querysets, ordering=CURSOR_ORDERING):
+        self.querysets = querysets
+        self.ordering = ordering
+
+    def filter(self, *args, **kwargs):
+        return AdFeed(*(queryset.filter(*args, **kwargs) for queryset in self.querysets), ordering=self.ordering)
+
+    def order_by(self, *ordering):
+        return AdFeed(*self.querysets, ordering=ordering)
+
+    def get_rows(self):
+        rows = [
+            queryset.annotate(ad_type=Value(queryset.model._meta.model_name, output_field=CharField()))
+            .values_list('ad_type', 'id', 'created_at').order_by()
+            for queryset in self.querysets
+        ]
+        if not rows:
+            return []
+        return rows[0].union(*rows[1:], all=True).order_by(*self.ordering)
+
+    def count(self):
+        return self.get_rows().count() if self.querysets else 0
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        rows = self.get_rows()[key] if self.querysets else []
+        if not isinstance(key, slice):
+            return self.hydrate([rows])[0]
+        return self.hydrate(rows)
+
+    def hydrate(self, rows):
+        models = {queryset.model._meta.model_name: queryset.model for queryset in self.querysets}
+        ids_by_type = {}
+        for ad_type, pk, created_at in rows:
+            ids_by_type.setdefault(ad_type, []).append(pk)
+
+        instances = {
+            ad_type: models[ad_type].objects.select_related('author').in_bulk(ids)
+            for ad_type, ids in ids_by_type.items()
+        }
+        return [instances[ad_type][pk] for ad_type, pk, created_at in rows if pk in instances[ad_type]]
@@ -9,13 +9,16 @@ from rest_framework.generics import ListAPIView
 from job.models import Vacancy, Resume
 from job.serializers import VacancyListSerializer, ResumeListSerializer
 from monitoring.models import Employee
-from .firebase_service import send_fcm_notification
+from monitoring.services import get_org_context, has_org_permission
 from .models import Equipment, Order, Reviews, EquipmentCategory, OrderCategory, EquipmentImages, OrderImages, \
     Notification
 from .models import ServiceCategory, ServiceImages, Service
 from .serializers import *
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from .services import get_paginated_data, get_services_paginated_data, get_equipment_paginated, get_order_or_equipment
+from .services import get_paginated_data, get_services_paginated_data, get_equipment_paginated, get_order_or_equipment, \
+    paginate
+from .utils import AdFeed, ViewerState, prefetch_cover_images
+from search.services import search_queryset, federated_search
 from drf_yasg.utils import swagger_auto_schema
 from authorization.models import UserProfile, Organization
 from django.db.models import Q
@@ -26,7 +29,6 @@ from rest_framework import status
 from .models import Equipment
 from .serializers import EquipmentDetailSerializer
 from .permissions import CurrentUserOrReadOnly
-from operator import attrgetter
 from rest_framework.test import APIRequestFactory
 from django.db import transaction
 from monitoring.models import STATUS_CHOICES
@@ -87,7 +89,7 @@ class BaseOrderListView(APIView):
     def filter_queryset_by_search(self, queryset):
         search_query = self.get_search_query()
         if search_query:
-            queryset = queryset.filter(Q(title__icontains=search_query))
+            queryset = search_queryset(queryset, search_query)
         return queryset
 
     def get(self, request):
@@ -160,12 +162,10 @@ class MyReceivedOrdersListView(BaseOrderListView):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         #     return Order.objects.filter(org_work=organization).order_by('booked_at')
         # else:
-        try:
-            # organization = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            return Order.objects.filter(org_work=employee.org).order_by('booked_at')
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "Вы не ещё не состоите ни в одной компании."}, status = status.HTTP_403_FORBIDDEN)
+        return Order.objects.filter(org_work=organization).order_by('booked_at')
 
     def get_list_type(self):
         return "my-received-orders"
@@ -198,10 +198,8 @@ class MyHistoryOrdersListView(BaseOrderListView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "У вас нет активной организации."}, status = status.HTTP_403_FORBIDDEN)
         stage = self.request.query_params.get('stage')
         if stage == 'active':
@@ -257,11 +255,8 @@ class MyOrgOrdersListView(BaseOrderListView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-            # organization = user.user_profile.working_orgs.get().org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "У вас нет активной организации."}, status = status.HTTP_403_FORBIDDEN)
 
         self.stage = self.request.query_params.get('stage')
@@ -456,11 +451,8 @@ class ReceivedOrderStatusAPIView(APIView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            # organization = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "У вас нет активной организации."}, status = status.HTTP_403_FORBIDDEN)
 
         orders_data = self.get_orders_data(organization)
@@ -493,11 +485,8 @@ class OrdersHistoryListView(BaseOrderListView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            # organization = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "У вас нет активной организации."}, status = status.HTTP_403_FORBIDDEN)
 
         stage = self.request.query_params.get('stage')
@@ -601,11 +590,8 @@ class MyAppliedOrdersListView(BaseOrderListView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            # organization = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "У вас нет активной организации."}, status = status.HTTP_403_FORBIDDEN)
         return organization.applied_orders.all().order_by('-created_at')
 
@@ -1002,11 +988,8 @@ class ApplyOrderAPIView(APIView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            # organization = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "Вы не ещё не состоите ни в одной компании."}, status = status.HTTP_403_FORBIDDEN)
         if organization in order.org_applicants.all():
             return Response({'error': 'You already applied for this order.'},
@@ -1114,11 +1097,8 @@ class UpdateOrderStatusAPIView(APIView):
         # if Organization.objects.filter(founder=user.user_profile):
         #     organization = Organization.objects.filter(founder=user.user_profile, active=True).first()
         # else:
-        try:
-            # organization = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-            organization = employee.org
-        except Exception:
+        organization = get_org_context(self.request).org
+        if organization is None:
             return Response({"Error": "У вас нет активной организации."}, status = status.HTTP_403_FORBIDDEN)
 
         if order not in organization.received_orders.all():
@@ -1251,16 +1231,8 @@ class OrderAddEmployeeAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def has_permission(self, user_profile, org):
-        # Check if user is founder or owner
-        if user_profile == org.founder or user_profile == org.owner:
-            return True
-
-        # Check if user is an employee with the appropriate job title flag
-        employee = Employee.objects.filter(user=user_profile, org=org).first()
-        if employee and employee.job_title and employee.job_title.flag_add_employee:
-            return True
-
-        return False
+        # Founder, owner or an employee whose job title has the flag
+        return has_org_permission(user_profile, org, 'flag_add_employee', allow_owner=True)
 
     @swagger_auto_schema(
         operation_summary="Add employee to order",
@@ -1303,16 +1275,8 @@ class OrderRemoveEmployeeAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def has_permission(self, user_profile, org):
-        # Check if user is founder or owner
-        if user_profile == org.founder or user_profile == org.owner:
-            return True
-
-        # Check if user is an employee with the appropriate job title flag
-        employee = Employee.objects.filter(user=user_profile, org=org).first()
-        if employee and employee.job_title and employee.job_title.flag_remove_employee:
-            return True
-
-        return False
+        # Founder, owner or an employee whose job title has the flag
+        return has_org_permission(user_profile, org, 'flag_remove_employee', allow_owner=True)
 
     @swagger_auto_schema(
         operation_summary="Remove employee from order",
@@ -1490,7 +1454,7 @@ class EquipmentSearchAPIView(APIView):
     def get(self, request, *args, **kwargs):
         try:
             search_query = request.query_params.get('search', '')
-            equipments = Equipment.objects.filter(title__icontains=search_query)
+            equipments = search_queryset(Equipment.objects.all(), search_query)
         except Equipment.DoesNotExist:
             return Response({"error": "Equipment does not exist"}, status=status.HTTP_404_NOT_FOUND)
         search_equipments = get_equipment_paginated(equipments, request, "equipments-list")
@@ -1718,22 +1682,15 @@ class MyPurchasesAPIView(APIView):
         return Response(data, status=status.HTTP_200_OK)
 
     def get_paginated_response(self, queryset, request, equipments_type):
-        page_number = request.query_params.get('page', 1)
-        max_page = request.query_params.get('limit', 10)
-
-        paginator = Paginator(queryset, max_page)
-        page_obj = paginator.get_page(page_number)
+        page_obj, pagination = paginate(queryset, request)
+        prefetch_cover_images(page_obj)
 
-        serializer = EquipmentSerializer(page_obj, many=True, context={'request': request, 'equipments_type': equipments_type})
+        serializer = EquipmentSerializer(page_obj, many=True, context={'request': request, 'equipments_type': equipments_type,
+                                                                       'viewer_state': ViewerState.resolve(page_obj, request)})
 
         data = {
             'data': serializer.data,
-            'total_pages': paginator.num_pages,
-            'current_page': page_obj.number,
-            'has_next_page': page_obj.has_next(),
-            'has_prev_page': page_obj.has_previous(),
-            'next_page_number': page_obj.next_page_number() if page_obj.has_next() else None,
-            'prev_page_number': page_obj.previous_page_number() if page_obj.has_previous() else None
+            **pagination,
         }
 
         return data
@@ -1761,8 +1718,8 @@ class MyAdsListAPIView(APIView):
         elif ads == 'service':
             queryset = Service.objects.filter(author=author).order_by('-created_at')
         elif ads is None:
-            queryset = list(Equipment.objects.filter(author=author)) + list(Order.objects.filter(author=author)) + list(Service.objects.filter(author=author))
-            queryset = sorted(queryset, key=attrgetter('created_at'), reverse=True)
+            queryset = AdFeed(Equipment.objects.filter(author=author), Order.objects.filter(author=author),
+                              Service.objects.filter(author=author))
         else:
             queryset = []
 
@@ -1804,29 +1761,28 @@ class MyAdsListAPIView(APIView):
 
 class SearchAdsAPIView(APIView):
     permission_classes = [AllowAny]
+    federated_types = ['order', 'equipment', 'service', 'vacancy', 'resume']
 
     def get_search_query(self):
         return self.request.query_params.get('title', '')
 
     def filter_queryset_by_search(self, queryset, ads):
         search_query = self.get_search_query()
-        if ads in ['order', 'equipment', 'service'] and search_query:
-            queryset = queryset.filter(Q(title__icontains=search_query))
-        elif ads in ['vacancy', 'resume'] and search_query:
-            queryset = queryset.filter(Q(job_title__icontains=search_query))
+        if ads in ['order', 'equipment', 'service', 'vacancy', 'resume'] and search_query:
+            queryset = search_queryset(queryset, search_query)
         return queryset
 
     def get_orders_and_equipments(self, ads=None):
         if ads == 'order':
-            queryset = Order.objects.all().order_by('-created_at')
+            queryset = Order.objects.select_related('author').order_by('-created_at')
         elif ads == 'equipment':
-            queryset = Equipment.objects.all().order_by('-created_at')
+            queryset = Equipment.objects.select_related('author').order_by('-created_at')
         elif ads == 'service':
-            queryset = Service.objects.all().order_by('-created_at')
+            queryset = Service.objects.select_related('author').order_by('-created_at')
         elif ads == 'vacancy':
-            queryset = Vacancy.objects.all().order_by('-created_at')
+            queryset = Vacancy.objects.select_related('organization').order_by('-created_at')
         elif ads == 'resume':
-            queryset = Resume.objects.all().order_by('-created_at')
+            queryset = Resume.objects.select_related('author').order_by('-created_at')
         elif ads is None:
             queryset = []
         else:
@@ -1846,7 +1802,8 @@ class SearchAdsAPIView(APIView):
             openapi.Parameter(
                 'ads',
                 openapi.IN_QUERY,
-                description="Filter the results by the type of advertisement (order, equipment, service, vacancy, resume). If not provided, returns all.",
+                description="Filter the results by the type of advertisement (order, equipment, service, vacancy, resume). "
+                            "If not provided, searches all types at once and returns the hit count per type in `facets` (\"1000+\" past 1000).",
                 type=openapi.TYPE_STRING,
                 enum=['order', 'equipment', 'service', 'vacancy', 'resume'],
                 required=False
@@ -1862,20 +1819,44 @@ class SearchAdsAPIView(APIView):
     )
     def get(self, request, *args, **kwargs):
         ads = request.query_params.get('ads')
+        if ads is None:
+            data = self.get_federated_response(request)
+            return Response(data, status=status.HTTP_200_OK)
         queryset = self.get_orders_and_equipments(ads)
         queryset = self.filter_queryset_by_search(queryset, ads)
         data = self.get_paginated_response(queryset, request, ads)
         return Response(data, status=status.HTTP_200_OK)
 
-    def get_paginated_response(self, queryset, request, ads):
-        page_number = request.query_params.get('page', 1)
-        max_page = request.query_params.get('limit', 10)
+    def get_federated_response(self, request):
+        querysets = {ads: self.get_orders_and_equipments(ads) for ads in self.federated_types}
+        hits, facets = federated_search(querysets, self.get_search_query())
+        page_obj, pagination = paginate(hits, request)
+        items = list(page_obj)
+        prefetch_cover_images(items)
+
+        context = {'request': request, 'viewer_state': ViewerState.resolve(items, request)}
+        data = []
+        for item in items:
+            if isinstance(item, Vacancy):
+                data.append({'type': 'Vacancy', **VacancyListSerializer(item, context=context).data})
+            elif isinstance(item, Resume):
+                data.append({'type': 'Resume', **ResumeListSerializer(item, context=context).data})
+            else:
+                data.append(MyAdsSerializer(item, context=context).data)
 
-        paginator = Paginator(queryset, max_page)
-        page_obj = paginator.get_page(page_number)
+        return {
+            'data': data,
+            'facets': facets,
+            **pagination,
+        }
+
+    def get_paginated_response(self, queryset, request, ads):
+        page_obj, pagination = paginate(queryset, request)
+        prefetch_cover_images(page_obj)
 
         if ads in ['order', 'equipment', 'service']:
-            serializer = MyAdsSerializer(page_obj, many=True, context={'request': request})
+            serializer = MyAdsSerializer(page_obj, many=True, context={'request': request,
+                                                                        'viewer_state': ViewerState.resolve(page_obj, request)})
         elif ads == 'vacancy':
             serializer = VacancyListSerializer(page_obj, many=True, context={'request': request})
         elif ads == 'resume':
@@ -1885,12 +1866,7 @@ class SearchAdsAPIView(APIView):
 
         data = {
             'data': serializer.data,
-            'total_pages': paginator.num_pages,
-            'current_page': page_obj.number,
-            'has_next_page': page_obj.has_next(),
-            'has_prev_page': page_obj.has_previous(),
-            'next_page_number': page_obj.next_page_number() if page_obj.has_next() else None,
-            'prev_page_number': page_obj.previous_page_number() if page_obj.has_previous() else None
+            **pagination,
         }
 
         return data
@@ -1924,7 +1900,7 @@ class BaseServiceListView(APIView):
     def filter_queryset_by_search(self, queryset):
         search_query = self.get_search_query()
         if search_query:
-            queryset = queryset.filter(Q(title__icontains=search_query))
+            queryset = search_queryset(queryset, search_query)
         return queryset
 
     def get(self, request):
@@ -2289,8 +2265,7 @@ class LikedByUserItemsAPIView(APIView):
         elif item_type == 'service':
             queryset = author.liked_services.order_by('-created_at')
         elif item_type is None:
-            queryset = list(author.liked_orders.all()) + list(author.liked_equipment.all()) + list(author.liked_services.all())
-            queryset = sorted(queryset, key=attrgetter('created_at'), reverse=True)
+            queryset = AdFeed(author.liked_orders.all(), author.liked_equipment.all(), author.liked_services.all())
         else:
             queryset = []
 
@@ -11,6 +11,25 @@ STATUS_CHOICES = (
     ('Ожидает подтверждения', 'Ожидает подтверждения')
 )
 
+# Bit i of a permission mask is JOB_TITLE_FLAGS[i]; only append, cached masks depend on the order
+JOB_TITLE_FLAGS = (
+    'flag_create_jobtitle',
+    'flag_remove_jobtitle',
+    'flag_update_access',
+    'flag_add_employee',
+    'flag_update_order',
+    'flag_delete_order',
+    'flag_remove_employee',
+    'flag_employee_detail_access',
+    'flag_create_vacancy',
+    'flag_change_employee_job',
+)
+
+
+def get_permission_bit(flag):
+    return 1 << JOB_TITLE_FLAGS.index(flag)
+
+
 class JobTitle(models.Model):
 
     org = models.ForeignKey(Organization, verbose_name = 'org', related_name = 'jobs', on_delete = models.CASCADE)
@@ -30,6 +49,14 @@ class JobTitle(models.Model):
 
     def __str__(self):
         return "{}-{}-{}".format(self.org.title, self.title, self.slug)
+
+    @property
+    def permissions(self):
+        mask = 0
+        for bit, flag in enumerate(JOB_TITLE_FLAGS):
+            if getattr(self, flag):
+                mask |= 1 << bit
+        return mask
     
     class Meta:
         unique_together = ('org', 'title')
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Employee, JobTitle
+from .models import Employee, JobTitle, JOB_TITLE_FLAGS
 from marketplace.models import Order
 from authorization.models import Organization, UserProfile
 from authorization.models import SUBCRIPTION_CHOICES
@@ -25,24 +25,19 @@ class MyEmployeeSerializer(serializers.ModelSerializer):
     organization = serializers.ReadOnlyField(source = 'org.title')
     job_title = serializers.ReadOnlyField(source = 'job_title.title')
     job_title = serializers.ReadOnlyField(source = 'job_title.slug')
-    flag_create_jobtitle = serializers.ReadOnlyField(source = 'job_title.flag_create_jobtitle')
-    flag_remove_jobtitle = serializers.ReadOnlyField(source = 'job_title.flag_remove_jobtitle')
-    flag_update_access = serializers.ReadOnlyField(source = 'job_title.flag_update_access')
-    flag_add_employee = serializers.ReadOnlyField(source = 'job_title.flag_add_employee')
-    flag_remove_employee = serializers.ReadOnlyField(source = 'job_title.flag_remove_employee')
-    flag_update_order = serializers.ReadOnlyField(source = 'job_title.flag_update_order')
-    flag_delete_order = serializers.ReadOnlyField(source = 'job_title.flag_delete_order')
-    flag_employee_detail_access = serializers.ReadOnlyField(source = 'job_title.flag_employee_detail_access')
-    flag_create_vacancy = serializers.ReadOnlyField(source = 'job_title.flag_create_vacancy')
-    flag_change_employee_job = serializers.ReadOnlyField(source = 'job_title.flag_change_employee_job')
 
     class Meta:
         model = Employee
-        fields = ['active', 'organization', 'job_title', 'flag_create_jobtitle',
-                  'flag_remove_jobtitle', 'flag_update_access',
-                  'flag_add_employee', 'flag_remove_employee',
-                  'flag_update_order', 'flag_delete_order', 'flag_employee_detail_access',
-                  'flag_create_vacancy', 'flag_change_employee_job']
+        fields = ['active', 'organization', 'job_title']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # The JobTitle flags, decoded from its permission mask
+        if instance.job_title:
+            permissions = instance.job_title.permissions
+            for bit, flag in enumerate(JOB_TITLE_FLAGS):
+                data[flag] = bool(permissions & 1 << bit)
+        return data
 
 class MyOrganizationSerializer(serializers.ModelSerializer):
     founder = serializers.ReadOnlyField(source = 'founder.slug')    
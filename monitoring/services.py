@@ -0,0 +1,122 @@
+from django.core.cache import cache
+from django.db.models import F
+from django.utils.functional import cached_property
+
+from .models import Employee, STATUS_CHOICES, get_permission_bit
+
+ORG_CONTEXT_TTL = 300
+PERMISSIONS_TTL = 300
+
+
+class OrgContext:
+    """
+    The active organization of a user: the authorized, active Employee row
+    with its org and job title, or none of them. Ids and permission checks
+    come from the cached context; the rows are loaded on first access, once
+    per context.
+    """
+    def __init__(self, user, employee_id=None, org_id=None, job_title_id=None, founder_id=None, owner_id=None):
+        self.user = user
+        self.employee_id = employee_id
+        self.org_id = org_id
+        self.job_title_id = job_title_id
+        self.founder_id = founder_id
+        self.owner_id = owner_id
+
+    @property
+    def profile(self):
+        return self.user.user_profile
+
+    @cached_property
+    def employee(self):
+        if self.employee_id is None:
+            return None
+        return Employee.objects.select_related('org', 'job_title', 'user').filter(pk=self.employee_id).first()
+
+    @property
+    def org(self):
+        return self.employee.org if self.employee else None
+
+    @property
+    def job_title(self):
+        return self.employee.job_title if self.employee else None
+
+    def has_permission(self, flag, allow_owner=False):
+        """Whether the job title grants `flag` in the active organization; see has_org_permission."""
+        if self.employee_id is None:
+            return False
+        profile_id = self.profile.id
+        if allow_owner and profile_id in (self.founder_id, self.owner_id):
+            return True
+        return bool(get_permissions(profile_id, self.org_id) & get_permission_bit(flag))
+
+
+def get_org_context_key(user_id):
+    return f'org_context:{user_id}'
+
+
+def get_org_context(request):
+    """
+    Returns the OrgContext of the request user. It is resolved once per
+    request, shared by the view and its permission classes, and cached
+    across requests until monitoring.signals invalidates it.
+    """
+    # DRF views and permissions get a Request wrapping the same HttpRequest
+    http_request = getattr(request, '_request', request)
+    context = getattr(http_request, 'org_context', None)
+    if context is None:
+        context = http_request.org_context = resolve_org_context(request.user)
+    return context
+
+
+def resolve_org_context(user):
+    if not user or user.is_anonymous:
+        return OrgContext(user)
+
+    key = get_org_context_key(user.id)
+    fields = cache.get(key)
+    if fields is None:
+        # Only ids are cached: instances would outlive changes to the rows they were loaded from
+        fields = Employee.objects.filter(user__user_id=user.id, status=STATUS_CHOICES[0][0], active=True) \
+            .values('job_title_id', 'org_id', employee_id=F('id'), founder_id=F('org__founder_id'),
+                    owner_id=F('org__owner_id')).first() or {}
+        cache.set(key, fields, ORG_CONTEXT_TTL)
+    return OrgContext(user, **fields)
+
+
+def invalidate_org_context(user_ids):
+    cache.delete_many([get_org_context_key(user_id) for user_id in user_ids])
+
+
+def get_permissions_key(user_id, org_id):
+    return f'org_permissions:{user_id}:{org_id}'
+
+
+def get_permissions(profile_id, org_id):
+    """
+    Returns the JobTitle flags of the profile in the organization as a bitmask
+    (see JOB_TITLE_FLAGS). Cached per (profile, org) until monitoring.signals
+    invalidates it.
+    """
+    key = get_permissions_key(profile_id, org_id)
+    permissions = cache.get(key)
+    if permissions is None:
+        employee = Employee.objects.select_related('job_title').filter(user_id=profile_id, org_id=org_id).first()
+        permissions = employee.job_title.permissions if employee and employee.job_title else 0
+        cache.set(key, permissions, PERMISSIONS_TTL)
+    return permissions
+
+
+def has_org_permission(profile, org, flag, allow_owner=False):
+    """
+    Whether the job title of the profile in the organization grants `flag`.
+    With `allow_owner` the founder and the owner of the organization hold
+    every permission.
+    """
+    if allow_owner and profile.id in (org.founder_id, org.owner_id):
+        return True
+    return bool(get_permissions(profile.id, org.id) & get_permission_bit(flag))
+
+
+def invalidate_permissions(pairs):
+    cache.delete_many([get_permissions_key(profile_id, org_id) for profile_id, org_id in pairs])
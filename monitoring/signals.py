@@ -0,0 +1,32 @@
+from django.db.models.signals import post_save, post_delete, pre_delete
+
+from authorization.models import Organization, UserProfile
+from .models import Employee, JobTitle
+from .services import invalidate_org_context, invalidate_permissions
+
+
+def employee_changed(sender, instance, **kwargs):
+    # Covers switching the active organization, joining, leaving and job title changes
+    invalidate_org_context(UserProfile.objects.filter(id=instance.user_id).values_list('user_id', flat=True))
+    invalidate_permissions([(instance.user_id, instance.org_id)])
+
+
+def organization_changed(sender, instance, **kwargs):
+    # The context holds the founder and owner ids
+    invalidate_org_context(Employee.objects.filter(org=instance).values_list('user__user_id', flat=True))
+
+
+def job_title_changed(sender, instance, **kwargs):
+    employees = Employee.objects.filter(job_title=instance)
+    invalidate_org_context(employees.values_list('user__user_id', flat=True))
+    invalidate_permissions(employees.values_list('user_id', 'org_id'))
+
+
+for signal in (post_save, post_delete):
+    signal.connect(employee_changed, sender=Employee, dispatch_uid=f'org-context-employee-{signal is post_save}')
+    signal.connect(organization_changed, sender=Organization,
+                   dispatch_uid=f'org-context-organization-{signal is post_save}')
+
+# Deleting a job title sets Employee.job_title to NULL before post_delete, so collect its holders earlier
+for signal in (post_save, pre_delete):
+    signal.connect(job_title_changed, sender=JobTitle, dispatch_uid=f'org-context-job-title-{signal is post_save}')
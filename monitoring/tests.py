@@ -1,3 +1,128 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from rest_framework.request import Request
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from authorization.factories import create_organization, create_profile
+from authorization.models import User
+from job.permissions import AddVacancyEmployee
+from .models import Employee, JobTitle
+from .services import get_org_context, get_org_context_key, has_org_permission
+
+
+class OrgContextTestCase(TestCase):
+    def setUp(self):
+        # Ids are reused between tests, and so would be cached contexts
+        cache.clear()
+        self.founder = create_profile("founder")
+        self.profile = create_profile("employee")
+        self.org = create_organization(self.founder, "First")
+        self.job_title = JobTitle.objects.create(org=self.org, title="Worker", description="Worker")
+        self.employee = Employee.objects.create(user=self.profile, org=self.org, job_title=self.job_title,
+                                                active=True)
+
+    def get_request(self, profile=None):
+        request = RequestFactory().get('/')
+        request.user = User.objects.select_related('user_profile').get(pk=(profile or self.profile).user_id)
+        return request
+
+
+class OrgContextTests(OrgContextTestCase):
+    def test_context_is_resolved_once_per_request(self):
+        request = self.get_request()
+        with self.assertNumQueries(1):
+            context = get_org_context(request)
+            self.assertIs(get_org_context(request), context)
+        self.assertEqual((context.employee_id, context.org_id), (self.employee.id, self.org.id))
+
+    def test_warm_context_costs_no_queries(self):
+        get_org_context(self.get_request())
+        request = self.get_request()
+        with self.assertNumQueries(0):
+            context = get_org_context(request)
+        self.assertEqual(context.job_title_id, self.job_title.id)
+        # The rows are loaded on first use
+        with self.assertNumQueries(1):
+            self.assertEqual(context.org, self.org)
+            self.assertEqual(context.employee.job_title, self.job_title)
+
+    def test_only_ids_are_cached(self):
+        get_org_context(self.get_request())
+        cached = cache.get(get_org_context_key(self.profile.user_id))
+        self.assertTrue(all(isinstance(value, int) for value in cached.values()))
+
+    def test_request_profile_is_left_alone(self):
+        request = self.get_request()
+        profile = request.user.user_profile
+        get_org_context(request).employee
+        self.assertIs(request.user.user_profile, profile)
+
+    def test_users_without_an_active_organization(self):
+        context = get_org_context(self.get_request(create_profile("outsider")))
+        self.assertIsNone(context.employee)
+        self.assertIsNone(context.org)
+
+    def test_activating_an_organization_moves_the_context(self):
+        get_org_context(self.get_request())
+        other = create_organization(self.founder, "Second")
+        Employee.objects.create(user=self.profile, org=other)
+        client = APIClient()
+        client.force_authenticate(self.profile.user)
+        response = client.put(f'/organization/activate/{other.slug}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_org_context(self.get_request()).org_id, other.id)
+
+
+class PermissionTests(OrgContextTestCase):
+    def setUp(self):
+        super().setUp()
+        # The founder works in the organization under a job title without flags
+        self.founder_employee = Employee.objects.create(user=self.founder, org=self.org, active=True,
+                                                        job_title=JobTitle.objects.create(
+                                                            org=self.org, title="Founder", description="Founder"))
+        self.client = APIClient()
+
+    def create_job_title(self, profile):
+        self.client.force_authenticate(profile.user)
+        return self.client.post('/org-jobs/add/', {'title': "New", 'description': "New"})
+
+    def test_job_title_flag_grants_the_permission(self):
+        self.assertEqual(self.create_job_title(self.profile).status_code, 403)
+        self.job_title.flag_create_jobtitle = True
+        self.job_title.save()
+        self.assertEqual(self.create_job_title(self.profile).status_code, 201)
+
+    def test_founder_needs_the_flag_for_organization_management(self):
+        self.assertEqual(self.create_job_title(self.founder).status_code, 403)
+        self.client.force_authenticate(self.founder.user)
+        response = self.client.post('/employee/add/', {'email': "someone@example.com", 'org_slug': self.org.slug,
+                                                       'jt_slug': self.job_title.slug})
+        self.assertEqual(response.status_code, 403)
+
+    def test_founder_and_owner_may_pass_where_allowed(self):
+        request = self.get_request(self.founder)
+        context = get_org_context(request)
+        self.assertFalse(context.has_permission('flag_create_vacancy'))
+        self.assertTrue(context.has_permission('flag_create_vacancy', allow_owner=True))
+        self.assertTrue(has_org_permission(self.founder, self.org, 'flag_add_employee', allow_owner=True))
+        self.assertFalse(has_org_permission(self.profile, self.org, 'flag_add_employee', allow_owner=True))
+
+    def test_warm_permission_check_costs_no_queries(self):
+        get_org_context(self.get_request()).has_permission('flag_add_employee')
+        request = self.get_request()
+        with self.assertNumQueries(0):
+            self.assertFalse(get_org_context(request).has_permission('flag_add_employee'))
+
+    def test_job_title_changes_invalidate_the_mask(self):
+        self.assertFalse(has_org_permission(self.profile, self.org, 'flag_add_employee'))
+        self.job_title.flag_add_employee = True
+        self.job_title.save()
+        self.assertTrue(has_org_permission(self.profile, self.org, 'flag_add_employee'))
+        self.job_title.delete()
+        self.assertFalse(get_org_context(self.get_request()).has_permission('flag_add_employee'))
+
+    def test_vacancy_permission_lets_the_founder_in(self):
+        for profile, allowed in ((self.founder, True), (self.profile, False)):
+            request = Request(self.get_request(profile))
+            request.user = request._request.user
+            self.assertEqual(AddVacancyEmployee().has_permission(request, None), allowed)
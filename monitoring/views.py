@@ -1,6 +1,5 @@
 import datetime as dt
 import json
-from operator import attrgetter
 
 from django.db.models import Q
 
@@ -10,10 +9,12 @@ from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnl
 from drf_yasg.utils import swagger_auto_schema
 
 from marketplace.services import get_order_or_equipment, get_paginated_data
+from marketplace.utils import AdFeed
 
 from .serializers import *
 from .models import Employee, JobTitle
 from .models import STATUS_CHOICES
+from .services import get_org_context
 from marketplace.models import Order, Equipment, Service
 from marketplace.serializers import OrderListAPI
 from authorization.models import UserProfile, User, Organization
@@ -67,10 +68,10 @@ class UserAdsAPIView(APIView):
         elif ads == 'service':
             queryset = Service.objects.filter(author=author).order_by('-created_at')
         elif ads is None:
-            queryset = list(Equipment.objects.filter(author=author)) + list(Service.objects.filter(author=author))
+            querysets = [Equipment.objects.filter(author=author), Service.objects.filter(author=author)]
             if user.is_authenticated:
-                queryset += list(Order.objects.filter(author=author))
-            queryset = sorted(queryset, key=attrgetter('created_at'), reverse=True)
+                querysets.append(Order.objects.filter(author=author))
+            queryset = AdFeed(*querysets)
         else:
             queryset = []
 
@@ -134,9 +135,9 @@ class MyProfileAPIView(APIView):
         is_sub = False
         if sub_type == SUBCRIPTION_CHOICES[2][0] or (sub and sub > dt.datetime.now(dt.timezone.utc)):
             is_sub = True
-        empl = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0])
+        empl = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0]).select_related('org', 'job_title')
         emp_serializer = MyEmployeeSerializer(empl, many = True)
-        active_emp = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
+        active_emp = get_org_context(request).employee
         org = None
         if active_emp:
             org = active_emp.org
@@ -375,10 +376,10 @@ class CreateJobTitleAPIView(APIView):
         # if Organization.objects.filter(founder = user.user_profile):
         #     org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # else:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
-        if not employee or not employee.job_title or not employee.job_title.flag_create_jobtitle:
+        context = get_org_context(request)
+        if not context.has_permission('flag_create_jobtitle'):
             return Response({"Error": "У Вас нет прав на создание должностей!"}, status = status.HTTP_403_FORBIDDEN)
-        org = employee.org   
+        org = context.org
         if JobTitle.objects.filter(org = org, title = request.data['title']).first():
             return Response({"Error": "Должность с таким именем в организации уже существует!"}, status = status.HTTP_400_BAD_REQUEST)
         serializer = JobTitleSerializer(data = request.data, context = {'org': org})
@@ -405,7 +406,7 @@ class JobTitleAPIView(APIView):
         # if Organization.objects.filter(founder = user.user_profile):
         #     org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # else:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
+        employee = get_org_context(request).employee
         if not employee:
             return Response({"Error": "У Вас нет прав на просмотр должностей!"}, status = status.HTTP_403_FORBIDDEN)
         org = employee.org
@@ -434,10 +435,10 @@ class JobTitleAPIView(APIView):
         # if Organization.objects.filter(founder = user.user_profile):
         #     org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # else:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
-        if not employee or not employee.job_title or not employee.job_title.flag_create_jobtitle:
+        context = get_org_context(request)
+        if not context.has_permission('flag_create_jobtitle'):
             return Response({"Error": "У Вас нет прав на изменение прав должностей!"}, status = status.HTTP_403_FORBIDDEN)
-        org = employee.org     
+        org = context.org
         try:
             job_title = JobTitle.objects.get(slug = jt_slug)
         except Exception:
@@ -465,10 +466,10 @@ class JobTitleAPIView(APIView):
         # if Organization.objects.filter(founder = user.user_profile):
         #     org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # else:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
-        if not employee or not employee.job_title or not employee.job_title.flag_remove_jobtitle:
+        context = get_org_context(request)
+        if not context.has_permission('flag_remove_jobtitle'):
             return Response({"Error": "У Вас нет прав на удаление должностей!"}, status = status.HTTP_403_FORBIDDEN)
-        org = employee.org   
+        org = context.org
         try:
             job_title = JobTitle.objects.get(slug = jt_slug)
         except Exception:
@@ -479,18 +480,8 @@ class JobTitleAPIView(APIView):
         return Response({"Success": "Job title has been deleted!"}, status = status.HTTP_200_OK)
 
 def sort_for_jobs(item):
-    result = 0
-    result += item.flag_create_jobtitle
-    result += item.flag_remove_jobtitle
-    result += item.flag_update_access
-    result += item.flag_add_employee
-    result += item.flag_update_order
-    result += item.flag_delete_order
-    result += item.flag_remove_employee
-    result += item.flag_change_employee_job
-    result += item.flag_create_vacancy
-    result += item.flag_employee_detail_access
-    return result
+    # Number of flags the job title grants
+    return bin(item.permissions).count('1')
 
 class JobTitleListAPIView(APIView):
     permission_classes = [IsAuthenticated]
@@ -509,10 +500,8 @@ class JobTitleListAPIView(APIView):
         # if Organization.objects.filter(founder = user.user_profile):
         #     org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # else:
-        try:
-            # org = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-        except Exception:
+        employee = get_org_context(request).employee
+        if not employee:
             return Response({"Error": "Вы не ещё не состоите ни в одной компании или не активирована ни одна из организаций."}, status = status.HTTP_403_FORBIDDEN)
         jobs = JobTitle.objects.filter(org = employee.org)
         jobs = sorted(jobs, key = lambda item: sort_for_jobs(item), reverse = True)
@@ -535,11 +524,9 @@ class EmployeeListAPIView(APIView):
         # if Organization.objects.filter(founder = user.user_profile):
         #     org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # else:
-        try:
-            # org = user.user_profile.working_orgs.get().org
-            employee = Employee.objects.get(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True)
-        except Exception:
-                return Response({"Error": "Вы не ещё не состоите ни в одной компании или не активирована ни одна из организаций."}, status = status.HTTP_403_FORBIDDEN)
+        employee = get_org_context(request).employee
+        if not employee:
+            return Response({"Error": "Вы не ещё не состоите ни в одной компании или не активирована ни одна из организаций."}, status = status.HTTP_403_FORBIDDEN)
         employees = Employee.objects.filter(org = employee.org)
         serializer = EmployeeListSerializer(employees, many = True)
         return Response(serializer.data, status = status.HTTP_200_OK)
@@ -560,7 +547,7 @@ class EmployeeDetailAPIView(APIView):
         user = request.user
         # cur_org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # if not cur_org:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
+        employee = get_org_context(request).employee
         if not employee:
             return Response({"Error": "Вы не состоите ни в одной организации!"}, status = status.HTTP_403_FORBIDDEN)
         cur_org = employee.org
@@ -589,10 +576,10 @@ class EmployeeDetailAPIView(APIView):
         user = request.user
         # cur_org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # if not cur_org:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
-        if not employee or not employee.job_title or not employee.job_title.flag_change_employee_job:
+        context = get_org_context(request)
+        if not context.has_permission('flag_change_employee_job'):
             return Response({"Error": "У Вас нет прав на изменение сотрудников!"}, status = status.HTTP_403_FORBIDDEN)
-        cur_org = employee.org
+        cur_org = context.org
         jt_slug = request.data['jt_slug']
         try:
             target_user = UserProfile.objects.get(slug = employee_slug)
@@ -626,10 +613,10 @@ class EmployeeDetailAPIView(APIView):
         user = request.user
         # cur_org = Organization.objects.filter(founder = user.user_profile, active = True).first()
         # if not cur_org:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
-        if not employee or not employee.job_title or not employee.job_title.flag_remove_employee:
+        context = get_org_context(request)
+        if not context.has_permission('flag_remove_employee'):
             return Response({"Error": "У Вас нет прав на удаление сотрудников!"}, status = status.HTTP_403_FORBIDDEN)
-        cur_org = employee.org
+        cur_org = context.org
         try:
             target_user = UserProfile.objects.get(slug = employee_slug)
         except Exception:
@@ -740,7 +727,7 @@ class OrderEmployeesAPIView(APIView):
         except Order.DoesNotExist:
             return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
         user = request.user
-        employee = Employee.objects.filter(user=user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
+        employee = get_org_context(request).employee
         if not employee:
             return Response({"Error": "Вы не состоите ни в одной организации!"}, status = status.HTTP_403_FORBIDDEN)
         cur_org = employee.org
@@ -771,10 +758,10 @@ class EmployeeCreateAPIView(APIView):
         user = request.user
         # cur_org = Organization.objects.filter(founder = user.user_profile).exists()
         # if not cur_org:
-        employee = Employee.objects.filter(user = user.user_profile, status = STATUS_CHOICES[0][0], active = True).first()
-        if not employee or not employee.job_title or not employee.job_title.flag_add_employee:
+        context = get_org_context(request)
+        if not context.has_permission('flag_add_employee'):
             return Response({"Error": "У Вас нет прав на добавление сотрудников!"}, status = status.HTTP_403_FORBIDDEN)
-        cur_org = employee.org
+        cur_org = context.org
         email = request.data['email']
         org_slug = request.data['org_slug']
         jt_slug = request.data['jt_slug']
@@ -59,16 +59,80 @@
 #         self.get_notifications()
 
 import json
+from urllib.parse import parse_qs
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from django.utils import timezone
 
-from .models import Notifications
+from .services import (NOTIFICATION_DELTA_LIMIT, get_last_sequence, get_notifications_after,
+                       get_unread_notifications, get_notifications_group)
 from authorization.models import UserProfile
 
+class NotificationStream:
+    """
+    Pushes the notifications of one user to a socket through `send`, which
+    delivers a dict to the client.
+    A client that starts with `last_sequence=<n>` (0 when it has nothing)
+    gets the notifications after n and then only the new ones, each message
+    carrying the latest sequence. When it is too far behind it gets a snapshot
+    of the unread list instead. Clients without `last_sequence` get the whole
+    unread list on every change.
+    """
+
+    def __init__(self, consumer, recipient_id, send, last_sequence=None):
+        self.consumer = consumer
+        self.recipient_id = recipient_id
+        self.send = send
+        self.group_name = get_notifications_group(recipient_id)
+        try:
+            self.last_sequence = int(last_sequence) if last_sequence is not None else None
+        except (ValueError, TypeError):
+            self.last_sequence = None
+
+    async def join(self):
+        await self.consumer.channel_layer.group_add(self.group_name, self.consumer.channel_name)
+        await self.send_changes()
+
+    async def leave(self):
+        await self.consumer.channel_layer.group_discard(self.group_name, self.consumer.channel_name)
+
+    async def send_changes(self):
+        last_sequence = await database_sync_to_async(get_last_sequence)(self.recipient_id)
+        if self.last_sequence is not None and 0 <= last_sequence - self.last_sequence <= NOTIFICATION_DELTA_LIMIT:
+            notifications = await database_sync_to_async(get_notifications_after)(
+                self.recipient_id, self.last_sequence, last_sequence
+            )
+            await self.send_notifications("delta", notifications, last_sequence)
+        else:
+            notifications = await database_sync_to_async(get_unread_notifications)(self.recipient_id, last_sequence)
+            await self.send_notifications("snapshot", notifications, last_sequence)
+
+    async def send_notifications(self, kind, notifications, sequence):
+        if self.last_sequence is not None:
+            self.last_sequence = sequence
+        await self.send({"type": kind, "sequence": sequence, "notifications": notifications})
+
+    async def notification_created(self, event):
+        notification = event["notification"]
+        if self.last_sequence is None or notification["sequence"] > self.last_sequence + 1:
+            # Old client or missed notifications: let send_changes pick delta or snapshot
+            await self.send_changes()
+        elif notification["sequence"] == self.last_sequence + 1:
+            await self.send_notifications("delta", [notification], notification["sequence"])
+
+    async def receive(self, data):
+        # {"last_sequence": n} resumes from n on an open socket
+        try:
+            self.last_sequence = int(data["last_sequence"])
+        except (ValueError, TypeError, KeyError):
+            return
+        await self.send_changes()
+
+
 class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    ws/notifications/<user_id>/?last_sequence=<n>: one NotificationStream.
+    """
 
     async def connect(self):
         print("WebSocket connected!")
@@ -76,13 +140,19 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         self.user = await self.get_user(self.user_id)
         jwt_user = self.scope['user']
         # print(self.user)
-        self.user_group_name = f"{self.user_id}-notifications"
+        self.stream = None
         jwt_user = await self.get_jwt_user(jwt_user)
         if self.user == jwt_user:
-            await self.channel_layer.group_add(self.user_group_name, self.channel_name)
-
+            self.stream = NotificationStream(self, self.user.id, self.send_data, self.get_client_sequence())
             await self.accept()
-            await self.get_notifications()
+            await self.stream.join()
+
+    def get_client_sequence(self):
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(params['last_sequence'][0])
+        except (KeyError, ValueError):
+            return None
 
     @database_sync_to_async
     def get_jwt_user(self, jwt_user):
@@ -94,35 +164,25 @@ class NotificationConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         # Disconnect from group
-        self.channel_layer.group_discard(
-            self.user_group_name, self.channel_name
-        )
-
-    async def get_notifications(self):
-        notifications = await sync_to_async(list, thread_sensitive=True)(
-            Notifications.objects.filter(recipient=self.user.id, read = False).order_by('-timestamp')
-        )
-        notifications_list = []
-        for notification in notifications:
-            notification.timestamp = timezone.localtime(notification.timestamp)
-            notifications_list.append(
-                {
-                    "id": notification.id,
-                    "type": notification.type,
-                    "title": notification.title,
-                    "description": notification.description,
-                    "target_slug": notification.target_slug,
-                    "timestamp": notification.timestamp.strftime("%d.%m.%Y %H:%M"),
-                }
-            )
-        await self.send(text_data=json.dumps({"notifications": notifications_list}))
+        if self.stream:
+            await self.stream.leave()
+
+    async def send_data(self, data):
+        await self.send(text_data=json.dumps(data))
+
+    async def notification_created(self, event):
+        await self.stream.notification_created(event)
 
     async def get_notifications_handler(self, event):
-        await self.get_notifications()
+        await self.stream.send_changes()
 
     async def receive(self, text_data):
-        ...
-        # text_data_json = json.loads(text_data)
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if isinstance(data, dict):
+            await self.stream.receive(data)
 
     async def receive_get_notifications(self, event):
-        await self.get_notifications()
\ No newline at end of file
+        await self.stream.send_changes()
@@ -0,0 +1,34 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from notif.services import OUTBOX_BATCH_SIZE, dispatch_outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Publishes committed notification outbox events to the channel layer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait when the outbox is empty.")
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE)
+        parser.add_argument('--once', action='store_true',
+                            help="Publish the pending events and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                handled = dispatch_outbox(options['batch_size'])
+            except Exception:
+                logger.exception("Notification outbox dispatch failed")
+                handled = 0
+                if options['once']:
+                    raise
+
+            if not handled:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,37 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from notif.push import PUSH_BATCH_SIZE, PUSH_WORKERS, create_push_executor, dispatch_push_batch, get_transport
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Sends queued push messages as FCM multicasts on a worker pool, retrying transient failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait when no push is due.")
+        parser.add_argument('--batch-size', type=int, default=PUSH_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=PUSH_WORKERS)
+        parser.add_argument('--once', action='store_true',
+                            help="Send the due pushes and exit.")
+
+    def handle(self, *args, **options):
+        transport = get_transport()
+        with create_push_executor(options['workers']) as executor:
+            while True:
+                try:
+                    stats = dispatch_push_batch(transport, options['batch_size'], executor)
+                except Exception:
+                    logger.exception("Push dispatch failed")
+                    stats = {}
+                    if options['once']:
+                        raise
+
+                if not any(stats.values()):
+                    if options['once']:
+                        return
+                    time.sleep(options['interval'])
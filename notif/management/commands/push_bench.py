@@ -0,0 +1,74 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from authorization.models import User, UserProfile
+from notif.models import DeviceToken, PushOutbox
+from notif.push import FakeTransport, create_push_executor, dispatch_push_batch, queue_push
+
+
+class Command(BaseCommand):
+    help = ("Queues pushes for fake devices on a throwaway test database and dispatches them through "
+            "FakeTransport, reporting throughput, invalid token cleanup and retries.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=20000, help="Pushes queued.")
+        parser.add_argument('--payloads', type=int, default=4, help="Distinct payloads among the pushes.")
+        parser.add_argument('--invalid', type=float, default=0.05, help="Share of invalid device tokens.")
+        parser.add_argument('--failure-rate', type=float, default=0.1, help="Transient failure rate per token.")
+        parser.add_argument('--latency', type=float, default=0.1, help="Seconds per multicast call.")
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            report = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, value in report.items():
+            self.stdout.write(f"{name}: {value}")
+
+    def run(self, options):
+        user = User.objects.create_user("pushbench@example.com", "password")
+        profile = UserProfile.objects.filter(user=user).first() or UserProfile.objects.create(
+            user=user, first_name="push", last_name="bench")
+
+        invalid_every = round(1 / options['invalid']) if options['invalid'] else 0
+        tokens = [f"{'invalid' if invalid_every and number % invalid_every == 0 else 'device'}-{number}"
+                  for number in range(options['items'])]
+        DeviceToken.objects.bulk_create([DeviceToken(profile=profile, token=token) for token in tokens],
+                                        batch_size=1000)
+        queue_push((token, {'title': f"Payload {number % options['payloads']}", 'body': "Benchmark"})
+                   for number, token in enumerate(tokens))
+
+        transport = FakeTransport(latency=options['latency'], failure_rate=options['failure_rate'], seed=1)
+        totals = {'sent': 0, 'invalid': 0, 'retried': 0, 'dropped': 0}
+        rounds = 0
+        started = time.perf_counter()
+        with create_push_executor(options['workers']) as executor:
+            while PushOutbox.objects.exists():
+                stats = dispatch_push_batch(transport, options['batch_size'], executor)
+                rounds += 1
+                for name, value in stats.items():
+                    totals[name] += value
+                if not any(stats.values()):
+                    # Skip the retry backoff
+                    PushOutbox.objects.update(next_attempt_at=timezone.now())
+        elapsed = time.perf_counter() - started
+
+        return {
+            'pushes queued': options['items'],
+            'multicast calls': transport.multicasts,
+            'dispatch rounds': rounds,
+            **totals,
+            'device tokens left': DeviceToken.objects.count(),
+            'elapsed sec': round(elapsed, 2),
+            'pushes/sec': round(options['items'] / elapsed),
+            # One messaging.send per push, as send_fcm_notification did
+            'sequential send estimate sec': round(options['items'] * options['latency'], 1),
+        }
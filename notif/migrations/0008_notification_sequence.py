@@ -0,0 +1,55 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def assign_sequences(apps, schema_editor):
+    Notifications = apps.get_model('notif', 'Notifications')
+    NotificationState = apps.get_model('notif', 'NotificationState')
+
+    last_sequences = {}
+    notifications = []
+    for notification in Notifications.objects.order_by('recipient_id', 'timestamp', 'id').only('id', 'recipient_id'):
+        notification.sequence = last_sequences.get(notification.recipient_id, 0) + 1
+        last_sequences[notification.recipient_id] = notification.sequence
+        notifications.append(notification)
+
+    Notifications.objects.bulk_update(notifications, ['sequence'], batch_size=1000)
+    NotificationState.objects.bulk_create([
+        NotificationState(recipient_id=recipient_id, last_sequence=last_sequence)
+        for recipient_id, last_sequence in last_sequences.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0008_userprofile_device_token'),
+        ('notif', '0007_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_sequence', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notifications',
+            name='sequence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='notificationstate',
+            name='recipient',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='notification_state', to='authorization.userprofile'),
+        ),
+        migrations.RunPython(assign_sequences, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notifications',
+            constraint=models.UniqueConstraint(fields=('recipient', 'sequence'), name='notification_recipient_sequence'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:26
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def set_read_watermarks(apps, schema_editor):
+    Notifications = apps.get_model('notif', 'Notifications')
+    NotificationState = apps.get_model('notif', 'NotificationState')
+
+    first_unread = dict(
+        Notifications.objects.filter(read=False).values('recipient_id')
+        .annotate(first=Min('sequence')).values_list('recipient_id', 'first')
+    )
+    states = list(NotificationState.objects.all())
+    for state in states:
+        state.read_sequence = first_unread[state.recipient_id] - 1 if state.recipient_id in first_unread \
+            else state.last_sequence
+    NotificationState.objects.bulk_update(states, ['read_sequence'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notif', '0008_notification_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationstate',
+            name='read_sequence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(set_read_watermarks, migrations.RunPython.noop),
+    ]
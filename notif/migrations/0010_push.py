@@ -0,0 +1,54 @@
+# Generated by Django 4.2.5 on 2026-10-17 18:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def copy_device_tokens(apps, schema_editor):
+    UserProfile = apps.get_model('authorization', 'UserProfile')
+    DeviceToken = apps.get_model('notif', 'DeviceToken')
+
+    tokens = {}
+    for profile_id, token in UserProfile.objects.exclude(device_token__isnull=True).exclude(device_token='') \
+            .order_by('id').values_list('id', 'device_token'):
+        # A token moved to another account belongs to the newest profile
+        tokens[token] = profile_id
+    DeviceToken.objects.bulk_create([DeviceToken(profile_id=profile_id, token=token)
+                                     for token, profile_id in tokens.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0009_emailoutbox'),
+        ('notif', '0009_notification_read_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=255)),
+                ('payload', models.JSONField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['next_attempt_at'], name='push_outbox_next_attempt_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DeviceToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=255, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='device_tokens', to='authorization.userprofile')),
+            ],
+        ),
+        migrations.RunPython(copy_device_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-17 18:52
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notif', '0010_push'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationoutbox',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='notificationoutbox',
+            index=models.Index(fields=['next_attempt_at'], name='notif_outbox_next_attempt_idx'),
+        ),
+    ]
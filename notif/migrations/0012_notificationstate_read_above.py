@@ -0,0 +1,32 @@
+from django.db import migrations, models
+from django.db.models import Count, F, Q
+
+
+def set_read_above(apps, schema_editor):
+    Notifications = apps.get_model('notif', 'Notifications')
+    NotificationState = apps.get_model('notif', 'NotificationState')
+
+    unread = dict(
+        Notifications.objects.filter(read=False, sequence__gt=F('recipient__notification_state__read_sequence'))
+        .values('recipient_id').annotate(count=Count('id')).values_list('recipient_id', 'count')
+    )
+    states = list(NotificationState.objects.filter(~Q(last_sequence=F('read_sequence'))))
+    for state in states:
+        state.read_above = state.last_sequence - state.read_sequence - unread.get(state.recipient_id, 0)
+    NotificationState.objects.bulk_update(states, ['read_above'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notif', '0011_notification_outbox_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationstate',
+            name='read_above',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(set_read_above, migrations.RunPython.noop),
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 
 # Create your models here.
 from django.db import models
+from django.utils import timezone
 from authorization.models import UserProfile, Organization
 
 TYPE_CHOICES = (
@@ -20,7 +21,70 @@ class Notifications(models.Model):
     read = models.BooleanField(default=False)
     recipient = models.ForeignKey(UserProfile, related_name='recipient_name', on_delete=models.CASCADE)
     target_slug = models.SlugField(null = True, blank = True)
+    sequence = models.PositiveBigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.title} - {self.recipient.id}"
-    
\ No newline at end of file
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipient', 'sequence'], name='notification_recipient_sequence'),
+        ]
+
+
+class NotificationState(models.Model):
+    # Per-user counter behind Notifications.sequence and the "read up to" watermark
+    recipient = models.OneToOneField(UserProfile, related_name='notification_state', on_delete=models.CASCADE)
+    last_sequence = models.PositiveBigIntegerField(default=0)
+    read_sequence = models.PositiveBigIntegerField(default=0)
+    # Notifications above the watermark read one by one or deleted: unread = last - read_sequence - read_above
+    read_above = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.recipient.id} - {self.last_sequence}"
+    
+
+class NotificationOutbox(models.Model):
+    # Channel layer events written in the same transaction as their notification
+    # and published after commit by the `dispatch_notifications` command
+    group = models.CharField(max_length=255)
+    event = models.JSONField()
+    # Pushed forward while a dispatcher publishes the row
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], name='notif_outbox_next_attempt_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.group} - {self.event.get('type')}"
+
+
+class DeviceToken(models.Model):
+    # FCM registration tokens, one per device of the user
+    profile = models.ForeignKey(UserProfile, related_name='device_tokens', on_delete=models.CASCADE)
+    token = models.CharField(max_length=255, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.profile.id} - {self.token[:16]}"
+
+
+class PushOutbox(models.Model):
+    # Push messages waiting for the `dispatch_push` command, retried with backoff on transient failures
+    token = models.CharField(max_length=255)
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], name='push_outbox_next_attempt_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.token[:16]} - {self.payload.get('title')}"
@@ -0,0 +1,205 @@
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from authorization.authentication import invalidate_auth_user
+from authorization.models import UserProfile
+from .models import DeviceToken, PushOutbox
+
+logger = logging.getLogger(__name__)
+
+# FCM accepts at most 500 tokens per multicast message
+MULTICAST_SIZE = 500
+PUSH_BATCH_SIZE = 5000
+PUSH_WORKERS = 8
+PUSH_MAX_ATTEMPTS = 6
+PUSH_RETRY_DELAY = 10
+PUSH_MAX_RETRY_DELAY = 1800
+# Seconds a claimed batch is hidden from other workers, longer than sending it takes
+PUSH_LEASE = 300
+
+# Outcome of one token of a multicast send
+SENT = 'sent'
+INVALID = 'invalid'
+RETRY = 'retry'
+
+
+class FCMTransport:
+    """Sends multicast messages through Firebase Cloud Messaging."""
+
+    def __init__(self):
+        import firebase_admin
+        from firebase_admin import exceptions, messaging
+
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            # Credentials come from GOOGLE_APPLICATION_CREDENTIALS
+            firebase_admin.initialize_app()
+        self.messaging = messaging
+        self.invalid_errors = (messaging.UnregisteredError, messaging.SenderIdMismatchError,
+                               exceptions.InvalidArgumentError)
+
+    def send_multicast(self, tokens, payload):
+        message = self.messaging.MulticastMessage(
+            notification=self.messaging.Notification(title=payload.get('title'), body=payload.get('body')),
+            data=payload.get('data'),
+            tokens=tokens,
+        )
+        response = self.messaging.send_each_for_multicast(message)
+        results = []
+        for result in response.responses:
+            if result.success:
+                results.append((SENT, None))
+            elif isinstance(result.exception, self.invalid_errors):
+                results.append((INVALID, str(result.exception)))
+            else:
+                # Quota, unavailable and internal errors are worth another attempt
+                results.append((RETRY, str(result.exception)))
+        return results
+
+
+class FakeTransport:
+    """
+    Offline stand-in for FCMTransport: every multicast takes `latency`
+    seconds, tokens starting with "invalid" are rejected, and each other
+    token fails transiently with `failure_rate` probability.
+    """
+    def __init__(self, latency=0.05, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.multicasts = 0
+        self.sent = []
+
+    def send_multicast(self, tokens, payload):
+        time.sleep(self.latency)
+        results = []
+        with self.lock:
+            self.multicasts += 1
+            for token in tokens:
+                if token.startswith('invalid'):
+                    results.append((INVALID, "Requested entity was not found."))
+                elif self.random.random() < self.failure_rate:
+                    results.append((RETRY, "The service is currently unavailable."))
+                else:
+                    self.sent.append((token, payload))
+                    results.append((SENT, None))
+        return results
+
+
+def get_transport():
+    return import_string(settings.PUSH_TRANSPORT)()
+
+
+def queue_push(items):
+    """
+    Adds (token, payload) items to the push outbox; payload is a dict with
+    "title", "body" and optional string "data". Returns the number queued.
+    """
+    rows = PushOutbox.objects.bulk_create([PushOutbox(token=token, payload=payload) for token, payload in items],
+                                          batch_size=1000)
+    return len(rows)
+
+
+def queue_push_to_profiles(profiles, payload):
+    tokens = DeviceToken.objects.filter(profile__in=profiles).values_list('token', flat=True)
+    return queue_push((token, payload) for token in tokens)
+
+
+def get_retry_delay(attempts):
+    return timedelta(seconds=min(PUSH_RETRY_DELAY * 2 ** (attempts - 1), PUSH_MAX_RETRY_DELAY))
+
+
+def get_multicasts(rows):
+    # Rows with the same payload share a multicast message
+    rows_by_payload = {}
+    for row in rows:
+        rows_by_payload.setdefault(json.dumps(row.payload, sort_keys=True), []).append(row)
+    for payload_rows in rows_by_payload.values():
+        for start in range(0, len(payload_rows), MULTICAST_SIZE):
+            yield payload_rows[start:start + MULTICAST_SIZE]
+
+
+def send_multicast(transport, rows):
+    try:
+        return transport.send_multicast([row.token for row in rows], rows[0].payload)
+    except Exception as e:
+        logger.warning("Push multicast of %s tokens failed: %s", len(rows), e)
+        return [(RETRY, str(e))] * len(rows)
+
+
+def dispatch_push_batch(transport, batch_size=PUSH_BATCH_SIZE, executor=None):
+    """
+    Sends one batch of due outbox rows as multicasts of up to MULTICAST_SIZE
+    tokens, in parallel on `executor`. The batch is claimed for PUSH_LEASE
+    seconds and sent outside of any transaction; a worker that dies mid-batch
+    leaves it to the next one once the lease runs out. Sent rows are deleted;
+    rejected tokens are deleted together with their DeviceToken; transient
+    failures are retried with backoff until PUSH_MAX_ATTEMPTS.
+    Returns {"sent", "invalid", "retried", "dropped"} counts.
+    """
+    stats = {'sent': 0, 'invalid': 0, 'retried': 0, 'dropped': 0}
+    with transaction.atomic():
+        rows = list(PushOutbox.objects.select_for_update(skip_locked=True)
+                    .filter(next_attempt_at__lte=timezone.now()).order_by('next_attempt_at', 'id')[:batch_size])
+        if not rows:
+            return stats
+        # Other workers skip the claimed rows until the lease runs out
+        PushOutbox.objects.filter(id__in=[row.id for row in rows]) \
+            .update(next_attempt_at=timezone.now() + timedelta(seconds=PUSH_LEASE))
+
+    multicasts = list(get_multicasts(rows))
+    if executor is None:
+        results = [send_multicast(transport, multicast) for multicast in multicasts]
+    else:
+        results = list(executor.map(lambda multicast: send_multicast(transport, multicast), multicasts))
+
+    done, invalid_tokens, retries = [], set(), []
+    for multicast, multicast_results in zip(multicasts, results):
+        for row, (outcome, error) in zip(multicast, multicast_results):
+            if outcome == SENT:
+                done.append(row.id)
+                stats['sent'] += 1
+            elif outcome == INVALID:
+                done.append(row.id)
+                invalid_tokens.add(row.token)
+                stats['invalid'] += 1
+            elif row.attempts + 1 >= PUSH_MAX_ATTEMPTS:
+                logger.warning("Dropping push %s after %s attempts: %s", row.id, row.attempts + 1, error)
+                done.append(row.id)
+                stats['dropped'] += 1
+            else:
+                row.attempts += 1
+                row.next_attempt_at = timezone.now() + get_retry_delay(row.attempts)
+                row.last_error = error or ''
+                retries.append(row)
+                stats['retried'] += 1
+
+    user_ids = []
+    with transaction.atomic():
+        PushOutbox.objects.filter(id__in=done).delete()
+        PushOutbox.objects.bulk_update(retries, ['attempts', 'next_attempt_at', 'last_error'], batch_size=1000)
+        if invalid_tokens:
+            DeviceToken.objects.filter(token__in=invalid_tokens).delete()
+            user_ids = list(UserProfile.objects.filter(device_token__in=invalid_tokens)
+                            .values_list('user_id', flat=True))
+            UserProfile.objects.filter(user_id__in=user_ids).update(device_token=None)
+    # The update skips the signals that drop the cached users of authorization
+    for user_id in user_ids:
+        invalidate_auth_user(user_id)
+    return stats
+
+
+def create_push_executor(workers=PUSH_WORKERS):
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='push')
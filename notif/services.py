@@ -0,0 +1,231 @@
+import asyncio
+import json
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import DeviceToken, Notifications, NotificationOutbox, NotificationState
+from .push import queue_push, queue_push_to_profiles
+
+OUTBOX_BATCH_SIZE = 500
+# Seconds a claimed batch is hidden from other dispatchers, longer than publishing it takes
+OUTBOX_LEASE = 60
+
+# A reconnecting client further behind than this gets a full snapshot instead of a delta
+NOTIFICATION_DELTA_LIMIT = 100
+
+
+def get_notifications_group(recipient_id):
+    return f"{recipient_id}-notifications"
+
+
+def serialize_notification(notification):
+    return {
+        "id": notification.id,
+        "sequence": notification.sequence,
+        "type": notification.type,
+        "title": notification.title,
+        "description": notification.description,
+        "target_slug": notification.target_slug,
+        "timestamp": timezone.localtime(notification.timestamp).strftime("%d.%m.%Y %H:%M"),
+    }
+
+
+def get_push_payload(notification):
+    # FCM data values must be strings; notifications sent to many recipients share the payload and the multicast
+    return {
+        "title": notification.title,
+        "body": notification.description,
+        "data": {"type": notification.type, "target_slug": notification.target_slug or ""},
+    }
+
+
+def create_notification(recipient, title, description, type='Order', target_slug=None):
+    """
+    Creates the notification with the recipient's next sequence number,
+    together with the outbox event that pushes it to the recipient's
+    notification socket and the push messages to the recipient's devices.
+    Nothing is sent from the request.
+    """
+    with transaction.atomic():
+        state, created = NotificationState.objects.select_for_update().get_or_create(recipient=recipient)
+        state.last_sequence += 1
+        state.save(update_fields=['last_sequence'])
+
+        notification = Notifications.objects.create(
+            type=type,
+            title=title,
+            description=description,
+            recipient=recipient,
+            target_slug=target_slug,
+            sequence=state.last_sequence
+        )
+        NotificationOutbox.objects.create(
+            group=get_notifications_group(recipient.id),
+            event={"type": "notification_created", "notification": serialize_notification(notification)},
+        )
+        queue_push_to_profiles([recipient], get_push_payload(notification))
+    return notification
+
+
+def create_notifications(notifications):
+    """
+    Bulk version of create_notification for unsaved Notifications instances.
+    Sequences are assigned per recipient, and the notifications, their
+    outbox events, the recipients' counters and device tokens and the push
+    messages take one query each.
+    """
+    notifications = list(notifications)
+    if not notifications:
+        return notifications
+
+    recipient_ids = {notification.recipient_id for notification in notifications}
+    with transaction.atomic():
+        NotificationState.objects.bulk_create([NotificationState(recipient_id=recipient_id)
+                                               for recipient_id in recipient_ids], ignore_conflicts=True)
+        states = NotificationState.objects.select_for_update().filter(recipient_id__in=recipient_ids) \
+            .order_by('recipient_id').in_bulk(field_name='recipient_id')
+        for notification in notifications:
+            state = states[notification.recipient_id]
+            state.last_sequence += 1
+            notification.sequence = state.last_sequence
+        NotificationState.objects.bulk_update(states.values(), ['last_sequence'])
+
+        Notifications.objects.bulk_create(notifications)
+        NotificationOutbox.objects.bulk_create([
+            NotificationOutbox(
+                group=get_notifications_group(notification.recipient_id),
+                event={"type": "notification_created", "notification": serialize_notification(notification)},
+            )
+            for notification in notifications
+        ])
+
+        payloads = {}
+        for notification in notifications:
+            payloads.setdefault(notification.recipient_id, []).append(get_push_payload(notification))
+        tokens = DeviceToken.objects.filter(profile_id__in=recipient_ids).values_list('profile_id', 'token')
+        queue_push((token, payload) for profile_id, token in tokens for payload in payloads[profile_id])
+    return notifications
+
+
+def get_last_sequence(recipient_id):
+    return NotificationState.objects.filter(recipient_id=recipient_id).values_list('last_sequence', flat=True).first() or 0
+
+
+def get_notifications_after(recipient_id, sequence, up_to):
+    notifications = Notifications.objects.filter(recipient_id=recipient_id, sequence__gt=sequence,
+                                                 sequence__lte=up_to).order_by('sequence')
+    return [serialize_notification(notification) for notification in notifications]
+
+
+def get_unread_notifications(recipient_id, up_to):
+    notifications = Notifications.objects.filter(recipient_id=recipient_id, read=False,
+                                                 sequence__lte=up_to).order_by('-timestamp')
+    return [serialize_notification(notification) for notification in notifications]
+
+
+def mark_notifications_read(recipient, up_to_sequence=None):
+    """
+    Marks the recipient's notifications up to `up_to_sequence` (all by
+    default) as read with a single UPDATE and moves the read watermark.
+    Returns the number of notifications marked.
+    """
+    with transaction.atomic():
+        state, created = NotificationState.objects.select_for_update().get_or_create(recipient=recipient)
+        up_to = state.last_sequence if up_to_sequence is None else min(up_to_sequence, state.last_sequence)
+        # Everything up to the old watermark is already read
+        updated = Notifications.objects.filter(recipient=recipient, read=False, sequence__gt=state.read_sequence,
+                                               sequence__lte=up_to).update(read=True)
+        if up_to > state.read_sequence:
+            # The rest of the passed range was read one by one or deleted
+            state.read_above -= up_to - state.read_sequence - updated
+            state.read_sequence = up_to
+            state.save(update_fields=['read_sequence', 'read_above'])
+    return updated
+
+
+def settle_notification(recipient, notification_id, delete=False):
+    """
+    Marks one notification of the recipient as read, or deletes it, and
+    counts it in `read_above` when it was unread above the watermark.
+    Returns False when the recipient has no such notification (or, unless
+    deleting, no such unread one).
+    """
+    with transaction.atomic():
+        state, created = NotificationState.objects.select_for_update().get_or_create(recipient=recipient)
+        notification = Notifications.objects.filter(id=notification_id, recipient=recipient) \
+            .only('id', 'sequence', 'read').first()
+        if notification is None or (notification.read and not delete):
+            return False
+
+        if delete:
+            notification.delete()
+        else:
+            Notifications.objects.filter(id=notification.id).update(read=True)
+        if not notification.read and notification.sequence > state.read_sequence:
+            NotificationState.objects.filter(id=state.id).update(read_above=F('read_above') + 1)
+    return True
+
+
+def delete_notifications(recipient):
+    with transaction.atomic():
+        state, created = NotificationState.objects.select_for_update().get_or_create(recipient=recipient)
+        Notifications.objects.filter(recipient=recipient).delete()
+        # Nothing is left to be unread
+        state.read_sequence, state.read_above = state.last_sequence, 0
+        state.save(update_fields=['read_sequence', 'read_above'])
+
+
+def get_unread_count(recipient_id):
+    # Counted from the watermark alone, without reading the notifications
+    return NotificationState.objects.filter(recipient_id=recipient_id).values_list(
+        Greatest(F('last_sequence') - F('read_sequence') - F('read_above'), 0), flat=True).first() or 0
+
+
+async def publish_events(channel_layer, events):
+    # Groups are published concurrently; events of one group keep their order
+    events_by_group = {}
+    for group, event in events:
+        events_by_group.setdefault(group, []).append(event)
+
+    async def publish_group(group, group_events):
+        for event in group_events:
+            await channel_layer.group_send(group, event)
+
+    await asyncio.gather(*(publish_group(group, group_events) for group, group_events in events_by_group.items()))
+
+
+def dispatch_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Publishes one batch of committed outbox events and deletes them.
+    The batch is claimed for OUTBOX_LEASE seconds and published outside of
+    any transaction; a failed publish releases it, a dispatcher that dies
+    leaves it to the next one once the lease runs out.
+    Identical events for the same group are sent once.
+    Returns the number of outbox rows handled.
+    """
+    with transaction.atomic():
+        rows = list(NotificationOutbox.objects.select_for_update(skip_locked=True)
+                    .filter(next_attempt_at__lte=timezone.now()).order_by('id')[:batch_size])
+        if not rows:
+            return 0
+        # Other dispatchers skip the claimed rows until the lease runs out
+        claimed = NotificationOutbox.objects.filter(id__in=[row.id for row in rows])
+        claimed.update(next_attempt_at=timezone.now() + timedelta(seconds=OUTBOX_LEASE))
+
+    events = {}
+    for row in rows:
+        events.setdefault((row.group, json.dumps(row.event, sort_keys=True)), (row.group, row.event))
+
+    try:
+        async_to_sync(publish_events)(get_channel_layer(), events.values())
+    except Exception:
+        claimed.update(next_attempt_at=timezone.now())
+        raise
+    claimed.delete()
+    return len(rows)
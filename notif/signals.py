@@ -1,45 +1,11 @@
-import time
-
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 
 from marketplace.models import Order
-from .models import Notifications
+from .services import create_notification
 from monitoring.models import Employee, STATUS_CHOICES
 from chat.models import Message
 
-SLEEP_TIME = 3
-
-
-
-
-@receiver(post_save, sender=Notifications)
-def notify_customers(sender, instance, **kwargs):
-    """
-    Updates notifications on customer side.
-    """
-    time.sleep(SLEEP_TIME)
-    channel_layer = get_channel_layer()  # Use this function
-    async_to_sync(channel_layer.group_send)(
-        "branch",
-        {
-            "type": "get_notifications",
-        },
-    )
-
-
-# @receiver(post_delete, sender=Notifications)
-# def notify_customers_on_delete(sender, instance, **kwargs):
-#     time.sleep(SLEEP_TIME)
-#     channel_layer = get_channel_layer()  # Use this function
-#     async_to_sync(channel_layer.group_send)(
-#         "branch",
-#         {
-#             "type": "get_notifications",
-#         },
-# )
 
 @receiver(post_save, sender=Employee, dispatch_uid="employee-create")
 def customer_status_changed(sender, instance, created, **kwargs):
@@ -47,23 +13,8 @@ def customer_status_changed(sender, instance, created, **kwargs):
         if instance.status == STATUS_CHOICES[1][0]:
             title = "Приглашение в организацию"
             description = "Вы были приглашены в организацию {} на должность {}".format(instance.org.title, instance.job_title.title)
-            Notifications.objects.create(
-                type = 'Organization',
-                title=title,
-                description=description,
-                recipient=instance.user,
-                target_slug=instance.org.slug
-            )
-
-            user_name = f"{instance.user.id}-notifications"
-
-            channel_layer = get_channel_layer()  # Use this function
-            async_to_sync(channel_layer.group_send)(
-                user_name,
-                {
-                    "type": "get_notifications_handler",
-                }
-            )
+            create_notification(instance.user, title, description, type='Organization',
+                                target_slug=instance.org.slug)
 
 # @receiver(pre_save, sender=Order, dispatch_uid="order-apply")
 # def order_apply_notification(sender, instance, **kwargs):
@@ -107,77 +58,43 @@ def customer_status_changed(sender, instance, created, **kwargs):
 #                     }
 #                 )
 
-@receiver(pre_save, sender=Order, dispatch_uid="order-book")
-def order_book_notification(sender, instance, **kwargs):
-    previous = Order.objects.filter(id=instance.id).first()
-    if previous:
-        if previous.is_booked == False and instance.is_booked == True:
-            title = "Заказ забронирован"
-            description = f"Ваш заказ {instance.title} был забронирован."
-            Notifications.objects.create(
-                type = 'Order',
-                title=title,
-                description=description,
-                recipient=instance.author,
-                target_slug=instance.slug
-            )
-
-            user_name = f"{instance.author.id}-notifications"
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                user_name,
-                {
-                    "type": "get_notifications_handler",
-                }
-            )
-
-@receiver(pre_save, sender=Order, dispatch_uid="order-finish")
-def order_finish_notification(sender, instance, **kwargs):
-    previous = Order.objects.filter(id=instance.id).first()
-    if previous and previous.is_finished == False and instance.is_finished == True:
+def order_book_notification(order, previous, current):
+    if previous == False and current == True:
+        title = "Заказ забронирован"
+        description = f"Ваш заказ {order.title} был забронирован."
+        create_notification(order.author, title, description, type='Order', target_slug=order.slug)
+
+def order_finish_notification(order, previous, current):
+    if previous == False and current == True:
         # Notify the order author
         title = "Заказ готов"
-        description = f"Ваш заказ - '{instance.title}' готов."
-        Notifications.objects.create(
-            type = 'Order',
-            title=title,
-            description=description,
-            recipient=instance.author,
-            target_slug = instance.slug
-        )
-
-        user_name = f"{instance.author.id}-notifications"
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            user_name,
-            {
-                "type": "get_notifications_handler",
-            }
-        )
-
-@receiver(pre_save, sender=Order, dispatch_uid="order-status-update")
-def order_status_update_notification(sender, instance, **kwargs):
+        description = f"Ваш заказ - '{order.title}' готов."
+        create_notification(order.author, title, description, type='Order', target_slug=order.slug)
+
+def order_status_update_notification(order, previous, current):
     # Notify the order author about the status change
-    previous = Order.objects.filter(id=instance.id).first()
-    if previous and previous.status != instance.status:
-        title = "Статус заказа изменился!"
-        description = f"Статус вашего заказа {instance.title} изменился c {previous.status} на {instance.status}."
-        Notifications.objects.create(
-            type = 'Order',
-            title=title,
-            description=description,
-            recipient=instance.author,
-            target_slug = instance.slug
-        )
-
-        user_name = f"{instance.author.id}-notifications"
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            user_name,
-            {
-                "type": "get_notifications_handler",
-            }
-        )
+    title = "Статус заказа изменился!"
+    description = f"Статус вашего заказа {order.title} изменился c {previous} на {current}."
+    create_notification(order.author, title, description, type='Order', target_slug=order.slug)
+
+ORDER_CHANGE_HANDLERS = (
+    ('is_booked', order_book_notification),
+    ('is_finished', order_finish_notification),
+    ('status', order_status_update_notification),
+)
+
+@receiver(post_save, sender=Order, dispatch_uid="order-changes")
+def order_changed(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Routes a saved order to the handlers of the tracked fields it changed.
+    Saves that touch none of them cost no extra queries.
+    """
+    if created:
+        return
+    changes = instance.get_tracked_changes(update_fields)
+    for field, handler in ORDER_CHANGE_HANDLERS:
+        if field in changes:
+            handler(instance, *changes[field])
 
 # @receiver(post_save, sender=Message, dispatch_uid="message-send")
 # def customer_status_changed(sender, instance, created, **kwargs):
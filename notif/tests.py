@@ -1,3 +1,345 @@
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authorization.factories import create_profile
+from marketplace.factories import create_order
+from .consumers import NotificationConsumer
+from .models import DeviceToken, Notifications, NotificationOutbox, NotificationState, PushOutbox
+from .push import PUSH_LEASE, FakeTransport, dispatch_push_batch, queue_push
+from .services import OUTBOX_LEASE, create_notification, create_notifications, dispatch_outbox, get_notifications_group, \
+    get_last_sequence, mark_notifications_read, get_unread_count
+
+
+def join_group(group):
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)(group, channel)
+    return layer, channel
+
+
+class NotificationOutboxTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile("recipient")
+
+    def test_outbox_event_is_written_with_the_notification(self):
+        notification = create_notification(self.profile, "Title", "Description", target_slug='slug')
+        row = NotificationOutbox.objects.get()
+        self.assertEqual(row.group, get_notifications_group(self.profile.id))
+        self.assertEqual(row.event['type'], 'notification_created')
+        self.assertEqual(row.event['notification']['id'], notification.id)
+
+    def test_rolled_back_notification_leaves_no_event(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            create_notification(self.profile, "Title", "Description")
+            raise RuntimeError
+        self.assertFalse(Notifications.objects.exists())
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_order_change_does_not_block_the_request(self):
+        order = create_order(self.profile)
+        with mock.patch('time.sleep', side_effect=AssertionError("slept")), \
+                mock.patch('notif.services.get_channel_layer', side_effect=AssertionError("published")):
+            order.status = 'Process'
+            order.save()
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_dispatch_publishes_and_deletes(self):
+        layer, channel = join_group(get_notifications_group(self.profile.id))
+        notification = create_notification(self.profile, "Title", "Description")
+        self.assertEqual(dispatch_outbox(), 1)
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual(event['notification']['id'], notification.id)
+        self.assertFalse(NotificationOutbox.objects.exists())
+        self.assertEqual(dispatch_outbox(), 0)
+
+    def test_failed_publish_keeps_the_events(self):
+        layer, channel = join_group(get_notifications_group(self.profile.id))
+        create_notification(self.profile, "Title", "Description")
+        with mock.patch('notif.services.publish_events', side_effect=ConnectionError), \
+                self.assertRaises(ConnectionError):
+            dispatch_outbox()
+        # Delivered at least once: the next run publishes what the failed one could not
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+        self.assertEqual(dispatch_outbox(), 1)
+        self.assertEqual(async_to_sync(layer.receive)(channel)['type'], 'notification_created')
+
+    def test_events_are_published_outside_the_transaction(self):
+        create_notification(self.profile, "Title", "Description")
+        depth = len(connection.atomic_blocks)
+        depths = []
+        # Recorded on the calling thread, the coroutine gets a connection of its own
+        with mock.patch('notif.services.async_to_sync', side_effect=lambda function: lambda *args: depths.append(
+                len(connection.atomic_blocks))):
+            self.assertEqual(dispatch_outbox(), 1)
+        self.assertEqual(depths, [depth])
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_batch_of_a_dead_dispatcher_is_published_after_the_lease(self):
+        create_notification(self.profile, "Title", "Description")
+        with mock.patch('notif.services.publish_events', side_effect=SystemExit), self.assertRaises(SystemExit):
+            dispatch_outbox()
+        self.assertEqual(dispatch_outbox(), 0)
+        later = timezone.now() + timedelta(seconds=OUTBOX_LEASE + 1)
+        with mock.patch('django.utils.timezone.now', return_value=later), \
+                mock.patch('notif.services.publish_events', new=mock.AsyncMock()):
+            self.assertEqual(dispatch_outbox(), 1)
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_identical_events_are_published_once(self):
+        group = get_notifications_group(self.profile.id)
+        for _ in range(3):
+            NotificationOutbox.objects.create(group=group, event={'type': 'get_notifications_handler'})
+        with mock.patch('notif.services.publish_events', new=mock.AsyncMock()) as publish_events:
+            self.assertEqual(dispatch_outbox(), 3)
+        self.assertEqual(list(publish_events.call_args.args[1]), [(group, {'type': 'get_notifications_handler'})])
+
+
+class NotificationSequenceTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile("recipient")
+        self.other = create_profile("other")
+
+    def test_sequences_increase_per_recipient(self):
+        sequences = [create_notification(self.profile, "Title", str(number)).sequence for number in range(3)]
+        self.assertEqual(sequences, [1, 2, 3])
+        self.assertEqual(create_notification(self.other, "Title", "").sequence, 1)
+
+    def test_bulk_creation_continues_the_sequences(self):
+        create_notification(self.profile, "Title", "")
+        notifications = create_notifications([
+            Notifications(recipient=self.profile, title="Bulk", description=""),
+            Notifications(recipient=self.other, title="Bulk", description=""),
+            Notifications(recipient=self.profile, title="Bulk", description=""),
+        ])
+        self.assertEqual([notification.sequence for notification in notifications], [2, 1, 3])
+        self.assertEqual(get_last_sequence(self.profile.id), 3)
+        self.assertEqual(NotificationOutbox.objects.count(), 4)
+
+    def test_sequences_are_unique_per_recipient(self):
+        create_notification(self.profile, "Title", "")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Notifications.objects.create(recipient=self.profile, title="Copy", description="", sequence=1)
+
+
+class NotificationStreamTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile("recipient")
+        for number in range(3):
+            create_notification(self.profile, "Title", str(number))
+
+    async def connect(self, query=''):
+        communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(),
+                                             f"/ws/notifications/{self.profile.id}/?{query}")
+        communicator.scope['user'] = self.profile.user
+        communicator.scope['url_route'] = {'kwargs': {'user_id': str(self.profile.id)}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_resume_gets_a_delta(self):
+        communicator = await self.connect('last_sequence=1')
+        message = await communicator.receive_json_from()
+        self.assertEqual(message['type'], 'delta')
+        self.assertEqual(message['sequence'], 3)
+        self.assertEqual([notification['sequence'] for notification in message['notifications']], [2, 3])
+        await communicator.disconnect()
+
+    async def test_up_to_date_client_gets_an_empty_delta(self):
+        communicator = await self.connect('last_sequence=3')
+        message = await communicator.receive_json_from()
+        self.assertEqual((message['type'], message['notifications']), ('delta', []))
+        await communicator.disconnect()
+
+    async def test_clients_without_a_sequence_get_a_snapshot(self):
+        communicator = await self.connect()
+        message = await communicator.receive_json_from()
+        self.assertEqual(message['type'], 'snapshot')
+        self.assertEqual(len(message['notifications']), 3)
+        await communicator.disconnect()
+
+    async def test_clients_too_far_behind_get_a_snapshot(self):
+        await database_sync_to_async(mark_notifications_read)(self.profile, 2)
+        with mock.patch('notif.consumers.NOTIFICATION_DELTA_LIMIT', 1):
+            communicator = await self.connect('last_sequence=0')
+            message = await communicator.receive_json_from()
+        self.assertEqual(message['type'], 'snapshot')
+        self.assertEqual([notification['sequence'] for notification in message['notifications']], [3])
+        await communicator.disconnect()
+
+    async def test_live_notifications_arrive_as_deltas(self):
+        communicator = await self.connect('last_sequence=3')
+        await communicator.receive_json_from()
+        notification = await database_sync_to_async(create_notification)(self.profile, "Live", "")
+        await database_sync_to_async(dispatch_outbox)()
+        message = await communicator.receive_json_from()
+        self.assertEqual((message['type'], message['sequence']), ('delta', notification.sequence))
+        self.assertEqual([row['id'] for row in message['notifications']], [notification.id])
+        await communicator.disconnect()
+
+    async def test_a_gap_replays_the_missed_notifications(self):
+        communicator = await self.connect('last_sequence=3')
+        await communicator.receive_json_from()
+
+        def miss_one_event():
+            create_notification(self.profile, "Missed", "")
+            NotificationOutbox.objects.all().delete()
+            create_notification(self.profile, "Live", "")
+            dispatch_outbox()
+
+        await database_sync_to_async(miss_one_event)()
+        message = await communicator.receive_json_from()
+        self.assertEqual([row['sequence'] for row in message['notifications']], [4, 5])
+        await communicator.disconnect()
+
+
+class MarkReadTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile("recipient")
+        self.notifications = [create_notification(self.profile, "Title", str(number)) for number in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.profile.user)
+
+    def test_mark_all_read_with_one_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(mark_notifications_read(self.profile), 5)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "notif_notifications"')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(Notifications.objects.filter(read=False).exists())
+        self.assertEqual(NotificationState.objects.get(recipient=self.profile).read_sequence, 5)
+
+    def test_mark_read_up_to_a_sequence(self):
+        self.assertEqual(mark_notifications_read(self.profile, 3), 3)
+        self.assertEqual(get_unread_count(self.profile.id), 2)
+        # The watermark never moves back, nor past the last sequence
+        self.assertEqual(mark_notifications_read(self.profile, 1), 0)
+        self.assertEqual(mark_notifications_read(self.profile, 100), 2)
+        self.assertEqual(NotificationState.objects.get(recipient=self.profile).read_sequence, 5)
+
+    def test_unread_count_reads_only_the_watermark(self):
+        mark_notifications_read(self.profile, 4)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(get_unread_count(self.profile.id), 1)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"notif_notifications"', queries[0]['sql'])
+
+    def test_single_reads_count_above_the_watermark(self):
+        response = self.client.put(f'/notification/read/{self.notifications[2].id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_unread_count(self.profile.id), 4)
+        response = self.client.put(f'/notification/read/{self.notifications[2].id}/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_unread_count(self.profile.id), 4)
+        # The watermark passes the notification read on its own
+        self.assertEqual(mark_notifications_read(self.profile, 4), 3)
+        self.assertEqual(get_unread_count(self.profile.id), 1)
+        self.assertEqual(NotificationState.objects.get(recipient=self.profile).read_above, 0)
+
+    def test_deleted_notifications_are_not_unread(self):
+        self.client.put(f'/notification/read/{self.notifications[1].id}/')
+        for notification in self.notifications[:2]:
+            response = self.client.delete(f'/notifications/delete/{notification.id}/')
+            self.assertEqual(response.status_code, 204)
+        self.assertEqual(get_unread_count(self.profile.id), 3)
+        self.assertEqual(mark_notifications_read(self.profile), 3)
+        self.assertEqual(get_unread_count(self.profile.id), 0)
+        create_notification(self.profile, "Title", "New")
+        self.assertEqual(get_unread_count(self.profile.id), 1)
+
+    def test_delete_all_clears_the_unread_count(self):
+        response = self.client.delete('/notifications/delete/all/')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Notifications.objects.exists())
+        self.assertEqual(get_unread_count(self.profile.id), 0)
+
+    def test_read_list_view(self):
+        response = self.client.put('/notificationslist/read/', {'up_to_sequence': 2}, format='json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/notifications/list/')
+        self.assertEqual(response.data['unread_count'], 3)
+        response = self.client.put('/notificationslist/read/', {'up_to_sequence': 'x'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class PushTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile("recipient")
+        self.other = create_profile("other")
+        DeviceToken.objects.create(profile=self.profile, token="phone")
+        DeviceToken.objects.create(profile=self.profile, token="tablet")
+        self.transport = FakeTransport(latency=0)
+
+    def test_notification_queues_a_push_per_device(self):
+        create_notification(self.profile, "Title", "Description", target_slug='slug')
+        create_notification(self.other, "Title", "Description")
+        rows = PushOutbox.objects.order_by('token')
+        self.assertEqual([row.token for row in rows], ["phone", "tablet"])
+        self.assertEqual(rows[0].payload, {'title': "Title", 'body': "Description",
+                                           'data': {'type': 'Order', 'target_slug': 'slug'}})
+
+    def test_rolled_back_notification_leaves_no_push(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            create_notification(self.profile, "Title", "Description")
+            raise RuntimeError
+        self.assertFalse(PushOutbox.objects.exists())
+
+    def test_bulk_notifications_share_a_multicast(self):
+        DeviceToken.objects.create(profile=self.other, token="other-phone")
+        create_notifications(Notifications(recipient=profile, title="Title", description="Description")
+                             for profile in (self.profile, self.other))
+        self.assertEqual(PushOutbox.objects.count(), 3)
+        self.assertEqual(dispatch_push_batch(self.transport)['sent'], 3)
+        self.assertEqual(self.transport.multicasts, 1)
+        self.assertFalse(PushOutbox.objects.exists())
+
+    def test_pushes_are_sent_outside_the_transaction(self):
+        queue_push([("phone", {'title': "Title", 'body': "Body"})])
+        depth = len(connection.atomic_blocks)
+        depths = []
+        send_multicast = self.transport.send_multicast
+        with mock.patch.object(self.transport, 'send_multicast',
+                               side_effect=lambda tokens, payload: depths.append(len(connection.atomic_blocks))
+                               or send_multicast(tokens, payload)):
+            dispatch_push_batch(self.transport)
+        self.assertEqual(depths, [depth])
+
+    def test_invalid_token_is_forgotten(self):
+        self.profile.device_token = "invalid-phone"
+        self.profile.save()
+        DeviceToken.objects.create(profile=self.profile, token="invalid-phone")
+        queue_push([("invalid-phone", {'title': "Title", 'body': "Body"})])
+        with mock.patch('notif.push.invalidate_auth_user') as invalidate:
+            self.assertEqual(dispatch_push_batch(self.transport)['invalid'], 1)
+        invalidate.assert_called_once_with(self.profile.user_id)
+        self.assertFalse(DeviceToken.objects.filter(token="invalid-phone").exists())
+        self.profile.refresh_from_db()
+        self.assertIsNone(self.profile.device_token)
+
+    def test_transient_failure_is_retried_with_backoff(self):
+        queue_push([("phone", {'title': "Title", 'body': "Body"})])
+        self.transport.failure_rate = 1
+        self.assertEqual(dispatch_push_batch(self.transport)['retried'], 1)
+        row = PushOutbox.objects.get()
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.next_attempt_at, timezone.now())
+        self.assertEqual(dispatch_push_batch(self.transport)['retried'], 0)
 
-# Create your tests here.
+    def test_batch_of_a_dead_worker_is_sent_after_the_lease(self):
+        queue_push([("phone", {'title': "Title", 'body': "Body"})])
+        with mock.patch.object(self.transport, 'send_multicast', side_effect=SystemExit), \
+                self.assertRaises(SystemExit):
+            dispatch_push_batch(self.transport)
+        self.assertFalse(any(dispatch_push_batch(self.transport).values()))
+        later = timezone.now() + timedelta(seconds=PUSH_LEASE + 1)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(dispatch_push_batch(self.transport)['sent'], 1)
+        self.assertEqual([token for token, payload in self.transport.sent], ["phone"])
@@ -7,5 +7,6 @@ urlpatterns = [
     path('notifications/delete/all/', NotificationAllDeleteView.as_view(), name='delete-all'),
     path('notifications/list/', UserNotificationListView.as_view(), name='notifications'),
     path('notification/read/<int:notif_id>/', ReadNotificationView.as_view(), name='notificationread'),
-    path('notificationslist/read/', ReadNotificationListView.as_view(), name='notificationslistread')
+    path('notificationslist/read/', ReadNotificationListView.as_view(), name='notificationslistread'),
+    path('notifications/devices/', DeviceTokenView.as_view(), name='notification-devices'),
 ]
\ No newline at end of file
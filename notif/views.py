@@ -2,50 +2,49 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
+from marketplace.services import paginate
 from .serializers import UserNotificationSerializer
-from .models import Notifications
+from .models import Notifications, DeviceToken
+from .services import mark_notifications_read, get_unread_count, settle_notification, delete_notifications
 
 class NotificationDeleteView(APIView):
     permission_classes = [IsAuthenticated]
 
     def delete(self, request, pk, *args, **kwargs):
-        try:
-            notification = Notifications.objects.get(pk=pk, recipient=request.user.user_profile)
-            notification.delete()
+        if settle_notification(request.user.user_profile, pk, delete=True):
             return Response(status=status.HTTP_204_NO_CONTENT)
-        except Notifications.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_404_NOT_FOUND)
 
 
 class NotificationAllDeleteView(APIView):
     permission_classes = [IsAuthenticated]
 
     def delete(self, request, *args, **kwargs):
-        try:
-            notifications = Notifications.objects.filter(recipient=request.user.user_profile)
-            notifications.delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        except Notifications.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
+        delete_notifications(request.user.user_profile)
+        return Response(status=status.HTTP_204_NO_CONTENT)
         
 class UserNotificationListView(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = UserNotificationSerializer
 
     def get(self, request, *args, **kwargs):
-        notifications = Notifications.objects.filter(recipient=request.user.user_profile).order_by('-timestamp')
-        serializer = self.serializer_class(notifications, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        recipient = request.user.user_profile
+        notifications = Notifications.objects.filter(recipient=recipient).select_related('recipient').order_by('-timestamp')
+        page_obj, pagination = paginate(notifications, request, cursor_field='timestamp')
+        serializer = self.serializer_class(page_obj, many=True)
+        data = {
+            'data': serializer.data,
+            'unread_count': get_unread_count(recipient.id),
+            **pagination,
+        }
+        return Response(data, status=status.HTTP_200_OK)
     
 class ReadNotificationView(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = UserNotificationSerializer
 
     def put(self, request, notif_id, *args, **kwargs):
-        notification = Notifications.objects.filter(id = notif_id, recipient=request.user.user_profile, read = False).first()
-        if notification:
-            notification.read = True
-            notification.save()
+        if settle_notification(request.user.user_profile, notif_id):
             return Response({"Success": "Уведомление прочитано."}, status=status.HTTP_200_OK)
         else:
             return Response({"Message": "Нет такого уведомления или оно уже прочитано."}, status=status.HTTP_400_BAD_REQUEST)
@@ -55,8 +54,28 @@ class ReadNotificationListView(APIView):
     serializer_class = UserNotificationSerializer
 
     def put(self, request, *args, **kwargs):
-        notifications = Notifications.objects.filter(recipient=request.user.user_profile, read = False)
-        for notification in notifications:
-            notification.read = True
-            notification.save()
-        return Response({"Success": "Уведомления прочитаны."}, status=status.HTTP_200_OK)
\ No newline at end of file
+        # Optional `up_to_sequence` marks only the notifications up to that sequence
+        up_to_sequence = request.data.get('up_to_sequence')
+        if up_to_sequence is not None:
+            try:
+                up_to_sequence = int(up_to_sequence)
+            except (TypeError, ValueError):
+                return Response({"Error": "up_to_sequence должен быть числом."}, status=status.HTTP_400_BAD_REQUEST)
+        mark_notifications_read(request.user.user_profile, up_to_sequence)
+        return Response({"Success": "Уведомления прочитаны."}, status=status.HTTP_200_OK)
+
+
+class DeviceTokenView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        # Registers the FCM token of one of the user's devices; a token moves with its latest account
+        token = request.data.get('token')
+        if not token or len(token) > 255:
+            return Response({"Error": "Укажите token устройства."}, status=status.HTTP_400_BAD_REQUEST)
+        DeviceToken.objects.update_or_create(token=token, defaults={'profile': request.user.user_profile})
+        return Response({"Success": "Устройство зарегистрировано."}, status=status.HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        DeviceToken.objects.filter(token=request.data.get('token'), profile=request.user.user_profile).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
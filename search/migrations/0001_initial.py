@@ -0,0 +1,56 @@
+from django.db import migrations
+
+
+SEARCH_TABLES = {
+    'marketplace_order': 'title',
+    'marketplace_equipment': 'title',
+    'marketplace_service': 'title',
+    'job_vacancy': 'job_title',
+    'job_resume': 'job_title',
+}
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, field in SEARCH_TABLES.items():
+            schema_editor.execute(f'CREATE INDEX {table}_search_vector_idx ON {table} USING gin (search_vector)')
+            schema_editor.execute(f'CREATE INDEX {table}_{field}_trgm_idx ON {table} USING gin ({field} gin_trgm_ops)')
+            schema_editor.execute(
+                f'CREATE TRIGGER {table}_search_vector_trigger BEFORE INSERT OR UPDATE OF {field} ON {table} '
+                f"FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.simple', {field})"
+            )
+            schema_editor.execute(
+                f"UPDATE {table} SET search_vector = to_tsvector('pg_catalog.simple', coalesce({field}, ''))"
+            )
+    elif vendor == 'sqlite':
+        for table, field in SEARCH_TABLES.items():
+            schema_editor.execute(f"CREATE VIRTUAL TABLE {table}_fts USING fts5(title, tokenize='trigram')")
+            schema_editor.execute(f'INSERT INTO {table}_fts (rowid, title) SELECT id, {field} FROM {table}')
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for table, field in SEARCH_TABLES.items():
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {table}_search_vector_trigger ON {table}')
+            schema_editor.execute(f'DROP INDEX IF EXISTS {table}_{field}_trgm_idx')
+            schema_editor.execute(f'DROP INDEX IF EXISTS {table}_search_vector_idx')
+    elif vendor == 'sqlite':
+        for table in SEARCH_TABLES:
+            schema_editor.execute(f'DROP TABLE IF EXISTS {table}_fts')
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('marketplace', '0016_search_vector'),
+        ('job', '0009_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,116 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connections
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
+
+from job.models import Vacancy, Resume
+from marketplace.models import Order, Equipment, Service
+
+
+SEARCH_FIELDS = {
+    Order: 'title',
+    Equipment: 'title',
+    Service: 'title',
+    Vacancy: 'job_title',
+    Resume: 'job_title',
+}
+
+SEARCH_CONFIG = 'simple'  # no stemming: titles are in Russian and Kyrgyz
+
+# The FTS5 trigram tokenizer can only match terms of at least 3 characters
+FTS_MIN_TERM_LENGTH = 3
+
+
+def get_fts_table(model):
+    return f'{model._meta.db_table}_fts'
+
+
+def search_queryset(queryset, query):
+    """
+    Filters the queryset by `query` on its title and orders it by relevance.
+    PostgreSQL matches word prefixes on the `search_vector` column and
+    tolerates typos with pg_trgm; SQLite uses the FTS5 trigram table.
+    """
+    field = SEARCH_FIELDS[queryset.model]
+    terms = re.findall(r'\w+', query)
+    vendor = connections[queryset.db].vendor
+
+    if terms and vendor == 'postgresql':
+        search_query = SearchQuery(' & '.join(f'{term}:*' for term in terms), config=SEARCH_CONFIG,
+                                   search_type='raw')
+        return queryset.annotate(
+            search_rank=SearchRank(F('search_vector'), search_query),
+            search_similarity=TrigramSimilarity(field, query),
+        ).filter(
+            Q(search_vector=search_query) | Q(**{f'{field}__trigram_similar': query})
+        ).order_by('-search_rank', '-search_similarity', '-created_at')
+
+    if terms and vendor == 'sqlite' and min(map(len, terms)) >= FTS_MIN_TERM_LENGTH:
+        table = queryset.model._meta.db_table
+        fts_table = get_fts_table(queryset.model)
+        match = ' '.join(f'"{term}"' for term in terms)
+        return queryset.annotate(
+            search_rank=RawSQL(f'SELECT bm25({fts_table}) FROM {fts_table} '
+                               f'WHERE {fts_table} MATCH %s AND rowid = "{table}"."id"', (match,)),
+        ).filter(
+            id__in=RawSQL(f'SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH %s', (match,))
+        ).order_by('search_rank', '-created_at')
+
+    return queryset.filter(**{f'{field}__icontains': query}).order_by('-created_at')
+
+
+def index_instance(instance):
+    """
+    Keeps the SQLite FTS5 table in sync. PostgreSQL fills `search_vector`
+    with a trigger, so there is nothing to do there.
+    """
+    connection = connections[instance._state.db]
+    if connection.vendor != 'sqlite':
+        return
+    fts_table = get_fts_table(type(instance))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {fts_table} WHERE rowid = %s', [instance.pk])
+        cursor.execute(f'INSERT INTO {fts_table} (rowid, title) VALUES (%s, %s)',
+                       [instance.pk, getattr(instance, SEARCH_FIELDS[type(instance)])])
+
+
+def remove_instance(instance):
+    connection = connections[instance._state.db]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {get_fts_table(type(instance))} WHERE rowid = %s', [instance.pk])
+
+
+FEDERATED_SEARCH_LIMIT = 50
+# Facets of types with more hits than this are reported as "1000+"
+FACET_COUNT_LIMIT = 1000
+
+
+def get_facet_count(queryset):
+    # Counts at most FACET_COUNT_LIMIT + 1 rows instead of every match of a broad query
+    count = queryset.values('pk').order_by()[:FACET_COUNT_LIMIT + 1].count()
+    return count if count <= FACET_COUNT_LIMIT else f'{FACET_COUNT_LIMIT}+'
+
+
+def federated_search(querysets, query, limit=FEDERATED_SEARCH_LIMIT):
+    """
+    Searches several querysets in one go. Loads at most `limit` top hits of
+    each one and interleaves them by their rank within their own type, so
+    one type with many weak hits does not push out the best hits of the
+    others. Returns the merged hits and the hit count per key of
+    `querysets`; counts are only taken up to FACET_COUNT_LIMIT, larger
+    ones are reported as "<FACET_COUNT_LIMIT>+".
+    """
+    ranked = []
+    facets = {}
+    for key, queryset in querysets.items():
+        queryset = search_queryset(queryset, query)
+        hits = list(queryset[:limit])
+        facets[key] = len(hits) if len(hits) < limit else get_facet_count(queryset)
+        ranked.extend((position, hit) for position, hit in enumerate(hits))
+
+    ranked.sort(key=lambda item: (item[0], -item[1].created_at.timestamp()))
+    return [hit for position, hit in ranked], facets
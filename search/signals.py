@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete
+
+from .services import SEARCH_FIELDS, index_instance, remove_instance
+
+
+def update_search_index(sender, instance, **kwargs):
+    index_instance(instance)
+
+
+def delete_from_search_index(sender, instance, **kwargs):
+    remove_instance(instance)
+
+
+for model in SEARCH_FIELDS:
+    post_save.connect(update_search_index, sender=model, dispatch_uid=f'search-index-{model._meta.label_lower}')
+    post_delete.connect(delete_from_search_index, sender=model,
+                        dispatch_uid=f'search-remove-{model._meta.label_lower}')
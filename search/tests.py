@@ -0,0 +1,84 @@
+from unittest import mock
+
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from authorization.factories import create_profile
+from authorization.models import Organization
+from job.models import Vacancy
+from marketplace.factories import create_order
+from marketplace.models import Order, Service
+from .services import search_queryset, federated_search
+
+
+def search_titles(query):
+    return [order.title for order in search_queryset(Order.objects.all(), query)]
+
+
+class TitleSearchTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+
+    def test_matches_words_inside_titles(self):
+        create_order(self.author, "Пошив платьев")
+        create_order(self.author, "Ремонт обуви")
+        self.assertEqual(search_titles("плать"), ["Пошив платьев"])
+        self.assertEqual(search_titles("ремонт"), ["Ремонт обуви"])
+
+    def test_every_term_has_to_match(self):
+        create_order(self.author, "Пошив платьев")
+        create_order(self.author, "Пошив курток")
+        self.assertEqual(search_titles("пошив курт"), ["Пошив курток"])
+
+    def test_index_follows_saves_and_deletes(self):
+        order = create_order(self.author, "Пошив платьев")
+        order.title = "Пошив курток"
+        order.save()
+        self.assertEqual(search_titles("плать"), [])
+        self.assertEqual(search_titles("курт"), ["Пошив курток"])
+        order.delete()
+        self.assertEqual(search_titles("курт"), [])
+
+    def test_short_terms_fall_back_to_a_substring_match(self):
+        create_order(self.author, "IT форма")
+        self.assertEqual(search_titles("IT"), ["IT форма"])
+
+
+class FederatedSearchTests(TestCase):
+    def setUp(self):
+        self.author = create_profile("author")
+        organization = Organization.objects.create(founder=self.author, owner=self.author, title="Org",
+                                                   description="org")
+        self.orders = [create_order(self.author, f"Пошив {number}") for number in range(4)]
+        self.services = [Service.objects.create(author=self.author, title=f"Пошив услуга {number}", price=1,
+                                                phone_number="0700") for number in range(2)]
+        self.vacancy = Vacancy.objects.create(organization=organization, job_title="Швея, пошив", min_salary=1,
+                                              max_salary=2)
+
+    def get_querysets(self):
+        return {'order': Order.objects.all(), 'service': Service.objects.all(), 'vacancy': Vacancy.objects.all()}
+
+    def test_hits_of_every_type_are_interleaved(self):
+        hits, facets = federated_search(self.get_querysets(), "пошив")
+        self.assertEqual(facets, {'order': 4, 'service': 2, 'vacancy': 1})
+        # The best hit of every type comes before the second hits
+        self.assertEqual({type(hit) for hit in hits[:3]}, {Order, Service, Vacancy})
+        self.assertEqual(len(hits), 7)
+
+    def test_limit_per_type(self):
+        hits, facets = federated_search(self.get_querysets(), "пошив", limit=2)
+        self.assertEqual(sum(isinstance(hit, Order) for hit in hits), 2)
+        # Types that reach the limit are counted
+        self.assertEqual(facets['order'], 4)
+
+    def test_facet_counts_are_capped(self):
+        with mock.patch('search.services.FACET_COUNT_LIMIT', 3):
+            hits, facets = federated_search(self.get_querysets(), "пошив", limit=2)
+        self.assertEqual(facets, {'order': '3+', 'service': 2, 'vacancy': 1})
+
+    def test_search_view_without_a_type(self):
+        response = APIClient().get('/ads-search/', {'title': "пошив"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['facets'], {'order': 4, 'equipment': 0, 'service': 2, 'vacancy': 1,
+                                                   'resume': 0})
+        self.assertEqual({row['type'] for row in response.data['data'][:3]}, {'Order', 'Service', 'Vacancy'})
@@ -16,6 +16,10 @@ from channels.security.websocket import AllowedHostsOriginValidator
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "smarttale.settings")
 django_asgi_app = get_asgi_application()
 
+from authorization.blacklist import load_token_blacklist
+
+load_token_blacklist()
+
 import chat.routing
 # from chat.channelsmiddleware import JwtAuthMiddlewareStack
 from channels_auth_token_middlewares.middleware import QueryStringSimpleJWTAuthTokenMiddleware
@@ -68,6 +68,7 @@ INSTALLED_APPS = [
     'job',
     'chat',
     'notif',
+    'search',
 ]
 
 MIDDLEWARE = [
@@ -128,6 +129,8 @@ if not DEBUG:
         #     'PORT': config('DB_PORT'),
         # }
     }
+    # Trigram lookups used by the search app
+    INSTALLED_APPS += ['django.contrib.postgres']
     CHANNEL_LAYERS = {
         'default': {
             'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -136,6 +139,13 @@ if not DEBUG:
             },
         },
     }
+    # Shared by all workers: chat presence and typing state live here
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': f"redis://{config('BROKER_HOST', default='127.0.0.1')}:{config('BROKER_PORT', default=6379)}/1",
+        },
+    }
 else:
     DATABASES = {
         'default': {
@@ -217,8 +227,23 @@ CLOUDINARY_STORAGE = {
 
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
 
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Offline setups keep uploaded files on the local filesystem
+if config('LOCAL_FILE_STORAGE', default = False, cast = bool):
+    DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+
+# Staging directory of chunked chat attachment uploads
+CHAT_UPLOAD_DIR = config('CHAT_UPLOAD_DIR', default = os.path.join(BASE_DIR, 'chat_uploads'))
+
+# Push transport of the `dispatch_push` command; 'notif.push.FakeTransport' sends nothing
+PUSH_TRANSPORT = config('PUSH_TRANSPORT', default = 'notif.push.FCMTransport')
+
 # Email settings
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Tests and offline setups use 'django.core.mail.backends.console.EmailBackend' or '...filebased.EmailBackend'
+EMAIL_BACKEND = config('EMAIL_BACKEND', default = 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = config('EMAIL_FILE_PATH', default = os.path.join(BASE_DIR, 'sent_emails'))
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
@@ -243,10 +268,14 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'authorization.authentication.ProfileJWTAuthentication',
     ],
 }
 
+# Seconds an authenticated user stays cached per token, in each worker and in the shared cache; 0 turns it off
+AUTH_USER_LOCAL_CACHE_TTL = config('AUTH_USER_LOCAL_CACHE_TTL', default = 5, cast = int)
+AUTH_USER_CACHE_TTL = config('AUTH_USER_CACHE_TTL', default = 60, cast = int)
+
 AUTH_USER_MODEL = 'authorization.User'
 
 SIMPLE_JWT = {
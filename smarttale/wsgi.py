@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smarttale.settings')
 
 application = get_wsgi_application()
+
+from authorization.blacklist import load_token_blacklist
+
+load_token_blacklist()